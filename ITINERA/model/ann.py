@@ -0,0 +1,192 @@
+"""
+近似最近邻（IVF倒排）索引：对归一化embedding做球面k-means粗量化
+查询时只扫描与查询向量最近的nprobe个簇，对候选行精确计算余弦相似度后排序
+索引离线从 .npy 构建，保存为同名 .ivf.npz
+"""
+
+import os
+import argparse
+import numpy as np
+
+from model.embedding_store import open_store, normalize_rows
+from model.search import top_k_indices
+
+# 行数低于该值时暴力检索更快，不使用索引
+ANN_MIN_ROWS = 20000
+DEFAULT_NPROBE = 16
+
+
+def index_path_for(emb_path: str) -> str:
+    """embedding文件对应的索引路径：data/x.npy -> data/x.ivf.npz"""
+    return os.path.splitext(emb_path)[0] + ".ivf.npz"
+
+
+def _sample_checksum(embedding: np.ndarray, n_samples: int = 64) -> float:
+    """抽样行之和，用于判断索引是否仍对应当前embedding文件"""
+    if embedding.shape[0] == 0:
+        return 0.0
+    step = max(1, embedding.shape[0] // n_samples)
+    return float(np.asarray(embedding[::step], dtype=np.float64).sum())
+
+
+class IVFIndex:
+    """IVF倒排索引。
+
+    Args:
+        centroids (np.ndarray): (n_lists, emb_dim) 归一化簇中心。
+        order (np.ndarray): 按簇排列的行号。
+        offsets (np.ndarray): (n_lists + 1,) 每个簇在order中的起止位置。
+        mean_vector (np.ndarray): 全库embedding均值，用于精确得到负向相似度的全库均值。
+        checksum (float): 构建时embedding的抽样校验值。
+    """
+
+    def __init__(self, centroids: np.ndarray, order: np.ndarray, offsets: np.ndarray, mean_vector: np.ndarray, checksum: float = 0.0):
+        self.centroids = centroids.astype(np.float32, copy=False)
+        self.order = order.astype(np.int64, copy=False)
+        self.offsets = offsets.astype(np.int64, copy=False)
+        self.mean_vector = mean_vector.astype(np.float32, copy=False)
+        self.checksum = float(checksum)
+
+    @property
+    def n_lists(self) -> int:
+        return self.centroids.shape[0]
+
+    @property
+    def n_rows(self) -> int:
+        return self.order.shape[0]
+
+    @classmethod
+    def build(cls, embedding: np.ndarray, n_lists: int = None, n_iter: int = 20, train_size: int = 100000, seed: int = 0, batch_rows: int = 65536) -> "IVFIndex":
+        """球面k-means训练簇中心（超大库抽样训练），再将全部行分配到最近的簇。
+
+        Args:
+            embedding (np.ndarray): (n, emb_dim) 已按行归一化的embedding（可为只读mmap）。
+            n_lists (int, optional): 簇数，缺省为 sqrt(n)。
+            n_iter (int): k-means迭代次数。
+            train_size (int): 训练样本上限。
+            seed (int): 随机种子。
+            batch_rows (int): 分配阶段每批读取的行数，控制内存。
+        """
+        n = embedding.shape[0]
+        if n == 0:
+            raise ValueError("embedding为空，无法构建索引")
+        if not n_lists:
+            n_lists = int(np.sqrt(n))
+        n_lists = max(1, min(int(n_lists), n))
+        rng = np.random.default_rng(seed)
+
+        train_rows = np.sort(rng.choice(n, size=min(n, max(train_size, n_lists)), replace=False))
+        train = normalize_rows(np.asarray(embedding[train_rows]))
+        centroids = train[rng.choice(train.shape[0], size=n_lists, replace=False)].copy()
+        for _ in range(n_iter):
+            assign = np.argmax(train @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, train)
+            counts = np.bincount(assign, minlength=n_lists)
+            # 空簇重新随机取点
+            empty = counts == 0
+            if empty.any():
+                sums[empty] = train[rng.choice(train.shape[0], size=int(empty.sum()), replace=False)]
+            centroids = normalize_rows(sums)
+
+        assign = np.empty(n, dtype=np.int64)
+        mean_vector = np.zeros(embedding.shape[1], dtype=np.float64)
+        for start in range(0, n, batch_rows):
+            block = np.asarray(embedding[start:start + batch_rows], dtype=np.float32)
+            assign[start:start + batch_rows] = np.argmax(block @ centroids.T, axis=1)
+            mean_vector += block.sum(axis=0, dtype=np.float64)
+        mean_vector /= n
+
+        order = np.argsort(assign, kind="stable")
+        offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(assign, minlength=n_lists))
+        return cls(centroids, order, offsets, mean_vector, _sample_checksum(embedding))
+
+    def save(self, path: str):
+        tmp = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp, centroids=self.centroids, order=self.order, offsets=self.offsets,
+                 mean_vector=self.mean_vector, checksum=np.array(self.checksum))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str) -> "IVFIndex":
+        with np.load(path) as z:
+            return cls(z["centroids"], z["order"], z["offsets"], z["mean_vector"], float(z["checksum"]))
+
+    def matches(self, embedding: np.ndarray) -> bool:
+        """索引的行数、维度与抽样校验值是否与embedding一致"""
+        return (
+            embedding.shape[0] == self.n_rows
+            and embedding.shape[1] == self.centroids.shape[1]
+            and np.isclose(_sample_checksum(embedding), self.checksum, rtol=1e-6, atol=1e-6)
+        )
+
+    def candidates(self, query: np.ndarray, nprobe: int = DEFAULT_NPROBE, min_candidates: int = 0, allowed: np.ndarray = None) -> np.ndarray:
+        """返回nprobe个最近簇中的行号（给定allowed时只保留允许的行）；不足min_candidates时继续扩大探查的簇数"""
+        nprobe = max(1, min(int(nprobe), self.n_lists))
+        list_order = np.argsort(self.centroids @ query)[::-1]
+        chunks, count = [], 0
+        for j, l in enumerate(list_order):
+            rows = self.order[self.offsets[l]:self.offsets[l + 1]]
+            if allowed is not None:
+                rows = rows[allowed[rows]]
+            chunks.append(rows)
+            count += rows.shape[0]
+            if j + 1 >= nprobe and count >= min_candidates:
+                break
+        return np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.int64)
+
+    def search(self, embedding: np.ndarray, pos: np.ndarray, neg: np.ndarray = None, top_k: int = 10, nprobe: int = None, allowed: np.ndarray = None, mean_vector: np.ndarray = None):
+        """在候选行上精确重排，分数与暴力检索一致：pos - neg + mean(neg)
+
+        Args:
+            embedding (np.ndarray): 建索引时的归一化embedding。
+            pos (np.ndarray): (emb_dim,) 归一化正向查询向量。
+            neg (np.ndarray, optional): (emb_dim,) 归一化负向查询向量。
+            top_k (int): 返回条数。
+            nprobe (int, optional): 探查簇数，越大召回越高、延迟越大；缺省为DEFAULT_NPROBE。
+            allowed (np.ndarray, optional): (n_rows,) bool，预过滤允许的行。
+            mean_vector (np.ndarray, optional): 负向平移所用的embedding均值；缺省为全库均值，预过滤时传入允许行的均值。
+
+        Returns:
+            tuple: (行号, 分数)，按分数降序。
+        """
+        cand = np.sort(self.candidates(pos, nprobe=nprobe or DEFAULT_NPROBE, min_candidates=top_k, allowed=allowed))
+        vectors = np.asarray(embedding[cand], dtype=np.float32)
+        scores = vectors @ pos
+        if neg is not None:
+            mean = self.mean_vector if mean_vector is None else mean_vector
+            scores = scores - vectors @ neg + float(mean @ neg)
+        order = top_k_indices(scores, top_k)
+        return cand[order], scores[order]
+
+
+def load_index(emb_path: str, embedding: np.ndarray):
+    """加载emb_path旁的索引；不存在、已过期或库太小时返回None"""
+    path = index_path_for(emb_path)
+    if embedding is None or embedding.shape[0] < ANN_MIN_ROWS or not os.path.exists(path):
+        return None
+    try:
+        index = IVFIndex.load(path)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"[ANN] 索引读取失败，使用暴力检索: {e}")
+        return None
+    if not index.matches(embedding):
+        print(f"[ANN] 索引与embedding不一致，使用暴力检索（请重新构建）: {path}")
+        return None
+    return index
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="从embedding .npy 离线构建IVF近似检索索引")
+    parser.add_argument("emb", help="embedding npy路径")
+    parser.add_argument("--lists", type=int, default=None, help="簇数，默认sqrt(n)")
+    parser.add_argument("--iters", type=int, default=20)
+    parser.add_argument("--train-size", type=int, default=100000)
+    args = parser.parse_args()
+
+    emb = open_store(args.emb)
+    index = IVFIndex.build(emb, n_lists=args.lists, n_iter=args.iters, train_size=args.train_size)
+    out = index_path_for(args.emb)
+    index.save(out)
+    print(f"已写入 {out}: {index.n_rows} 行, {index.n_lists} 个簇")
@@ -0,0 +1,159 @@
+"""
+地块数据的类型化列存：CSV导入一次，写为 x.cols/（每列一个 .npy + schema.json）
+数值列预先转换为float64/int64（含 inf 的距离列同样按数值保存），字符串列字典编码为取值编号 + 字符串表；
+加载时数值列与编号只读映射，不再解析CSV或逐请求做类型转换
+"""
+
+import os
+import json
+import shutil
+import argparse
+import numpy as np
+import pandas as pd
+
+COLUMNAR_VERSION = 1
+# 去重取值占比不超过该值的字符串列加载为Categorical（如土地用途），其余解码为普通字符串列
+CATEGORY_MAX_RATIO = 0.5
+
+
+def columns_dir_for(data_path: str) -> str:
+    """CSV对应的列存目录：data/x.csv -> data/x.cols"""
+    return os.path.splitext(data_path)[0] + ".cols"
+
+
+def schema_path_for(data_path: str) -> str:
+    return os.path.join(columns_dir_for(data_path), "schema.json")
+
+
+def _source_signature(data_path: str) -> dict:
+    st = os.stat(data_path)
+    return {"file": os.path.basename(data_path), "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def _read_schema(out_dir: str) -> dict:
+    try:
+        with open(os.path.join(out_dir, "schema.json"), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def is_current(data_path: str) -> bool:
+    """列存存在、格式版本一致且由当前CSV（大小与修改时间）生成"""
+    schema = _read_schema(columns_dir_for(data_path))
+    if not schema or schema.get("version") != COLUMNAR_VERSION:
+        return False
+    try:
+        return schema.get("source") == _source_signature(data_path)
+    except OSError:
+        return False
+
+
+def _encode_column(series: pd.Series):
+    """返回 (kind, 数组, 字符串表)；能完整转为数值的对象列按float64保存"""
+    if pd.api.types.is_numeric_dtype(series.dtype) and not isinstance(series.dtype, pd.CategoricalDtype):
+        return "numeric", series.to_numpy(), None
+    codes, uniques = pd.factorize(series, use_na_sentinel=True)
+    # 只对去重取值尝试数值转换
+    coerced = pd.to_numeric(pd.Series(uniques, dtype=object), errors='coerce').to_numpy(dtype=np.float64)
+    if len(uniques) and not np.isnan(coerced).any():
+        return "numeric", np.append(coerced, np.nan)[codes], None
+    return "category", codes.astype(np.int32, copy=False), [str(u) for u in uniques]
+
+
+def write_columnar(frame: pd.DataFrame, out_dir: str, source: dict = None) -> str:
+    """写入列存目录（先写临时目录再整体替换）"""
+    tmp = f"{out_dir}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    columns = []
+    for i, name in enumerate(frame.columns):
+        kind, values, table = _encode_column(frame[name])
+        entry = {"name": str(name), "kind": kind, "dtype": str(values.dtype), "file": f"{i:03d}.npy"}
+        np.save(os.path.join(tmp, entry["file"]), np.ascontiguousarray(values))
+        if table is not None:
+            entry["dict"] = f"{i:03d}.dict.json"
+            with open(os.path.join(tmp, entry["dict"]), 'w', encoding='utf-8') as f:
+                json.dump(table, f, ensure_ascii=False)
+        columns.append(entry)
+    with open(os.path.join(tmp, "schema.json"), 'w', encoding='utf-8') as f:
+        json.dump({"version": COLUMNAR_VERSION, "rows": int(frame.shape[0]), "source": source, "columns": columns},
+                  f, ensure_ascii=False, indent=2)
+        f.write("\n")
+
+    # 目录不能原子覆盖：旧目录先移走再换入
+    old = f"{out_dir}.{os.getpid()}.old"
+    if os.path.exists(out_dir):
+        os.replace(out_dir, old)
+    os.replace(tmp, out_dir)
+    shutil.rmtree(old, ignore_errors=True)
+    return out_dir
+
+
+def read_columnar(out_dir: str) -> pd.DataFrame:
+    """从列存目录加载DataFrame：数值列与取值编号为只读mmap，低基数字符串列为Categorical"""
+    schema = _read_schema(out_dir)
+    if not schema:
+        raise FileNotFoundError(f"列存不存在: {out_dir}")
+    n_rows = int(schema["rows"])
+    data = {}
+    for entry in schema["columns"]:
+        values = np.load(os.path.join(out_dir, entry["file"]), mmap_mode='r')
+        if entry["kind"] == "numeric":
+            data[entry["name"]] = values
+            continue
+        with open(os.path.join(out_dir, entry["dict"]), 'r', encoding='utf-8') as f:
+            table = json.load(f)
+        if len(table) <= CATEGORY_MAX_RATIO * n_rows and len(set(table)) == len(table):
+            data[entry["name"]] = pd.Categorical.from_codes(values, categories=table)
+        else:
+            # 末尾追加None，编号-1（空值）解码为None
+            lookup = np.asarray(table + [None], dtype=object)
+            data[entry["name"]] = lookup[values]
+    return pd.DataFrame(data, copy=False)
+
+
+def ingest(data_path: str, prepare=None) -> str:
+    """读取CSV（可选标准化），写入同名列存目录"""
+    frame = pd.read_csv(data_path)
+    if prepare is not None:
+        frame = prepare(frame)
+    return write_columnar(frame, columns_dir_for(data_path), source=_source_signature(data_path))
+
+
+def read_site_frame(data_path: str) -> pd.DataFrame:
+    """列存可用时从列存读取，否则解析CSV（不触发导入）"""
+    if is_current(data_path):
+        return read_columnar(columns_dir_for(data_path))
+    return pd.read_csv(data_path)
+
+
+def load_site_frame(data_path: str, prepare=None) -> pd.DataFrame:
+    """加载标准化后的地块数据：列存缺失或CSV已变化时先导入（列存保存prepare之后的结果）。
+
+    Args:
+        data_path (str): 地块CSV路径。
+        prepare (callable, optional): 导入时的列标准化函数（如 registry.prepare_site_data）。
+    """
+    out_dir = columns_dir_for(data_path)
+    if not is_current(data_path):
+        print(f"[Columnar] 导入列存: {out_dir}")
+        try:
+            ingest(data_path, prepare)
+        except OSError as e:
+            # 数据目录不可写时退回逐次解析CSV
+            print(f"[Columnar] 列存写入失败，直接读取CSV: {e}")
+            frame = pd.read_csv(data_path)
+            return prepare(frame) if prepare is not None else frame
+    return read_columnar(out_dir)
+
+
+if __name__ == "__main__":
+    from model.registry import prepare_site_data
+
+    parser = argparse.ArgumentParser(description="将地块CSV导入为类型化列存（x.cols/）")
+    parser.add_argument("csv", help="地块数据CSV路径")
+    args = parser.parse_args()
+
+    out = ingest(os.path.abspath(args.csv), prepare_site_data)
+    print(f"已写入 {out}")
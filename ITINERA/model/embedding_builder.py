@@ -0,0 +1,269 @@
+"""
+数据集embedding批量生成：分块、并发请求、断点续传
+已完成的分块写入 {emb_path}.partial/ 目录，中断后重新运行只补齐缺失分块
+存储旁的 x.rowhash.npy 记录逐行context哈希，数据追加/修改后只为新增或变化的行请求embedding
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import concurrent.futures
+import numpy as np
+import pandas as pd
+
+from model.embedding_store import save_npy_atomic, normalize_rows, open_store, rowhash_path_for, row_hashes
+from model.columnar import read_site_frame
+
+try:
+    from tqdm import tqdm
+except ImportError:  # 进度条为可选依赖
+    tqdm = None
+
+
+class EmbeddingConfigError(RuntimeError):
+    """provider配置错误（如缺少proxy），重试无意义，直接抛出"""
+
+
+def build_context(data: pd.DataFrame) -> pd.Series:
+    """返回用于embedding的文本列：优先使用context列，否则由名称/地址/用途/面积/价格拼接。"""
+    # 若已有context列，优先使用
+    if 'context' in data.columns:
+        return data['context'].astype(str)
+    # 兼容真实数据的列名，生成简洁文本描述（避免三元表达式跨行导致语法错误）
+    if 'name' in data.columns:
+        name = data['name'].astype(str)
+    elif '宗地坐落' in data.columns:
+        name = data['宗地坐落'].astype(str)
+    else:
+        name = data.index.astype(str)
+    if 'address' in data.columns:
+        address = data['address'].astype(str)
+    elif '宗地坐落' in data.columns:
+        address = data['宗地坐落'].astype(str)
+    else:
+        address = name
+    # 缺失列使用空Series，保证长度与数据一致
+    usage = (data['土地用途'].astype(str) if '土地用途' in data.columns else pd.Series([''] * len(data)))
+    area = (data['宗地面积(平方米)'].astype(str) if '宗地面积(平方米)' in data.columns else pd.Series([''] * len(data)))
+    price = (data['挂牌起始价(万元)'].astype(str) if '挂牌起始价(万元)' in data.columns else pd.Series([''] * len(data)))
+    desc = ("用途:" + usage + "，面积:" + area + "㎡，起始价:" + price + "万元").str.strip()
+    return name + "，地址是" + address + "，" + desc
+
+
+class EmbeddingBuilder:
+    """分块并发生成embedding。
+
+    Args:
+        embed_fn (callable): 输入文本列表，返回 (n, emb_dim) 数组。
+        chunk_size (int): 每次请求的文本数，需低于提供商的单次输入上限。
+        max_workers (int): 并发请求数。
+        max_retries (int): 单个分块失败后的重试次数（指数退避）。
+        show_progress (bool): 是否显示进度。
+        tag (str): 生成方标识（provider/模型），变化后旧断点不可复用。
+    """
+
+    def __init__(self, embed_fn, chunk_size: int = 256, max_workers: int = 4, max_retries: int = 3, show_progress: bool = True, tag: str = ""):
+        self.embed_fn = embed_fn
+        self.tag = tag
+        self.chunk_size = max(1, int(chunk_size))
+        self.max_workers = max(1, int(max_workers))
+        self.max_retries = max(0, int(max_retries))
+        self.show_progress = show_progress
+
+    @staticmethod
+    def _fingerprint(texts: list) -> str:
+        h = hashlib.sha256()
+        for t in texts:
+            h.update(t.encode('utf-8'))
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def _embed_chunk(self, texts: list) -> np.ndarray:
+        for attempt in range(self.max_retries + 1):
+            try:
+                vectors = np.asarray(self.embed_fn(texts), dtype=np.float32)
+                if vectors.shape[0] != len(texts):
+                    raise RuntimeError(f"embedding数量不匹配: {vectors.shape[0]} != {len(texts)}")
+                return vectors
+            except Exception as e:
+                if attempt >= self.max_retries or isinstance(e, EmbeddingConfigError):
+                    raise
+                wait = 2 ** attempt
+                print(f"[Embedding] 分块请求失败，{wait}s后重试({attempt + 1}/{self.max_retries})：{e}")
+                time.sleep(wait)
+
+    def _prepare_partial(self, partial_dir: str, texts: list) -> set:
+        """校验/初始化断点目录，返回已完成的分块编号"""
+        meta = {"rows": len(texts), "chunk_size": self.chunk_size, "fingerprint": self._fingerprint(texts), "tag": self.tag}
+        meta_path = os.path.join(partial_dir, "meta.json")
+        if os.path.isdir(partial_dir):
+            try:
+                with open(meta_path, 'r', encoding='utf-8') as f:
+                    old = json.load(f)
+            except (OSError, ValueError):
+                old = None
+            if old != meta:
+                # 数据或分块大小已变化，旧断点不可复用
+                shutil.rmtree(partial_dir, ignore_errors=True)
+        os.makedirs(partial_dir, exist_ok=True)
+        with open(meta_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        done = set()
+        for fn in os.listdir(partial_dir):
+            if fn.startswith("chunk_") and fn.endswith(".npy"):
+                done.add(int(fn[len("chunk_"):-len(".npy")]))
+        return done
+
+    def build(self, texts: list, emb_path: str = "") -> np.ndarray:
+        """生成全部文本的embedding（L2归一化float32）；提供emb_path时启用断点并在完成后原子写入该路径。"""
+        texts = [str(t) for t in texts]
+        n_chunks = (len(texts) + self.chunk_size - 1) // self.chunk_size
+        partial_dir = f"{emb_path}.partial" if emb_path else None
+        done = self._prepare_partial(partial_dir, texts) if partial_dir else set()
+        chunks = {}
+        todo = [i for i in range(n_chunks) if i not in done]
+        if done:
+            print(f"[Embedding] 从断点恢复：已完成 {len(done)}/{n_chunks} 个分块")
+
+        bar = tqdm(total=n_chunks, initial=len(done), desc="embedding", unit="chunk") if (self.show_progress and tqdm is not None) else None
+
+        def run(i):
+            vectors = self._embed_chunk(texts[i * self.chunk_size:(i + 1) * self.chunk_size])
+            if partial_dir:
+                save_npy_atomic(os.path.join(partial_dir, f"chunk_{i:06d}.npy"), vectors)
+            return i, vectors
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = [executor.submit(run, i) for i in todo]
+                for k, future in enumerate(concurrent.futures.as_completed(futures)):
+                    i, vectors = future.result()
+                    if not partial_dir:
+                        chunks[i] = vectors
+                    if bar is not None:
+                        bar.update(1)
+                    elif self.show_progress:
+                        print(f"[Embedding] 进度 {len(done) + k + 1}/{n_chunks}")
+        finally:
+            if bar is not None:
+                bar.close()
+
+        parts = []
+        for i in range(n_chunks):
+            if partial_dir:
+                parts.append(np.load(os.path.join(partial_dir, f"chunk_{i:06d}.npy")))
+            else:
+                parts.append(chunks[i])
+        embedding = np.concatenate(parts, axis=0) if parts else np.zeros((0, 0), dtype=np.float32)
+
+        # 以归一化float32落盘，检索时无需再按行归一化
+        embedding = normalize_rows(embedding)
+        if emb_path:
+            save_npy_atomic(emb_path, embedding)
+            save_npy_atomic(rowhash_path_for(emb_path), row_hashes(texts))
+            shutil.rmtree(partial_dir, ignore_errors=True)
+        return embedding
+
+    def update(self, texts: list, emb_path: str, block_rows: int = 65536) -> np.ndarray:
+        """增量更新emb_path：按逐行context哈希复用已有向量，只为新增/变化的行请求embedding，已删除的行随之丢弃。
+
+        已有存储缺少行哈希时：行数一致则视为与当前文本逐行对应并补写哈希，否则全量重建。
+        调用方需保证已有存储与当前provider一致（否则应删除后调用build）。
+        """
+        texts = [str(t) for t in texts]
+        new_hashes = row_hashes(texts)
+        hash_path = rowhash_path_for(emb_path)
+        if not os.path.exists(emb_path):
+            return self.build(texts, emb_path)
+        old = open_store(emb_path)
+        if os.path.exists(hash_path):
+            old_hashes = np.load(hash_path)
+        elif old.shape[0] == len(texts):
+            print(f"[Embedding] 为旧存储补写行哈希: {hash_path}")
+            save_npy_atomic(hash_path, new_hashes)
+            return old
+        else:
+            return self.build(texts, emb_path)
+        if old_hashes.shape[0] != old.shape[0]:
+            return self.build(texts, emb_path)
+        if np.array_equal(old_hashes, new_hashes):
+            return old
+
+        lookup = {h: i for i, h in enumerate(old_hashes.tolist())}
+        src = np.fromiter((lookup.get(h, -1) for h in new_hashes.tolist()), dtype=np.int64, count=len(texts))
+        missing = np.flatnonzero(src < 0)
+        print(f"[Embedding] 增量更新：复用 {len(texts) - len(missing)} 行，新增/变化 {len(missing)} 行，删除 {old.shape[0] - len(np.unique(src[src >= 0]))} 行")
+        # 新增行同样分块并发、可断点续传（写入 {emb_path}.delta.npy.partial）
+        delta_path = f"{emb_path}.delta.npy"
+        delta = self.build([texts[i] for i in missing], delta_path) if len(missing) else None
+        dim = old.shape[1] if old.shape[0] else delta.shape[1]
+
+        # 分块写入临时mmap后原子替换，避免在内存中拼出整个存储
+        tmp = f"{emb_path}.{os.getpid()}.tmp"
+        out = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float32, shape=(len(texts), dim))
+        for start in range(0, len(texts), block_rows):
+            rows = src[start:start + block_rows]
+            hit = rows >= 0
+            block = np.zeros((len(rows), dim), dtype=np.float32)
+            block[hit] = old[rows[hit]]
+            out[start:start + block_rows] = block
+        if delta is not None:
+            out[missing] = delta
+        out.flush()
+        del out, old
+        os.replace(tmp, emb_path)
+        save_npy_atomic(hash_path, new_hashes)
+        for path in (delta_path, rowhash_path_for(delta_path)):
+            if os.path.exists(path):
+                os.remove(path)
+        return open_store(emb_path)
+
+
+def builder_from_env(embed_fn, tag: str = "") -> EmbeddingBuilder:
+    """按环境变量 EMBEDDING_CHUNK_SIZE / EMBEDDING_MAX_WORKERS 构造"""
+    return EmbeddingBuilder(
+        embed_fn,
+        chunk_size=int(os.getenv("EMBEDDING_CHUNK_SIZE") or 256),
+        max_workers=int(os.getenv("EMBEDDING_MAX_WORKERS") or 4),
+        tag=tag
+    )
+
+
+if __name__ == "__main__":
+    from model.utils.proxy_call import OpenaiCall
+    from model.embedding_provider import PROVIDERS, make_provider, provider_name
+    from model.embedding_store import write_store_meta, read_store_meta
+    from model.embedding_manifest import EmbeddingManifest
+
+    parser = argparse.ArgumentParser(description="为地块CSV离线生成embedding集合（支持断点续传与增量更新）")
+    parser.add_argument("csv", help="地块数据CSV路径")
+    parser.add_argument("--out", default=None, help="输出npy路径，默认按数据集清单为该provider分配")
+    parser.add_argument("--chunk-size", type=int, default=256)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--provider", choices=PROVIDERS, default=None, help="默认读取 EMBEDDING_PROVIDER")
+    args = parser.parse_args()
+
+    csv_path = os.path.abspath(args.csv)
+    name = args.provider or provider_name()
+    manifest = EmbeddingManifest.load(csv_path)
+    out = os.path.abspath(args.out) if args.out else manifest.path_for(make_provider(name).describe(), os.path.splitext(csv_path)[0] + ".npy")
+    provider = make_provider(name, proxy=OpenaiCall() if name == "openai" else None, emb_path=out)
+    texts = build_context(read_site_frame(csv_path)).tolist()
+    provider.prepare(texts)
+    builder = EmbeddingBuilder(
+        provider.embed_documents,
+        chunk_size=args.chunk_size,
+        max_workers=args.workers,
+        tag=json.dumps(provider.describe(), sort_keys=True)
+    )
+    if os.path.exists(out) and provider.matches(read_store_meta(out)):
+        emb = builder.update(texts, out)
+    else:
+        emb = builder.build(texts, out)
+    write_store_meta(out, dict(provider.describe(), dim=int(emb.shape[1]), rows=int(emb.shape[0])))
+    manifest.register(out, read_store_meta(out))
+    manifest.save()
+    print(f"已写入 {out}: {emb.shape}")
@@ -0,0 +1,118 @@
+"""
+数据集embedding集合清单：x.manifest.json 列出同一数据集可用的多套embedding
+（provider、模型、维度、行数、校验值），各套存储并存，启动时按当前provider选择
+"""
+
+import os
+import re
+import json
+import time
+import hashlib
+import numpy as np
+
+from model.embedding_store import read_store_meta, rowhash_path_for
+
+MANIFEST_VERSION = 1
+# 用于匹配集合的provider描述字段（local的basis哈希由集合自身的基文件决定，不参与匹配）
+SET_KEYS = ("provider", "model", "version")
+
+
+class EmbeddingMismatchError(RuntimeError):
+    """查询向量与数据集embedding不属于同一集合（维度/provider不一致），需离线构建对应集合"""
+
+
+class EmbeddingsNotBuiltError(EmbeddingMismatchError):
+    """当前provider对应的embedding集合缺失或与数据行不一致；请求路径不生成，需离线构建或显式预加载"""
+
+
+def manifest_path_for(data_path: str) -> str:
+    """数据集对应的清单路径：data/x.csv -> data/x.manifest.json"""
+    return os.path.splitext(data_path)[0] + ".manifest.json"
+
+
+def set_slug(describe: dict) -> str:
+    """集合文件名片段，如 openai-text-embedding-ada-002-v1"""
+    raw = f"{describe.get('provider')}-{describe.get('model')}-v{describe.get('version')}"
+    return re.sub(r"[^0-9A-Za-z._-]+", "-", raw)
+
+
+def rows_checksum(emb_path: str) -> str:
+    """集合覆盖的数据行校验值（逐行context哈希的sha256）；缺少行哈希时为空串"""
+    path = rowhash_path_for(emb_path)
+    if not os.path.exists(path):
+        return ""
+    return hashlib.sha256(np.load(path).tobytes()).hexdigest()
+
+
+class EmbeddingManifest:
+    """单个数据集的embedding集合清单。
+
+    Args:
+        path (str): 清单文件路径。
+        sets (list, optional): 集合条目；file 为相对清单目录的文件名。
+    """
+
+    def __init__(self, path: str, sets: list = None):
+        self.path = path
+        self.sets = list(sets or [])
+
+    @classmethod
+    def load(cls, data_path: str, default_emb_path: str = None) -> "EmbeddingManifest":
+        """读取清单；不存在时若有同名 .npy（旧布局）则将其登记为一套集合"""
+        path = manifest_path_for(data_path)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return cls(path, json.load(f).get("sets"))
+        except (OSError, ValueError):
+            pass
+        manifest = cls(path)
+        default_emb_path = default_emb_path or os.path.splitext(data_path)[0] + ".npy"
+        if os.path.exists(default_emb_path):
+            manifest.register(default_emb_path, read_store_meta(default_emb_path))
+            manifest.save()
+        return manifest
+
+    def _dir(self) -> str:
+        return os.path.dirname(os.path.abspath(self.path))
+
+    def path_of(self, entry: dict) -> str:
+        return os.path.join(self._dir(), entry["file"])
+
+    def find(self, describe: dict) -> dict:
+        """按provider/模型/版本查找集合，找不到返回None"""
+        for entry in self.sets:
+            if all(entry.get(k) == describe.get(k) for k in SET_KEYS):
+                return entry
+        return None
+
+    def path_for(self, describe: dict, default_emb_path: str) -> str:
+        """集合存储路径：已登记的沿用；新集合优先占用同名 .npy，已被占用时为 x.<slug>.npy"""
+        entry = self.find(describe)
+        if entry is not None:
+            return self.path_of(entry)
+        taken = {os.path.abspath(self.path_of(e)) for e in self.sets}
+        if os.path.abspath(default_emb_path) not in taken and not os.path.exists(default_emb_path):
+            return default_emb_path
+        base = os.path.splitext(default_emb_path)[0]
+        return f"{base}.{set_slug(describe)}.npy"
+
+    def register(self, emb_path: str, meta: dict):
+        """登记/更新一套集合（维度、行数取自存储文件头，不读取数据）"""
+        shape = np.load(emb_path, mmap_mode='r').shape
+        entry = {k: v for k, v in (meta or {}).items() if k not in ("dim", "rows")}
+        entry.update({
+            "file": os.path.relpath(os.path.abspath(emb_path), self._dir()),
+            "dim": int(shape[1]) if len(shape) > 1 else 0,
+            "rows": int(shape[0]),
+            "checksum": rows_checksum(emb_path),
+            "updated_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        })
+        self.sets = [e for e in self.sets if e["file"] != entry["file"] and not all(e.get(k) == entry.get(k) for k in SET_KEYS)]
+        self.sets.append(entry)
+
+    def save(self):
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({"version": MANIFEST_VERSION, "sets": self.sets}, f, ensure_ascii=False, indent=2)
+            f.write("\n")
+        os.replace(tmp, self.path)
@@ -0,0 +1,206 @@
+"""
+embedding提供方：OpenAI接口或完全本地的哈希字符n-gram TF-IDF + SVD投影
+通过 EMBEDDING_PROVIDER=openai|local 选择；存储元数据（x.emb.json）记录生成它的provider
+"""
+
+import os
+import zlib
+import hashlib
+import numpy as np
+from collections import Counter
+from scipy import sparse
+from scipy.sparse.linalg import svds
+
+from model.lexical import char_ngrams
+from model.utils.proxy_call import parse_embedding_response
+from model.embedding_builder import EmbeddingConfigError
+
+PROVIDERS = ("openai", "local")
+
+
+class EmbeddingProvider:
+    """embedding提供方接口。
+
+    embed_queries 用于在线查询（可走缓存），embed_documents 用于批量构建存储。
+    describe() 的结果写入存储元数据，用于判断存储与当前provider是否一致。
+    """
+
+    name = ""
+    version = 1
+
+    def embed_queries(self, texts: list) -> np.ndarray:
+        raise NotImplementedError
+
+    def embed_documents(self, texts: list) -> np.ndarray:
+        return self.embed_queries(texts)
+
+    def prepare(self, texts: list):
+        """构建存储前调用（本地provider在此拟合基），默认无操作"""
+
+    def model(self) -> str:
+        return ""
+
+    def describe(self) -> dict:
+        return {"provider": self.name, "model": self.model(), "version": self.version}
+
+    def matches(self, meta: dict) -> bool:
+        """存储元数据是否由同一provider/模型/版本生成"""
+        if not meta:
+            return False
+        return all(meta.get(k) == v for k, v in self.describe().items())
+
+
+class OpenaiEmbeddingProvider(EmbeddingProvider):
+    """通过OpenaiCall请求embedding；查询走proxy.embed_texts的进程内/磁盘缓存"""
+
+    name = "openai"
+
+    def __init__(self, proxy=None):
+        self.proxy = proxy
+
+    def model(self) -> str:
+        return os.getenv("OPENAI_EMBEDDING_MODEL", "text-embedding-ada-002")
+
+    def _require_proxy(self):
+        if self.proxy is None:
+            raise EmbeddingConfigError("OpenAI embedding需要proxy，请传入OpenaiCall或改用 EMBEDDING_PROVIDER=local")
+
+    def embed_queries(self, texts: list) -> np.ndarray:
+        self._require_proxy()
+        if hasattr(self.proxy, "embed_texts"):
+            return self.proxy.embed_texts(list(texts))
+        return parse_embedding_response(self.proxy.embedding(input_data=list(texts)))
+
+    def embed_documents(self, texts: list) -> np.ndarray:
+        # 批量构建不写入查询缓存
+        self._require_proxy()
+        return parse_embedding_response(self.proxy.embedding(input_data=list(texts)))
+
+
+def _hash_ngram(gram: str) -> int:
+    # crc32在进程间稳定（内置hash带随机盐）
+    return zlib.crc32(gram.encode('utf-8'))
+
+
+class LocalNgramProvider(EmbeddingProvider):
+    """本地embedding：字符n-gram哈希特征 -> 次线性TF * IDF -> 截断SVD投影。
+
+    基（出现过的特征id、IDF与投影矩阵）由语料拟合一次，保存为 x.local_basis.npz；
+    查询时只需一次稀疏-稠密乘法，无网络请求。
+
+    Args:
+        basis_path (str): 基文件路径（为None时仅用于描述provider，不可embedding）。
+        dim (int): 输出维度（SVD分量数）。
+        n_values (tuple): 字符n-gram长度。
+    """
+
+    name = "local"
+
+    def __init__(self, basis_path: str, dim: int = 256, n_values: tuple = (1, 2, 3)):
+        self.basis_path = basis_path
+        self.dim = int(dim)
+        self.n_values = tuple(n_values)
+        self.features = None
+        self.idf = None
+        self.components = None
+        self._index = None
+        self._basis_hash = ""
+        if basis_path and os.path.exists(basis_path):
+            self.load()
+
+    def model(self) -> str:
+        return f"char{''.join(map(str, self.n_values))}-svd{self.dim}"
+
+    def describe(self) -> dict:
+        # 基重新拟合后旧存储/断点分块不可复用
+        return dict(super().describe(), basis=self._basis_hash)
+
+    def _set_basis(self, features, idf, components):
+        self.features, self.idf, self.components = features, idf, components
+        self.dim = components.shape[1]
+        self._index = {int(h): i for i, h in enumerate(features)}
+        h = hashlib.sha1()
+        for arr in (features, idf, components):
+            h.update(np.ascontiguousarray(arr).tobytes())
+        self._basis_hash = h.hexdigest()
+
+    def _tf(self, texts: list, index: dict = None):
+        """返回 (行, 哈希特征, 次线性TF)；给定index时只保留其中的特征并映射为列号"""
+        rows, cols, vals = [], [], []
+        for r, text in enumerate(texts):
+            counts = Counter(_hash_ngram(g) for g in char_ngrams(text, self.n_values))
+            for h, tf in counts.items():
+                if index is not None:
+                    h = index.get(h)
+                    if h is None:
+                        continue
+                rows.append(r)
+                cols.append(h)
+                vals.append(1.0 + np.log(tf))
+        return np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64), np.asarray(vals, dtype=np.float32)
+
+    def fit(self, texts: list):
+        rows, hashes, vals = self._tf(texts)
+        features, cols = np.unique(hashes, return_inverse=True)
+        n_docs, n_feat = len(texts), len(features)
+        tf = sparse.csr_matrix((vals, (rows, cols)), shape=(n_docs, n_feat))
+        df = np.bincount(cols, minlength=n_feat).astype(np.float32)
+        idf = (np.log((1 + n_docs) / (1 + df)) + 1).astype(np.float32)
+        x = tf.multiply(idf[None, :]).tocsr()
+        k = max(1, min(self.dim, min(x.shape) - 1))
+        if k < min(x.shape):
+            _, s, vt = svds(x.astype(np.float64), k=k, random_state=0)
+            order = np.argsort(s)[::-1]
+            components = vt[order].T
+        else:
+            # 语料极小时退化为完整SVD
+            _, _, vt = np.linalg.svd(x.toarray(), full_matrices=False)
+            components = vt[:k].T
+        basis = np.zeros((n_feat, self.dim), dtype=np.float32)
+        basis[:, :components.shape[1]] = components
+        self._set_basis(features, idf, basis)
+        self.save()
+
+    def save(self):
+        tmp = f"{self.basis_path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp, features=self.features, idf=self.idf, components=self.components,
+                 n_values=np.asarray(self.n_values))
+        os.replace(tmp, self.basis_path)
+
+    def load(self):
+        with np.load(self.basis_path) as z:
+            self.n_values = tuple(int(n) for n in z["n_values"])
+            self._set_basis(z["features"], z["idf"], z["components"])
+
+    def prepare(self, texts: list):
+        # 基已存在时沿用（保持已有向量可比）；需按新语料重新拟合时删除基文件
+        if self.components is None:
+            self.fit(texts)
+
+    def embed_queries(self, texts: list) -> np.ndarray:
+        if self.components is None:
+            raise RuntimeError(f"本地embedding基不存在: {self.basis_path}，请先构建数据集embedding")
+        rows, cols, vals = self._tf([str(t) for t in texts], self._index)
+        x = sparse.csr_matrix((vals * self.idf[cols], (rows, cols)), shape=(len(texts), len(self.features)))
+        return np.asarray(x @ self.components, dtype=np.float32)
+
+
+def basis_path_for(emb_path: str) -> str:
+    """本地provider的基文件：data/x.npy -> data/x.local_basis.npz"""
+    return os.path.splitext(emb_path)[0] + ".local_basis.npz"
+
+
+def provider_name() -> str:
+    name = (os.getenv("EMBEDDING_PROVIDER") or "openai").lower()
+    if name not in PROVIDERS:
+        raise ValueError(f"未知的 EMBEDDING_PROVIDER: {name}（可选 {', '.join(PROVIDERS)}）")
+    return name
+
+
+def make_provider(name: str = None, proxy=None, emb_path: str = None) -> EmbeddingProvider:
+    """按名称（缺省读取 EMBEDDING_PROVIDER）构造provider；local的基文件随emb_path所在集合"""
+    name = name or provider_name()
+    if name == "local":
+        basis_path = basis_path_for(emb_path) if emb_path else None
+        return LocalNgramProvider(basis_path, dim=int(os.getenv("LOCAL_EMBEDDING_DIM") or 256))
+    return OpenaiEmbeddingProvider(proxy)
@@ -0,0 +1,101 @@
+"""
+embedding存储格式：L2归一化的float32矩阵，np.load(mmap_mode='r')只读映射
+多个worker进程共享同一份页缓存，余弦相似度退化为一次矩阵-向量乘
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+
+# 归一化校验的容差与抽样行数
+NORM_TOLERANCE = 1e-3
+NORM_SAMPLE_ROWS = 1024
+
+
+def save_npy_atomic(path: str, array: np.ndarray):
+    """先写临时文件再替换，读者不会看到写了一半的npy"""
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp, path)
+
+
+def normalize_rows(embedding: np.ndarray) -> np.ndarray:
+    """按行L2归一化并转为float32（零向量保持为零）"""
+    emb = np.asarray(embedding, dtype=np.float32)
+    if emb.size == 0:
+        return emb
+    norms = np.linalg.norm(emb, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (emb / norms).astype(np.float32, copy=False)
+
+
+def is_normalized(embedding: np.ndarray) -> bool:
+    """float32且抽样行的范数均约为1（或为零向量）"""
+    if embedding.dtype != np.float32 or embedding.ndim != 2:
+        return False
+    if embedding.shape[0] == 0:
+        return True
+    step = max(1, embedding.shape[0] // NORM_SAMPLE_ROWS)
+    norms = np.linalg.norm(np.asarray(embedding[::step], dtype=np.float64), axis=1)
+    return bool(np.all((np.abs(norms - 1.0) < NORM_TOLERANCE) | (norms == 0)))
+
+
+def open_store(emb_path: str) -> np.ndarray:
+    """以只读内存映射打开embedding存储；旧格式（float64/未归一化）就地迁移一次。"""
+    embedding = np.load(emb_path, mmap_mode='r')
+    if is_normalized(embedding):
+        return embedding
+    print(f"[Embedding] 迁移为归一化float32存储: {emb_path}")
+    normalized = normalize_rows(np.asarray(embedding))
+    del embedding
+    save_npy_atomic(emb_path, normalized)
+    return np.load(emb_path, mmap_mode='r')
+
+
+# 无元数据的旧存储视为由OpenAI默认模型生成
+LEGACY_STORE_META = {"provider": "openai", "model": "text-embedding-ada-002", "version": 1}
+
+
+def store_meta_path(emb_path: str) -> str:
+    """embedding存储的元数据路径：data/x.npy -> data/x.emb.json"""
+    return os.path.splitext(emb_path)[0] + ".emb.json"
+
+
+def read_store_meta(emb_path: str) -> dict:
+    """读取存储元数据（生成该存储的provider、维度、行数）；缺失时返回None，存储存在但无元数据时返回LEGACY_STORE_META"""
+    if not os.path.exists(store_meta_path(emb_path)):
+        return dict(LEGACY_STORE_META) if os.path.exists(emb_path) else None
+    try:
+        with open(store_meta_path(emb_path), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_store_meta(emb_path: str, meta: dict):
+    path = store_meta_path(emb_path)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+        f.write("\n")
+    os.replace(tmp, path)
+
+
+def rowhash_path_for(emb_path: str) -> str:
+    """逐行context哈希：data/x.npy -> data/x.rowhash.npy，第i项对应存储第i行"""
+    return os.path.splitext(emb_path)[0] + ".rowhash.npy"
+
+
+def row_hashes(texts: list) -> np.ndarray:
+    """每行文本的16字节blake2b摘要"""
+    return np.array([hashlib.blake2b(str(t).encode('utf-8'), digest_size=16).digest() for t in texts], dtype='S16')
+
+
+def rows_current(emb_path: str, texts: list) -> bool:
+    """存储的逐行哈希是否与当前文本完全一致（缺少哈希文件时返回False）"""
+    path = rowhash_path_for(emb_path)
+    if not os.path.exists(path):
+        return False
+    return bool(np.array_equal(np.load(path), row_hashes(texts)))
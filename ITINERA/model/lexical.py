@@ -0,0 +1,91 @@
+"""
+本地词法检索：对地块文本做字符n-gram切分（适合中文），构建BM25倒排矩阵
+字面匹配的需求（如“工业用地”“花都区”）无需调用embedding接口即可打分
+"""
+
+import re
+import numpy as np
+import pandas as pd
+from collections import Counter
+from scipy import sparse
+
+# 参与词法索引的文本列（存在即拼接）
+LEXICAL_COLUMNS = ['context', '宗地坐落', '土地用途']
+
+_SPLIT_RE = re.compile(r"[\s,，。;；:：、/（）()\[\]【】\"'“”‘’!！?？·\-_]+")
+
+
+def char_ngrams(text: str, n_values: tuple = (1, 2)) -> list:
+    """按标点/空白分段后取字符n-gram；英文与数字转小写"""
+    grams = []
+    for seg in _SPLIT_RE.split(str(text).lower()):
+        if not seg:
+            continue
+        for n in n_values:
+            grams.extend(seg[i:i + n] for i in range(len(seg) - n + 1))
+    return grams
+
+
+class LexicalIndex:
+    """字符n-gram BM25索引。
+
+    文档-词项权重在构建时按BM25公式预先算好，查询时只取查询n-gram对应的列求和。
+
+    Args:
+        texts (list): 每行一个文档文本。
+        k1 (float): BM25词频饱和参数。
+        b (float): BM25文档长度归一化参数。
+        n_values (tuple): 使用的n-gram长度。
+    """
+
+    def __init__(self, texts: list, k1: float = 1.5, b: float = 0.75, n_values: tuple = (1, 2)):
+        self.n_values = n_values
+        self.vocab = {}
+        rows, cols, tfs = [], [], []
+        doc_len = np.zeros(len(texts), dtype=np.float32)
+        for r, text in enumerate(texts):
+            counts = Counter(char_ngrams(text, n_values))
+            doc_len[r] = sum(counts.values())
+            for term, tf in counts.items():
+                rows.append(r)
+                cols.append(self.vocab.setdefault(term, len(self.vocab)))
+                tfs.append(tf)
+        n_docs = len(texts)
+        tf = sparse.csc_matrix(
+            (np.asarray(tfs, dtype=np.float32), (np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64))),
+            shape=(n_docs, len(self.vocab))
+        )
+        df = np.diff(tf.indptr).astype(np.float32)
+        idf = np.log1p((n_docs - df + 0.5) / (df + 0.5)).astype(np.float32)
+        avgdl = float(doc_len.mean()) if n_docs else 1.0
+        # 逐非零元素计算BM25权重
+        tf = tf.tocoo()
+        norm = k1 * (1 - b + b * doc_len[tf.row] / max(avgdl, 1e-6))
+        weights = idf[tf.col] * tf.data * (k1 + 1) / (tf.data + norm)
+        self.weights = sparse.csc_matrix((weights.astype(np.float32), (tf.row, tf.col)), shape=tf.shape)
+        self.n_docs = n_docs
+
+    @classmethod
+    def from_frame(cls, site_data: pd.DataFrame, **kwargs) -> "LexicalIndex":
+        cols = [c for c in LEXICAL_COLUMNS if c in site_data.columns]
+        if cols:
+            # 空值记为空串（pandas 3 下 astype(str) 保留NaN，join会报错）；先转object以兼容Categorical列
+            texts = site_data[cols].astype(object).fillna('').astype(str).agg(' '.join, axis=1).tolist()
+        else:
+            texts = site_data.index.astype(str).tolist()
+        return cls(texts, **kwargs)
+
+    def score(self, query: str) -> np.ndarray:
+        """返回 (n_docs,) BM25分数；查询n-gram按出现次数加权"""
+        counts = Counter(t for t in char_ngrams(query, self.n_values) if t in self.vocab)
+        if not counts:
+            return np.zeros(self.n_docs, dtype=np.float32)
+        term_ids = np.fromiter((self.vocab[t] for t in counts), dtype=np.int64, count=len(counts))
+        qtf = np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+        return np.asarray(self.weights[:, term_ids] @ qtf, dtype=np.float32).ravel()
+
+    def score_normalized(self, query: str) -> np.ndarray:
+        """按最大值缩放到 [0, 1] 的BM25分数，便于与余弦相似度融合"""
+        scores = self.score(query)
+        top = float(scores.max()) if scores.size else 0.0
+        return scores / top if top > 0 else scores
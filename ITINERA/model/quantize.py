@@ -0,0 +1,153 @@
+"""
+embedding的int8标量量化：每行一个缩放系数，codes以只读mmap加载
+粗排直接在int8 codes上分块计算，再从float32存储中读取少量候选行精确重排
+"""
+
+import os
+import argparse
+import numpy as np
+
+from model.embedding_store import open_store
+from model.search import top_k_indices
+
+# 精确重排的候选数下限
+DEFAULT_RERANK = 256
+# 分块打分时每块行数，控制int8->float32转换的临时内存
+SCORE_BLOCK_ROWS = 32768
+
+
+def codes_path_for(emb_path: str) -> str:
+    """embedding文件对应的量化codes路径：data/x.npy -> data/x.int8.npy"""
+    return os.path.splitext(emb_path)[0] + ".int8.npy"
+
+
+def meta_path_for(emb_path: str) -> str:
+    """缩放系数与全库均值：data/x.npy -> data/x.int8.meta.npz"""
+    return os.path.splitext(emb_path)[0] + ".int8.meta.npz"
+
+
+def quantize_rows(block: np.ndarray):
+    """按行对称量化：x ≈ codes * scale，scale = max|x| / 127"""
+    block = np.asarray(block, dtype=np.float32)
+    scales = np.abs(block).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.clip(np.rint(block / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+class Int8Store:
+    """int8量化的embedding存储。
+
+    Args:
+        codes (np.ndarray): (n, emb_dim) int8 codes（通常为只读mmap）。
+        scales (np.ndarray): (n,) 每行缩放系数。
+        mean_vector (np.ndarray): 全库float embedding均值，用于负向相似度的全库均值。
+        rerank (int): 精确重排的候选数。
+    """
+
+    def __init__(self, codes: np.ndarray, scales: np.ndarray, mean_vector: np.ndarray, rerank: int = DEFAULT_RERANK):
+        self.codes = codes
+        self.scales = scales.astype(np.float32, copy=False)
+        self.mean_vector = mean_vector.astype(np.float32, copy=False)
+        self.rerank = max(1, int(rerank))
+
+    @property
+    def shape(self) -> tuple:
+        return self.codes.shape
+
+    @classmethod
+    def build(cls, embedding: np.ndarray, emb_path: str, block_rows: int = 65536) -> "Int8Store":
+        """从float32存储分块量化并落盘（codes + meta），返回mmap加载的存储"""
+        n, dim = embedding.shape
+        codes = np.lib.format.open_memmap(f"{codes_path_for(emb_path)}.{os.getpid()}.tmp", mode='w+', dtype=np.int8, shape=(n, dim))
+        scales = np.empty(n, dtype=np.float32)
+        mean_vector = np.zeros(dim, dtype=np.float64)
+        for start in range(0, n, block_rows):
+            block = np.asarray(embedding[start:start + block_rows], dtype=np.float32)
+            codes[start:start + block_rows], scales[start:start + block_rows] = quantize_rows(block)
+            mean_vector += block.sum(axis=0, dtype=np.float64)
+        if n:
+            mean_vector /= n
+        codes.flush()
+        tmp_codes = codes.filename
+        del codes
+        os.replace(tmp_codes, codes_path_for(emb_path))
+
+        meta_tmp = f"{meta_path_for(emb_path)}.{os.getpid()}.tmp.npz"
+        np.savez(meta_tmp, scales=scales, mean_vector=mean_vector.astype(np.float32))
+        os.replace(meta_tmp, meta_path_for(emb_path))
+        return cls.load(emb_path)
+
+    @classmethod
+    def load(cls, emb_path: str, rerank: int = None) -> "Int8Store":
+        codes = np.load(codes_path_for(emb_path), mmap_mode='r')
+        with np.load(meta_path_for(emb_path)) as z:
+            scales, mean_vector = z["scales"], z["mean_vector"]
+        return cls(codes, scales, mean_vector, rerank=rerank or int(os.getenv("QUANT_RERANK") or DEFAULT_RERANK))
+
+    def approx_scores(self, queries: np.ndarray) -> np.ndarray:
+        """(n_rows, n_queries) 近似余弦相似度，分块在int8 codes上计算"""
+        queries = np.asarray(queries, dtype=np.float32)
+        n = self.codes.shape[0]
+        out = np.empty((n, queries.shape[0]), dtype=np.float32)
+        for start in range(0, n, SCORE_BLOCK_ROWS):
+            block = np.asarray(self.codes[start:start + SCORE_BLOCK_ROWS], dtype=np.float32)
+            out[start:start + SCORE_BLOCK_ROWS] = (block @ queries.T) * self.scales[start:start + SCORE_BLOCK_ROWS, None]
+        return out
+
+    def search(self, embedding: np.ndarray, approx: np.ndarray, pos: np.ndarray, neg: np.ndarray = None, top_k: int = 10, allowed: np.ndarray = None, mean_vector: np.ndarray = None):
+        """基于近似分数取候选，再用float32存储精确重排：pos - neg + mean(neg)
+
+        Args:
+            embedding (np.ndarray): float32归一化存储（mmap，只读取候选行）。
+            approx (np.ndarray): (n_rows,) 该需求在codes上的近似组合分数。
+            pos (np.ndarray): (emb_dim,) 归一化正向查询向量。
+            neg (np.ndarray, optional): (emb_dim,) 归一化负向查询向量。
+            top_k (int): 返回条数。
+            allowed (np.ndarray, optional): (n_rows,) bool，预过滤允许的行。
+            mean_vector (np.ndarray, optional): 负向平移所用的embedding均值；缺省为全库均值，预过滤时传入允许行的均值。
+
+        Returns:
+            tuple: (行号, 分数)，按分数降序。
+        """
+        if allowed is not None:
+            approx = np.where(allowed, approx, -np.inf)
+        shortlist = np.sort(top_k_indices(approx, max(self.rerank, top_k)))
+        if allowed is not None:
+            shortlist = shortlist[allowed[shortlist]]
+        vectors = np.asarray(embedding[shortlist], dtype=np.float32)
+        scores = vectors @ pos
+        if neg is not None:
+            mean = self.mean_vector if mean_vector is None else mean_vector
+            scores = scores - vectors @ neg + float(mean @ neg)
+        order = top_k_indices(scores, top_k)
+        return shortlist[order], scores[order]
+
+
+def load_quantized(emb_path: str, embedding: np.ndarray, build: bool = False):
+    """加载emb_path旁的int8存储；build=True时缺失或过期则重新生成；不可用时返回None"""
+    codes_path, meta_path = codes_path_for(emb_path), meta_path_for(emb_path)
+    if embedding is None:
+        return None
+    store = None
+    if os.path.exists(codes_path) and os.path.exists(meta_path):
+        try:
+            store = Int8Store.load(emb_path)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"[Quant] int8存储读取失败: {e}")
+        # embedding文件比量化存储新或形状不一致时视为过期
+        if store is not None and (store.shape != embedding.shape or os.path.getmtime(codes_path) < os.path.getmtime(emb_path)):
+            store = None
+    if store is None and build:
+        print(f"[Quant] 生成int8量化存储: {codes_path}")
+        store = Int8Store.build(embedding, emb_path)
+    return store
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="从embedding .npy 生成int8量化存储")
+    parser.add_argument("emb", help="embedding npy路径")
+    args = parser.parse_args()
+
+    quant = Int8Store.build(open_store(args.emb), args.emb)
+    print(f"已写入 {codes_path_for(args.emb)}: {quant.shape}")
@@ -0,0 +1,407 @@
+"""
+数据集注册表：进程内共享地块数据、embedding与检索/空间模块
+同一数据集只加载一次，按文件路径与修改时间判定是否需要重新加载；
+多城市按需加载，超出内存预算时按最近最少使用淘汰
+"""
+
+import os
+import re
+import json
+import time
+import threading
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+
+from model.search import SearchEngine
+from model.embedding_store import open_store, read_store_meta, store_meta_path, rows_current, rowhash_path_for
+from model.embedding_builder import build_context
+from model.embedding_manifest import EmbeddingManifest, EmbeddingsNotBuiltError, SET_KEYS, manifest_path_for, set_slug
+from model.embedding_provider import make_provider, provider_name
+from model.ann import load_index, index_path_for
+from model.quantize import load_quantized, codes_path_for
+from model.lexical import LexicalIndex
+from model.rules import ColumnCache, TEXT_INDEX_COLUMNS
+from model.columnar import load_site_frame, schema_path_for
+from model.stats import load_stats
+from model.spatial import SpatialHandler
+from model.utils.metrics import METRICS
+
+DATA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "data"))
+# 不符合 {city}_{type}.csv 命名的城市数据集；CITY_DATASETS（JSON，相对路径基于model/data）可覆盖/追加
+DEFAULT_CITY_DATASETS = {"guangzhou": "land_transactions_with_coordinates_metrics.csv"}
+
+# 请求可选的数据集类型与城市名格式；城市名只用于查表与拼接 model/data 下的文件名，不接受路径
+DATASET_TYPES = ("zh", "en")
+CITY_NAME_RE = re.compile(r"^[a-z0-9_-]+$")
+
+DATASET_EVENTS = METRICS.counter("itinera_dataset_events_total", "Dataset registry loads and LRU evictions.", ("event",))
+
+
+class UnknownCityError(ValueError):
+    """请求的城市没有对应的数据集"""
+
+
+def city_datasets() -> dict:
+    """城市 -> CSV路径（绝对路径）映射：内置默认 + 环境变量 CITY_DATASETS"""
+    mapping = dict(DEFAULT_CITY_DATASETS)
+    raw = os.getenv("CITY_DATASETS")
+    if raw:
+        try:
+            mapping.update(json.loads(raw))
+        except ValueError as e:
+            print(f"[Registry] CITY_DATASETS 解析失败: {e}")
+    return {str(c).strip().lower(): p if os.path.isabs(p) else os.path.join(DATA_DIR, p) for c, p in mapping.items()}
+
+
+def _in_data_dir(path: str) -> bool:
+    real = os.path.realpath(path)
+    return os.path.commonpath([real, os.path.realpath(DATA_DIR)]) == os.path.realpath(DATA_DIR)
+
+
+def available_cities(type: str = "zh") -> list:
+    """有数据文件的城市：映射中的城市 + model/data 下的 {city}_{type}.csv"""
+    cities = {c for c, p in city_datasets().items() if os.path.exists(p)}
+    if type not in DATASET_TYPES:
+        return sorted(cities)
+    suffix = f"_{type}.csv"
+    try:
+        cities.update(f[:-len(suffix)].lower() for f in os.listdir(DATA_DIR) if f.endswith(suffix))
+    except OSError:
+        pass
+    return sorted(c for c in cities if CITY_NAME_RE.match(c))
+
+
+def resolve_city_dataset(city: str, type: str = "zh") -> tuple:
+    """城市名 -> (CSV路径, 默认embedding路径)；优先映射，其次 model/data/{city}_{type}.csv/.npy
+
+    城市名须为 available_cities(type) 之一，类型须在 DATASET_TYPES 中；按命名规则拼出的路径解析后必须位于 model/data 内
+    （CITY_DATASETS 中配置的路径属于部署配置，按原样使用）。
+    """
+    if type not in DATASET_TYPES:
+        raise UnknownCityError(f"不支持的数据集类型: {type}（可选 {', '.join(DATASET_TYPES)}）")
+    key = (city or "").strip().lower()
+    if not CITY_NAME_RE.match(key) or key not in available_cities(type):
+        raise UnknownCityError(f"未找到城市数据集: {city}（可选 {', '.join(available_cities(type)) or '无'}）")
+    data_path = city_datasets().get(key)
+    if data_path is None:
+        data_path = os.path.join(DATA_DIR, f"{key}_{type}.csv")
+        if not _in_data_dir(data_path):
+            raise UnknownCityError(f"城市数据集路径不在数据目录内: {city}")
+    if not os.path.exists(data_path):
+        raise UnknownCityError(f"未找到城市数据集: {city}（可选 {', '.join(available_cities(type)) or '无'}）")
+    return data_path, os.path.splitext(data_path)[0] + ".npy"
+
+
+def memory_budget_bytes() -> int:
+    """DATASET_MEMORY_MB：已加载数据集的内存预算，0或未设置表示不限"""
+    try:
+        return int(float(os.getenv("DATASET_MEMORY_MB") or 0) * 1024 * 1024)
+    except ValueError:
+        return 0
+
+
+def prepare_site_data(site_data: pd.DataFrame) -> pd.DataFrame:
+    """标准化地块数据列：经纬度、name/address/desc/context、id与平面坐标x/y。"""
+    # 标准化经纬度列
+    if 'lon' not in site_data.columns and '经度' in site_data.columns:
+        site_data = site_data.rename(columns={'经度': 'lon'})
+    if 'lat' not in site_data.columns and '纬度' in site_data.columns:
+        site_data = site_data.rename(columns={'纬度': 'lat'})
+    # 标准化名称/地址/用途/面积/价格
+    if 'name' not in site_data.columns:
+        if '宗地坐落' in site_data.columns:
+            site_data['name'] = site_data['宗地坐落'].astype(str)
+        else:
+            site_data['name'] = site_data.index.astype(str)
+    if 'address' not in site_data.columns:
+        if '宗地坐落' in site_data.columns:
+            site_data['address'] = site_data['宗地坐落'].astype(str)
+        else:
+            site_data['address'] = site_data['name'].astype(str)
+    # 生成desc/context（当源数据没有时）
+    if 'desc' not in site_data.columns:
+        usage = (site_data['土地用途'].astype(str) if '土地用途' in site_data.columns else pd.Series([''] * len(site_data)))
+        area = (site_data['宗地面积(平方米)'].astype(str) if '宗地面积(平方米)' in site_data.columns else pd.Series([''] * len(site_data)))
+        price = (site_data['挂牌起始价(万元)'].astype(str) if '挂牌起始价(万元)' in site_data.columns else pd.Series([''] * len(site_data)))
+        site_data['desc'] = (
+            ("用途:" + usage + "，面积:" + area + "㎡，起始价:" + price + "万元").str.strip()
+        )
+    if 'context' not in site_data.columns:
+        site_data['context'] = (
+            site_data['name'].astype(str) + "，地址是" + site_data['address'].astype(str) + "，" + site_data['desc'].astype(str)
+        )
+    # 填充ID
+    if 'id' not in site_data.columns:
+        site_data['id'] = site_data.index.astype(int)
+
+    # 可选：生成平面坐标x/y（仅当后续启用空间优化时使用）
+    if 'x' not in site_data.columns or 'y' not in site_data.columns:
+        try:
+            # 简化的近似换算（米）：
+            # x ~ lon * 111320 * cos(lat)
+            # y ~ lat * 110540
+            rad = np.deg2rad(site_data['lat'].astype(float))
+            site_data['x'] = site_data['lon'].astype(float) * 111320.0 * np.cos(rad)
+            site_data['y'] = site_data['lat'].astype(float) * 110540.0
+        except Exception:
+            pass
+
+    return site_data.reset_index(drop=True)
+
+
+def file_signature(*paths) -> tuple:
+    """返回文件签名 (路径, mtime_ns, size)，文件不存在时记为None。"""
+    sig = []
+    for p in paths:
+        try:
+            st = os.stat(p)
+            sig.append((p, st.st_mtime_ns, st.st_size))
+        except OSError:
+            sig.append((p, None, None))
+    return tuple(sig)
+
+
+class DatasetBundle:
+    """一次加载完成的数据集快照；加载后视为只读，在多个请求之间共享。"""
+
+    def __init__(self, data_path: str, emb_path: str, site_data: pd.DataFrame, embedding: np.ndarray, signature: tuple, ann_index=None, quantized=None, provider=None, stats=None):
+        self.data_path = data_path
+        self.emb_path = emb_path
+        self.site_data = site_data
+        self.embedding = embedding
+        self.ann_index = ann_index
+        self.quantized = quantized
+        # 本地provider（含拟合好的基）随数据集共享；OpenAI provider按请求的proxy构造
+        self.provider = provider
+        self.signature = signature
+        self.loaded_at = time.time()
+        # 数值列统计（最小/最大值、分位数、直方图），评分归一与规则阈值直接读取
+        self.stats = stats
+        # 词法索引随数据集构建一次，供hybrid/lexical检索与embedding失败时回退
+        self.lexical = LexicalIndex.from_frame(site_data)
+        # 结构化规则使用的类型化列与规则计划缓存；常用文本列的n-gram倒排索引随加载预建
+        self.column_cache = ColumnCache(site_data, stats=stats)
+        self.column_cache.build_text_indexes(TEXT_INDEX_COLUMNS)
+
+        # 创建索引映射
+        row_idx = self.site_data.index.to_numpy()
+        site_id = self.site_data["id"].to_numpy()
+        self.r2i = {key: value for key, value in zip(row_idx, site_id)}
+        self.i2r = {value: key for key, value in zip(row_idx, site_id)}
+
+        self._spatial_handlers = {}
+        self._lock = threading.Lock()
+        self.nbytes = self._estimate_nbytes()
+
+    def _estimate_nbytes(self) -> int:
+        """估算快照占用的内存（mmap的embedding/codes按映射大小计，常驻时占用页缓存）"""
+        total = int(self.site_data.memory_usage(index=True, deep=True).sum())
+        arrays = [self.embedding, self.lexical.weights.data, self.lexical.weights.indices, self.lexical.weights.indptr]
+        if self.ann_index is not None:
+            arrays += [self.ann_index.centroids, self.ann_index.order]
+        if self.quantized is not None:
+            arrays += [self.quantized.codes, self.quantized.scales]
+        for arr in arrays:
+            total += int(getattr(arr, "nbytes", 0))
+        # 加载时预建的文本列编码与n-gram倒排索引
+        total += self.column_cache.nbytes()
+        return total
+
+    def search_engine(self, proxy=None, mode: str = None) -> SearchEngine:
+        """返回共享embedding矩阵的检索引擎（查询embedding走调用方的proxy）。"""
+        provider = self.provider if self.provider is not None and self.provider.name == "local" else make_provider("openai", proxy=proxy)
+        return SearchEngine(
+            embedding=self.embedding,
+            emb_path=self.emb_path,
+            file_path=self.data_path,
+            proxy=proxy,
+            normalized=True,
+            ann_index=self.ann_index,
+            quantized=self.quantized,
+            lexical=self.lexical,
+            mode=mode,
+            provider=provider
+        )
+
+    def spatial_handler(self, min_clusters: int, min_pois: int, citywalk: bool = False, citywalk_thresh: int = 5000) -> SpatialHandler:
+        """按参数缓存SpatialHandler实例（其只读访问site_data）。"""
+        key = (int(min_clusters), int(min_pois), bool(citywalk), citywalk_thresh)
+        with self._lock:
+            handler = self._spatial_handlers.get(key)
+            if handler is None:
+                handler = SpatialHandler(
+                    data=self.site_data,
+                    min_clusters=min_clusters,
+                    min_pois=min_pois,
+                    citywalk=citywalk,
+                    citywalk_thresh=citywalk_thresh
+                )
+                self._spatial_handlers[key] = handler
+            return handler
+
+
+class DatasetRegistry:
+    """进程级数据集注册表。
+
+    以数据集绝对路径为键缓存DatasetBundle；每次获取时比对当前provider选择的集合键，以及CSV、embedding清单、所选集合及其索引文件的修改时间，
+    文件变化后在该路径的锁内重新加载，完成后整体替换，正在使用旧快照的请求不受影响。
+    已加载快照按访问顺序排列，总占用超过内存预算时从最久未使用的开始淘汰（被淘汰的快照在进行中的请求结束后释放）。
+
+    Args:
+        memory_budget (int, optional): 内存预算（字节），缺省读取 DATASET_MEMORY_MB；0表示不限。
+    """
+
+    def __init__(self, memory_budget: int = None):
+        self._bundles = OrderedDict()
+        self._lock = threading.Lock()
+        self._path_locks = {}
+        self.memory_budget = memory_budget
+
+    def _path_lock(self, key: str) -> threading.Lock:
+        with self._lock:
+            lock = self._path_locks.get(key)
+            if lock is None:
+                lock = threading.Lock()
+                self._path_locks[key] = lock
+            return lock
+
+    def get(self, data_path: str, emb_path: str = None, proxy=None, build: bool = False) -> DatasetBundle:
+        """获取数据集快照；未加载或文件已变化时(重新)加载。
+
+        Args:
+            data_path (str): 地块CSV路径。
+            emb_path (str, optional): 默认embedding集合路径，缺省为同名 .npy；实际使用的集合由清单按当前provider选择。
+            proxy (optional): 仅在需要生成embedding时使用。
+            build (bool): embedding集合（及 EMBEDDING_STORAGE=int8 时的量化codes）缺失或过期时是否就地生成；
+                请求路径保持False（集合缺失抛出 EmbeddingsNotBuiltError，codes缺失退回float检索），仅离线构建或启动预加载时显式开启。
+        """
+        data_path = os.path.abspath(data_path)
+        if not emb_path:
+            emb_path = os.path.splitext(data_path)[0] + ".npy"
+        emb_path = os.path.abspath(emb_path)
+
+        bundle = self._touch(data_path)
+        if bundle is not None and self._is_current(bundle):
+            return bundle
+
+        with self._path_lock(data_path):
+            # 等锁期间可能已被其他线程加载
+            bundle = self._touch(data_path)
+            if bundle is not None and self._is_current(bundle):
+                return bundle
+            bundle = self._load(data_path, emb_path, proxy, build=build)
+            DATASET_EVENTS.inc(event="load")
+            with self._lock:
+                self._bundles[data_path] = bundle
+                self._bundles.move_to_end(data_path)
+                self._evict(keep=data_path)
+            return bundle
+
+    def get_city(self, city: str, type: str = "zh", proxy=None, build: bool = False) -> DatasetBundle:
+        """按城市获取数据集快照（首次请求时加载），路径解析见 resolve_city_dataset"""
+        data_path, emb_path = resolve_city_dataset(city, type)
+        return self.get(data_path, emb_path=emb_path, proxy=proxy, build=build)
+
+    def _touch(self, key: str):
+        # 命中即标记为最近使用
+        with self._lock:
+            bundle = self._bundles.get(key)
+            if bundle is not None:
+                self._bundles.move_to_end(key)
+            return bundle
+
+    def _evict(self, keep: str):
+        """（持有self._lock时调用）超出预算时淘汰最久未使用的快照，刚加载的keep不淘汰"""
+        budget = self.memory_budget if self.memory_budget is not None else memory_budget_bytes()
+        if budget <= 0:
+            return
+        total = sum(b.nbytes for b in self._bundles.values())
+        for key in list(self._bundles):
+            if total <= budget:
+                break
+            if key == keep:
+                continue
+            evicted = self._bundles.pop(key)
+            total -= evicted.nbytes
+            DATASET_EVENTS.inc(event="evict")
+            print(f"[Registry] 内存超出预算，淘汰数据集: {key} ({evicted.nbytes / 1048576:.1f}MB)")
+
+    def loaded(self) -> list:
+        """已加载的数据集（按最近使用从旧到新）：[(路径, 估算字节数)]"""
+        with self._lock:
+            return [(key, b.nbytes) for key, b in self._bundles.items()]
+
+    def _is_current(self, bundle: DatasetBundle) -> bool:
+        # 按快照实际使用的embedding集合比对文件签名；清单变化或切换provider后重新选择集合
+        return bundle.signature == self._signature(bundle.data_path, bundle.emb_path)
+
+    @staticmethod
+    def _signature_paths(data_path: str, emb_path: str) -> tuple:
+        return (data_path, schema_path_for(data_path), manifest_path_for(data_path), emb_path, store_meta_path(emb_path),
+                rowhash_path_for(emb_path), index_path_for(emb_path), codes_path_for(emb_path))
+
+    @classmethod
+    def _signature(cls, data_path: str, emb_path: str) -> tuple:
+        """(当前provider选择的集合键, 文件签名)"""
+        describe = make_provider(provider_name()).describe()
+        selection = tuple(describe.get(k) for k in SET_KEYS)
+        return selection, file_signature(*cls._signature_paths(data_path, emb_path))
+
+    def _load(self, data_path: str, emb_path: str, proxy=None, build: bool = False) -> DatasetBundle:
+        print(f"[Registry] 加载数据集: {data_path}")
+        # 类型化列存（首次或CSV变化时导入，保存标准化后的列），数值列只读映射
+        site_data = load_site_frame(data_path, prepare=prepare_site_data)
+        # 统计清单按CSV版本生成一次
+        stats = load_stats(data_path, site_data)
+
+        # 按清单选择与当前provider匹配的embedding集合；不同provider/模型的集合并存，互不覆盖
+        name = provider_name()
+        manifest = EmbeddingManifest.load(data_path, default_emb_path=emb_path)
+        emb_path = manifest.path_for(make_provider(name).describe(), emb_path)
+        provider = make_provider(name, proxy=proxy, emb_path=emb_path)
+        if os.path.exists(emb_path) and provider.matches(read_store_meta(emb_path)) \
+                and rows_current(emb_path, build_context(site_data).tolist()):
+            # 归一化float32只读映射，多请求/多进程共享
+            embedding = open_store(emb_path)
+        elif not build:
+            # 请求路径不做全量生成：由 python -m model.embedding_builder 离线构建或启动预加载生成
+            state = "与当前数据行不一致" if os.path.exists(emb_path) else "不存在"
+            raise EmbeddingsNotBuiltError(
+                f"embedding集合 {set_slug(provider.describe())} {state}: {emb_path}；"
+                f"请先运行 python -m model.embedding_builder {data_path}"
+            )
+        else:
+            # 集合缺失或CSV已追加/修改：生成该集合（同一provider的已有存储只补算变化的行）
+            print(f"[Registry] 生成embedding集合 {set_slug(provider.describe())}: {emb_path}")
+            se_tmp = SearchEngine(embedding=np.zeros((0, 0), dtype=np.float32), emb_path=emb_path, file_path=data_path,
+                                  proxy=proxy, normalized=True, provider=provider)
+            embedding = se_tmp.get_embeddings(emb_path=emb_path, file_path=data_path, force=True)
+            manifest.register(emb_path, read_store_meta(emb_path))
+            manifest.save()
+
+        # 大库且已离线构建索引（python -m model.ann）时启用近似检索
+        ann_index = load_index(emb_path, embedding)
+        # EMBEDDING_STORAGE=int8 时在量化codes上粗排，float存储只读取候选行；
+        # 请求路径不生成codes，缺失或过期时退回float检索（由 python -m model.quantize 或启动预加载生成）
+        quantized = None
+        if (os.getenv("EMBEDDING_STORAGE") or "").lower() == "int8":
+            quantized = load_quantized(emb_path, embedding, build=build)
+            if quantized is None:
+                print(f"[Registry] int8量化存储缺失或过期，使用float检索；请运行 python -m model.quantize {emb_path}")
+
+        # 签名在embedding与量化存储落盘之后计算，避免刚生成的文件触发重复加载
+        signature = self._signature(data_path, emb_path)
+        return DatasetBundle(data_path, emb_path, site_data, embedding, signature, ann_index, quantized, provider, stats)
+
+    def invalidate(self, data_path: str = None):
+        """丢弃缓存的数据集（不传路径则全部丢弃）。"""
+        with self._lock:
+            if data_path is None:
+                self._bundles.clear()
+            else:
+                self._bundles.pop(os.path.abspath(data_path), None)
+
+
+# 进程级单例，供服务端与SiteSelector共享
+DATASET_REGISTRY = DatasetRegistry()
@@ -0,0 +1,389 @@
+"""
+结构化规则编译：将 {column, op, value, negative, confidence} 规则列表编译为列级谓词计划
+列按类型预处理一次（数值数组 / 字符串字典编码）并随数据集缓存；文本谓词经n-gram倒排索引只校验候选取值，
+相同子表达式共享，按选择度从严到宽求值并在累积结果为空时提前结束；计划按规则集哈希缓存
+"""
+
+import re
+import sys
+import json
+import hashlib
+import threading
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+
+from model.text_index import NgramIndex, required_literals
+
+NUMERIC_OPS = ("<=", ">=", "<", ">")
+TEXT_OPS = ("==", "contains", "regex", "in")
+# 置信度低于该值的规则忽略
+MIN_CONFIDENCE = 0.3
+# 每个数据集缓存的规则计划数
+PLAN_CACHE_SIZE = 64
+# 每个数据集缓存的文本谓词命中取值数（按谓词，LRU淘汰）
+MATCH_CACHE_SIZE = 256
+# 数据集加载时预建倒排索引的文本列（其他列在首次用于文本谓词时构建）
+TEXT_INDEX_COLUMNS = ['土地用途', '宗地坐落']
+
+_COMPARE = {"<=": np.less_equal, ">=": np.greater_equal, "<": np.less, ">": np.greater}
+
+
+class ColumnCache:
+    """数据集的类型化列缓存（惰性构建、线程安全），与数据集快照同生命周期。
+
+    数值列保存float64数组、排序后的非空值及其行号（二分即可得到满足范围的行）；
+    文本列保存字典编码（每行取值编号 + 去重取值 + 各取值行数）及其n-gram倒排索引。
+    每列在各自的锁内只构建一次，并发的首个请求等待同一次构建；规则计划与文本谓词命中按LRU限量缓存。
+
+    Args:
+        frame (pd.DataFrame): 地块数据（只读）。
+        stats (DatasetStats, optional): 数据集统计清单；数值谓词的选择度按其直方图估计，无需先排序整列。
+    """
+
+    def __init__(self, frame: pd.DataFrame, stats=None):
+        self.frame = frame
+        self.stats = stats
+        self.n_rows = int(frame.shape[0])
+        self._numeric = {}
+        self._numeric_order = {}
+        self._text = {}
+        self._text_index = {}
+        self._hits = OrderedDict()
+        self._plans = OrderedDict()
+        self._lock = threading.Lock()
+        self._column_locks = {}
+
+    def _column_lock(self, kind: str, column: str) -> threading.Lock:
+        with self._lock:
+            lock = self._column_locks.get((kind, column))
+            if lock is None:
+                lock = self._column_locks[(kind, column)] = threading.Lock()
+            return lock
+
+    def numeric(self, column: str) -> tuple:
+        """(值数组, 排序后的非空值)；无法转换的值为NaN"""
+        entry = self._numeric.get(column)
+        if entry is not None:
+            return entry
+        with self._column_lock("numeric", column):
+            entry = self._numeric.get(column)
+            if entry is not None:
+                return entry
+            try:
+                series = self.frame[column]
+                if pd.api.types.is_numeric_dtype(series.dtype) and not isinstance(series.dtype, pd.CategoricalDtype):
+                    # 列存中已是数值的列直接取（float64时不复制）
+                    values = series.to_numpy(dtype=np.float64)
+                else:
+                    values = pd.to_numeric(series, errors='coerce').to_numpy(dtype=np.float64)
+            except Exception:
+                values = np.full(self.n_rows, np.nan)
+            order = np.argsort(values, kind='stable')[:int((~np.isnan(values)).sum())]
+            self._numeric_order[column] = order
+            entry = (values, values[order])
+            self._numeric[column] = entry
+            return entry
+
+    def numeric_order(self, column: str) -> np.ndarray:
+        """非空数值按升序排列的行号，与 numeric(column)[1] 一一对应"""
+        self.numeric(column)
+        return self._numeric_order[column]
+
+    def text(self, column: str) -> tuple:
+        """(每行取值编号, 去重后的字符串取值, 各取值行数)；空值编号为-1，不匹配任何文本谓词（同 str.contains(na=False)）"""
+        entry = self._text.get(column)
+        if entry is not None:
+            return entry
+        with self._column_lock("text", column):
+            entry = self._text.get(column)
+            if entry is not None:
+                return entry
+            series = self.frame[column]
+            if isinstance(series.dtype, pd.CategoricalDtype):
+                # 列存的字典编码列直接复用编号
+                codes = series.cat.codes.to_numpy()
+                uniques = np.asarray([str(c) for c in series.cat.categories], dtype=object)
+            else:
+                codes, uniques = pd.factorize(series, sort=False, use_na_sentinel=True)
+                uniques = np.asarray([str(u) for u in uniques], dtype=object)
+            codes = codes.astype(np.int32, copy=False)
+            entry = (codes, uniques, np.bincount(codes[codes >= 0], minlength=len(uniques)))
+            self._text[column] = entry
+            return entry
+
+    def text_index(self, column: str) -> NgramIndex:
+        index = self._text_index.get(column)
+        if index is not None:
+            return index
+        with self._column_lock("text_index", column):
+            index = self._text_index.get(column)
+            if index is None:
+                codes, uniques, _ = self.text(column)
+                index = NgramIndex(uniques, codes)
+                self._text_index[column] = index
+            return index
+
+    def nbytes(self) -> int:
+        """已构建的文本列编码（含去重取值字符串）与n-gram倒排索引的内存估算，计入数据集内存预算"""
+        arrays = []
+        total = 0
+        for codes, uniques, counts in list(self._text.values()):
+            arrays += [codes, uniques, counts]
+            total += sum(sys.getsizeof(v) for v in uniques)
+        for index in list(self._text_index.values()):
+            arrays += [index.alphabet, index.gram_keys, index.gram_ids, index.gram_offsets, index.order, index.offsets]
+        return total + sum(int(a.nbytes) for a in arrays)
+
+    def build_text_indexes(self, columns: list):
+        """数据集加载时预建文本列的倒排索引（不存在的列跳过）"""
+        for column in columns:
+            if column in self.frame.columns:
+                self.text_index(column)
+
+    def matched_values(self, predicate: "Predicate") -> np.ndarray:
+        """满足文本谓词的取值编号（升序），经倒排索引只校验候选取值，跨请求按LRU缓存"""
+        with self._lock:
+            ids = self._hits.get(predicate.key)
+            if ids is not None:
+                self._hits.move_to_end(predicate.key)
+                return ids
+        ids = self.text_index(predicate.column).match_values(predicate, predicate.literals)
+        with self._lock:
+            self._hits[predicate.key] = ids
+            self._hits.move_to_end(predicate.key)
+            while len(self._hits) > MATCH_CACHE_SIZE:
+                self._hits.popitem(last=False)
+        return ids
+
+    def category_hits(self, predicate: "Predicate") -> np.ndarray:
+        """文本谓词在去重取值上的结果（bool，按取值编号）"""
+        _, uniques, _ = self.text(predicate.column)
+        hits = np.zeros(len(uniques), dtype=bool)
+        hits[self.matched_values(predicate)] = True
+        return hits
+
+    def plan(self, rules: list, columns: list) -> "RulePlan":
+        """按规则集哈希取编译好的计划（含全库掩码缓存）"""
+        key = rules_fingerprint(rules)
+        with self._lock:
+            plan = self._plans.get(key)
+            if plan is not None:
+                self._plans.move_to_end(key)
+                return plan
+        plan = RulePlan.compile(rules, columns)
+        with self._lock:
+            self._plans[key] = plan
+            while len(self._plans) > PLAN_CACHE_SIZE:
+                self._plans.popitem(last=False)
+        return plan
+
+
+class Predicate:
+    """单列谓词（不含取反）；key相同的谓词在计划内只求值一次。"""
+
+    def __init__(self, column: str, op: str, value):
+        self.column = column
+        self.op = op
+        self.value = value
+        self.key = (column, op, json.dumps(value, ensure_ascii=False, sort_keys=True))
+        self._patterns = None
+        # 每个命中取值必然包含其一的字面量（小写），用于倒排索引筛选；None表示需逐个取值匹配
+        self.literals = None
+        if op in ("contains", "regex"):
+            # 与 str.contains(case=False) 一致：按正则匹配
+            self._patterns = [re.compile(str(value), re.I)]
+            self.literals = required_literals(str(value))
+        elif op == "in":
+            self._patterns = [re.compile(v, re.I) for v in value]
+            alts = [required_literals(v) for v in value]
+            self.literals = None if any(a is None for a in alts) else [lit for a in alts for lit in a]
+        elif op == "==":
+            self.literals = [str(value).lower()] if str(value) else None
+
+    @property
+    def numeric(self) -> bool:
+        return self.op in NUMERIC_OPS
+
+    def match(self, text: str) -> bool:
+        """文本谓词对单个取值的判定"""
+        if self.op == "==":
+            return text.lower() == str(self.value).lower()
+        if self.op == "in":
+            return any(p.search(text) for p in self._patterns)
+        return self._patterns[0].search(text) is not None
+
+    def _numeric_range(self, cache: ColumnCache) -> tuple:
+        """满足数值谓词的行在排序数组中的区间 [lo, hi)"""
+        _, ordered = cache.numeric(self.column)
+        if self.op == "<=":
+            return 0, int(np.searchsorted(ordered, self.value, side='right'))
+        if self.op == "<":
+            return 0, int(np.searchsorted(ordered, self.value, side='left'))
+        if self.op == ">=":
+            return int(np.searchsorted(ordered, self.value, side='left')), ordered.size
+        return int(np.searchsorted(ordered, self.value, side='right')), ordered.size
+
+    def estimate_count(self, cache: ColumnCache) -> int:
+        """用于排序的通过行数：数值列优先按统计清单的直方图估计，否则取精确值"""
+        if self.numeric and cache.stats is not None and self.column not in cache._numeric:
+            estimate = cache.stats.estimate_count(self.column, self.op, self.value)
+            if estimate is not None:
+                return estimate
+        return self.pass_count(cache)
+
+    def pass_count(self, cache: ColumnCache) -> int:
+        """全库满足该谓词的行数（数值列二分、文本列按取值行数求和，不扫描行）"""
+        if self.numeric:
+            lo, hi = self._numeric_range(cache)
+            return hi - lo
+        _, _, counts = cache.text(self.column)
+        return int(counts[cache.matched_values(self)].sum())
+
+    def matching_rows(self, cache: ColumnCache) -> np.ndarray:
+        """全库满足该谓词的行号（升序），代价与命中行数成正比"""
+        if self.numeric:
+            lo, hi = self._numeric_range(cache)
+            return np.sort(cache.numeric_order(self.column)[lo:hi])
+        return cache.text_index(self.column).rows(cache.matched_values(self))
+
+    def evaluate(self, cache: ColumnCache, rows: np.ndarray = None) -> np.ndarray:
+        """在全库（rows为None）或给定行上求值，返回bool数组"""
+        if self.numeric:
+            values, _ = cache.numeric(self.column)
+            if rows is not None:
+                values = values[rows]
+            return _COMPARE[self.op](values, self.value)
+        codes, _, _ = cache.text(self.column)
+        if rows is not None:
+            codes = codes[rows]
+        # 末尾追加False，空值编号-1取到它
+        return np.append(cache.category_hits(self), False)[codes]
+
+
+def _normalize_rule(rule: dict, columns: list):
+    """校验并规范化单条规则，返回 (谓词参数, 是否取反)；无效规则返回None"""
+    col = rule.get("column")
+    op = (rule.get("op") or "").lower()
+    val = rule.get("value")
+    try:
+        conf = float(rule.get("confidence", 0.0))
+    except (TypeError, ValueError):
+        return None
+    if col not in columns or conf < MIN_CONFIDENCE:
+        return None
+    if op in NUMERIC_OPS:
+        try:
+            val = float(val)
+        except (TypeError, ValueError):
+            return None
+        if np.isnan(val):
+            return None
+    elif op == "in":
+        values = val if isinstance(val, list) else [val]
+        val = [str(v) for v in values if v is not None]
+        if len(val) == 0:
+            return None
+    elif op in TEXT_OPS:
+        val = str(val)
+    else:
+        # 未知操作符，跳过
+        return None
+    return (col, op, val), bool(rule.get("negative", False))
+
+
+def rules_fingerprint(rules: list) -> str:
+    """规则集哈希（与规则顺序无关）"""
+    items = sorted(json.dumps(r, ensure_ascii=False, sort_keys=True, default=str) for r in rules)
+    return hashlib.sha1("\n".join(items).encode('utf-8')).hexdigest()
+
+
+class RulePlan:
+    """编译后的规则计划：去重谓词 + (谓词, 取反, 重复次数) 项。
+
+    所有项取与得到结构化掩码；满足度 = 满足的规则数 / 有效规则数（重复规则按次数计）。
+    """
+
+    def __init__(self, predicates: list, terms: list, n_rules: int):
+        self.predicates = predicates
+        self.terms = terms
+        self.n_rules = n_rules
+        self._mask = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def compile(cls, rules: list, columns: list) -> "RulePlan":
+        predicates, index, weights = [], {}, OrderedDict()
+        n_rules = 0
+        for rule in rules:
+            try:
+                parsed = _normalize_rule(rule, columns)
+                if parsed is None:
+                    continue
+                (col, op, val), neg = parsed
+                pred = Predicate(col, op, val)
+            except re.error:
+                # 非法正则与原解释执行一致：跳过该规则
+                continue
+            i = index.get(pred.key)
+            if i is None:
+                i = index[pred.key] = len(predicates)
+                predicates.append(pred)
+            weights[(i, neg)] = weights.get((i, neg), 0) + 1
+            n_rules += 1
+        terms = [(i, neg, w) for (i, neg), w in weights.items()]
+        return cls(predicates, terms, n_rules)
+
+    def __len__(self) -> int:
+        return self.n_rules
+
+    def mask(self, cache: ColumnCache) -> np.ndarray:
+        """全库结构化掩码；首次求值后缓存（计划随数据集缓存，数据不变则结果不变）"""
+        with self._lock:
+            if self._mask is None:
+                self._mask = self._evaluate(cache)
+            return self._mask
+
+    def _evaluate(self, cache: ColumnCache) -> np.ndarray:
+        n = cache.n_rows
+        # 同一谓词同时要求成立与不成立时结果必为空
+        signs = {}
+        for i, neg, _ in self.terms:
+            signs.setdefault(i, set()).add(neg)
+        if any(len(s) > 1 for s in signs.values()):
+            return np.zeros(n, dtype=bool)
+
+        # 选择度最高（通过行数最少）的项先求值，后续项只在剩余行上求值
+        def passing(term):
+            i, neg, _ = term
+            count = self.predicates[i].estimate_count(cache)
+            return n - count if neg else count
+
+        rows = None
+        for i, neg, _ in sorted(self.terms, key=passing):
+            if rows is None and not neg:
+                # 首项直接由排序数组/倒排索引取命中行，不扫描整列
+                rows = self.predicates[i].matching_rows(cache)
+            else:
+                hit = self.predicates[i].evaluate(cache, rows)
+                keep = ~hit if neg else hit
+                rows = np.flatnonzero(keep) if rows is None else rows[keep]
+            if rows.size == 0:
+                break
+        mask = np.zeros(n, dtype=bool)
+        if rows is None:
+            mask[:] = True
+        else:
+            mask[rows] = True
+        return mask
+
+    def scores(self, cache: ColumnCache, rows: np.ndarray) -> np.ndarray:
+        """给定行的规则满足度（满足数 / 有效规则数），只在这些行上求值"""
+        rows = np.asarray(rows, dtype=np.int64)
+        if self.n_rules == 0:
+            return np.ones(rows.shape[0], dtype=float)
+        satisfied = np.zeros(rows.shape[0], dtype=float)
+        for i, neg, w in self.terms:
+            hit = self.predicates[i].evaluate(cache, rows)
+            satisfied += w * (~hit if neg else hit)
+        return satisfied / float(self.n_rules)
@@ -1,20 +1,87 @@
 import os
+import json
+import concurrent.futures
+import threading
 import numpy as np
-import pandas as pd
+
+from model.utils.metrics import timed_stage
+from model.embedding_builder import build_context, builder_from_env
+from model.embedding_store import open_store, normalize_rows, read_store_meta, write_store_meta
+from model.embedding_provider import make_provider
+from model.embedding_manifest import EmbeddingMismatchError
+from model.columnar import read_site_frame
+
+# 检索模式：vector 纯向量 / hybrid 向量+词法融合 / lexical 纯词法（不调用embedding接口）
+SEARCH_MODES = ("vector", "hybrid", "lexical")
+
+# 带超时的查询embedding在此线程池中执行（首次使用时创建，进程内共享）
+_EMBED_EXECUTOR = None
+_EMBED_EXECUTOR_LOCK = threading.Lock()
+
+# 预过滤子集不超过该行数时直接在子集上暴力检索，不再经过ANN/量化索引
+SUBSET_BRUTE_FORCE_ROWS = 20000
+# 计算子集embedding均值时每次读取的行数
+SUBSET_MEAN_BLOCK_ROWS = 65536
+
+
+def resolve_subset(mask, n_rows: int):
+    """将行掩码（bool，长度n_rows）或行号列表转为升序行号数组；None表示全库"""
+    if mask is None:
+        return None
+    mask = np.asarray(mask)
+    if mask.dtype == bool:
+        if mask.shape[0] != n_rows:
+            raise ValueError(f"行掩码长度 {mask.shape[0]} 与数据集行数 {n_rows} 不一致")
+        return np.flatnonzero(mask)
+    return np.unique(mask.astype(np.int64))
+
+
+def top_k_indices(scores: np.ndarray, k: int = None) -> np.ndarray:
+    """
+    Indices of the k largest scores in descending order.
+    Uses np.argpartition so only the top k entries are sorted; k=None (or k >= len) sorts everything.
+    """
+    n = scores.shape[0]
+    if k is None or k <= 0 or k >= n:
+        return np.argsort(scores)[::-1]
+    part = np.argpartition(scores, n - k)[n - k:]
+    return part[np.argsort(scores[part])[::-1]]
 
 
 class SearchEngine:
-    def __init__(self, embedding: np.ndarray = None, emb_path: str = "", file_path: str = "", proxy = None):
-        # 先设置代理，再决定是否生成embedding，避免在get_embeddings中访问未设置的self.proxy
+    def __init__(self, embedding: np.ndarray = None, emb_path: str = "", file_path: str = "", proxy = None, normalized: bool = False, ann_index = None, ann_nprobe: int = None, quantized = None, lexical = None, mode: str = None, provider = None):
+        # 先设置代理与provider，再决定是否生成embedding，避免在get_embeddings中访问未设置的属性
         self.proxy = proxy
         self.emb_path = emb_path
         self.file_path = file_path
+        # embedding提供方（model.embedding_provider），缺省按 EMBEDDING_PROVIDER 构造
+        self.provider = provider if provider is not None else make_provider(proxy=proxy, emb_path=emb_path)
         if embedding is not None:
-            self.embedding = embedding
+            # 检索假定embedding已按行归一化；调用方未保证时在此一次性归一化
+            self.embedding = embedding if normalized else normalize_rows(embedding)
         else:
             self.embedding = self.get_embeddings(emb_path=emb_path, file_path=file_path)
+        # 可选的IVF近似索引（model.ann）；nprobe为召回/延迟旋钮
+        self.ann_index = ann_index
+        self.ann_nprobe = int(ann_nprobe or os.getenv("ANN_NPROBE") or 0) or None
+        # 可选的int8量化存储（model.quantize）：在codes上粗排后精确重排
+        self.quantized = quantized
+        # 可选的BM25词法索引（model.lexical）；embedding接口超时/失败时回退为纯词法检索
+        self.lexical = lexical
+        self.mode = (mode or os.getenv("SEARCH_MODE") or "vector").lower()
+        if self.mode not in SEARCH_MODES:
+            self.mode = "vector"
+        self.lexical_weight = float(os.getenv("SEARCH_LEXICAL_WEIGHT") or 0.2)
+        self.embed_timeout = float(os.getenv("SEARCH_EMBED_TIMEOUT") or 0) or None
+
+    def embed_texts(self, texts: list) -> np.ndarray:
+        """
+        Embed query texts as a float32 array of shape (n, emb_dim) with the configured provider.
+        The OpenAI provider uses the proxy's memoized `embed_texts` when available.
+        """
+        return self.provider.embed_queries(list(texts))
 
-    def top_k_cosine_similarity(self, A: np.ndarray = None, B: np.ndarray = None, k: int = None, indices: list = None):
+    def top_k_cosine_similarity(self, A: np.ndarray = None, B: np.ndarray = None, k: int = None, indices: list = None, b_normalized: bool = False):
         """
         Calculate the top-k cosine similarities between vectors in set A and set B.
 
@@ -23,6 +90,7 @@ class SearchEngine:
             B (np.ndarray, optional): An array of vectors of shape (n, emb_dim) representing set B.
             k (int, optional): The number of top similarities to return.
             indices (list, optional): A list of indices to consider for top-k cosine similarities.
+            b_normalized (bool, optional): B rows are already L2-normalised (the embedding store), skip renormalising B.
 
         Returns:
             tuple: A tuple containing two elements:
@@ -30,161 +98,268 @@ class SearchEngine:
                 - np.ndarray: An array of shape (k,) containing the top-k cosine similarity scores.
         """
         # Normalize the vectors
-        A_norm = A / np.linalg.norm(A)
-        B_norm = B / np.linalg.norm(B, axis=1)[:, np.newaxis]
-
-        # Compute the cosine similarity
-        cosine_similarities = np.dot(A_norm, B_norm.T)
+        A_norm = (A / np.linalg.norm(A)).astype(np.float32, copy=False)
+        B_norm = B if b_normalized else B / np.linalg.norm(B, axis=1)[:, np.newaxis]
 
-        # If indices are provided, replace all other cosine similarities with negative infinity so that they don't get considered
         if indices is not None:
-            mask = np.ones(cosine_similarities.shape, dtype=bool)
-            mask[0][indices] = False
-            cosine_similarities[0][mask[0]] = -np.inf
-
-        # Get the top-k indices
-        top_k_indices = np.argsort(cosine_similarities[0])[::-1][:k]
-
-        # Get the top-k cosine similarities
-        top_k_similarities = cosine_similarities[0][top_k_indices]
-
-        return top_k_indices, top_k_similarities
+            # Only score the requested rows instead of masking a full copy of the similarities
+            indices = np.asarray(indices, dtype=np.int64)
+            scores = np.dot(B_norm[indices], A_norm[0])
+            order = top_k_indices(scores, k)
+            return indices[order], scores[order]
 
+        # Compute the cosine similarity
+        scores = np.dot(B_norm, A_norm[0])
+        order = top_k_indices(scores, k)
+        return order, scores[order]
 
-    def get_embeddings(self, emb_path: str = "", file_path: str = "", force: bool = False) -> None: 
+    def get_embeddings(self, emb_path: str = "", file_path: str = "", force: bool = False) -> np.ndarray:
         """
         Retrieves embeddings from the specified 'emb_path'
-        if no embedding exists, then load context from 'file_path' and compute embedding though openai api calls.
+        if no embedding exists, then load context from 'file_path' and compute embedding with the configured provider.
 
         Args:
             emb_path (str): The path to the embeddings file (numpy array).
             file_path (str, optional): The path to the original context (pandas dataframe).
-            save (bool, optional, default to True): save the computed embeddings to the emb_path (numpy array).
+            force (bool, optional): Rebuild even if 'emb_path' exists; rows whose context is unchanged are reused
+                when the existing store was built by the same provider.
 
         Returns:
-            None
+            np.ndarray: The L2-normalised float32 embedding store.
         """
-        # 当 force=True 时忽略已有文件，按当前提供商重新生成，确保维度对齐
+        # 当 force=True 时按当前提供商重新生成：已有存储由同一provider生成时只补算新增/变化的行
         if os.path.exists(emb_path) and not force:
-            embedding = np.load(emb_path)
+            embedding = open_store(emb_path)
         else:
-            data = pd.read_csv(file_path)
-            if self.proxy is None:
-                raise RuntimeError("SearchEngine.proxy 未设置，无法生成embedding。请传入有效的proxy或提供现有的embedding/emb_path。")
-            # 若已有context列，优先使用
-            if 'context' in data.columns:
-                context = data['context'].astype(str)
+            data = read_site_frame(file_path)
+            context = build_context(data).tolist()
+            # 本地provider在此拟合基
+            self.provider.prepare(context)
+            # 分块并发请求，已完成分块写入 {emb_path}.partial 以便中断后续传；完成后原子覆盖emb_path
+            builder = builder_from_env(
+                self.provider.embed_documents,
+                tag=json.dumps(self.provider.describe(), sort_keys=True)
+            )
+            if emb_path and os.path.exists(emb_path) and self.provider.matches(read_store_meta(emb_path)):
+                embedding = builder.update(context, emb_path)
             else:
-                # 兼容真实数据的列名，生成简洁文本描述（避免三元表达式跨行导致语法错误）
-                if 'name' in data.columns:
-                    name = data['name'].astype(str)
-                elif '宗地坐落' in data.columns:
-                    name = data['宗地坐落'].astype(str)
-                else:
-                    name = data.index.astype(str)
-                if 'address' in data.columns:
-                    address = data['address'].astype(str)
-                elif '宗地坐落' in data.columns:
-                    address = data['宗地坐落'].astype(str)
-                else:
-                    address = name
-                # 缺失列使用空Series，保证长度与数据一致
-                usage = (data['土地用途'].astype(str) if '土地用途' in data.columns else pd.Series([''] * len(data)))
-                area = (data['宗地面积(平方米)'].astype(str) if '宗地面积(平方米)' in data.columns else pd.Series([''] * len(data)))
-                price = (data['挂牌起始价(万元)'].astype(str) if '挂牌起始价(万元)' in data.columns else pd.Series([''] * len(data)))
-                desc = ("用途:" + usage + "，面积:" + area + "㎡，起始价:" + price + "万元").str.strip()
-                context = name + "，地址是" + address + "，" + desc
-            res_records = self.proxy.embedding(input_data=context.tolist())
-            try:
-                embedding = np.array([np.array(record["embedding"]) for record in res_records["data"]])
-            except Exception:
-                # 兼容不同proxy返回结构
-                embedding = np.array([np.array(record.embedding) for record in res_records.data])
-            # 始终覆盖写入最新embedding
-            try:
-                np.save(emb_path, embedding)
-            except Exception:
-                pass
+                embedding = builder.build(context, emb_path)
+            if emb_path:
+                # 记录生成该存储的provider，加载时据此判断是否需要重建
+                write_store_meta(emb_path, dict(self.provider.describe(), dim=int(embedding.shape[1]), rows=int(embedding.shape[0])))
 
         return embedding
 
-    def query(self, desc: tuple = None, top_k: int = None):
+    @timed_stage("search_query")
+    def query(self, desc: tuple = None, top_k: int = None, mask = None):
         """
         query the existing vector database and return the top_k ids and similarity scores
 
         Args:
             desc (tuple): The user pos reqs and neg reqs.
             top_k (int)
+            mask (optional): A boolean row mask or a list of row indices; only these rows are scored.
 
         Returns:
             numpy array with shape (top_k, 2)
             The first column indicates the queried ids and the second column indicates the similarity scores.
         """
+        return self.query_batch([desc], top_k=top_k, mask=mask)[0]
+
+    @timed_stage("search_query_batch")
+    def query_batch(self, descs: list = None, top_k: int = None, mask = None) -> list:
+        """
+        query several (pos, neg) requirements at once.
+        All sub-requirement texts are embedded in a single request and scored with one matrix-matrix product.
+        In "hybrid" mode normalized BM25 scores are added to the cosine scores; in "lexical" mode
+        (or when the embedding call fails or times out) only the lexical index is used.
+        With a mask only the selected rows are scored (the negative mean shift is taken over those rows);
+        returned ids are always corpus row ids.
+
+        Args:
+            descs (list): A list of (pos_desc, neg_desc) tuples; neg_desc may be None or "".
+            top_k (int)
+            mask (optional): A boolean row mask or a list of row indices to restrict the search to.
+
+        Returns:
+            list of numpy arrays with shape (top_k, 2), one per requirement, in input order.
+        """
+        empty = np.array([]).reshape(0, 2)
+        descs = list(descs or [])
+        if not descs:
+            return []
+        # 去重后一次性embedding全部正/负向文本
+        texts = []
+        slot = {}
+        for pos_desc, neg_desc in descs:
+            for text in (pos_desc, neg_desc):
+                if text in [None, ""]:
+                    continue
+                text = f"{text}"
+                if text not in slot:
+                    slot[text] = len(texts)
+                    texts.append(text)
+        if not texts:
+            return [empty for _ in descs]
+        rows = resolve_subset(mask, self.embedding.shape[0])
+        if rows is not None and rows.size == 0:
+            return [empty for _ in descs]
+        if self.mode == "lexical" and self.lexical is not None:
+            return self._query_lexical(descs, top_k, rows)
+
         try:
-            pos_desc, neg_desc = desc
-
-            pos_res = self.proxy.embedding(input_data=f"{pos_desc}")
-            try:
-                pos_embedding = np.array([np.array(record["embedding"]) for record in pos_res["data"]])
-            except:
-                pos_embedding = np.array([np.array(record.embedding) for record in pos_res.data])
-
-            # 若维度不一致，自动重算数据集embedding以对齐当前提供商维度
-            try:
-                if self.embedding is None or (self.embedding.size > 0 and self.embedding.shape[1] != pos_embedding.shape[1]):
-                    self.embedding = self.get_embeddings(emb_path=self.emb_path, file_path=self.file_path, force=True)
-            except Exception as _e:
-                pass
-
-            indices, similarities = self.top_k_cosine_similarity(pos_embedding, self.embedding, k=100000000)
-            
-            # 确保indices和similarities是一维数组
-            if indices.ndim > 1:
-                indices = indices.flatten()
-            if similarities.ndim > 1:
-                similarities = similarities.flatten()
-                
-            if neg_desc not in [None, ""]:
-                sorted_indices = np.argsort(indices)
-                indices = indices[sorted_indices]
-                similarities = similarities[sorted_indices]
-
-                neg_res = self.proxy.embedding(input_data=f"{neg_desc}")
-                try:
-                    neg_embedding = np.array([np.array(record["embedding"]) for record in neg_res["data"]])
-                except:
-                    neg_embedding = np.array([np.array(record.embedding) for record in neg_res.data])
-                neg_indices, neg_similarities = self.top_k_cosine_similarity(neg_embedding, self.embedding, k=100000000, indices=indices)
-                
-                # 确保neg_similarities是一维数组
-                if neg_similarities.ndim > 1:
-                    neg_similarities = neg_similarities.flatten()
-                
-                sorted_indices = np.argsort(neg_indices)
-                neg_indices = neg_indices[sorted_indices]
-                neg_similarities = neg_similarities[sorted_indices]
-
-                mean_similarity = np.mean(similarities)
-                
-                for i in range(len(neg_similarities)):
-                    similarities[i] -= neg_similarities[i]
-                similarities += (mean_similarity - np.mean(similarities)) # back to original similarities.
-
-                sorted_indices = np.argsort(similarities)[::-1]
-                indices = indices[sorted_indices]
-                similarities = similarities[sorted_indices]
-            
-            # 限制返回结果数量
-            if top_k is not None and top_k > 0:
-                indices = indices[:top_k]
-                similarities = similarities[:top_k]
-            
-            # 确保返回的数组形状正确
-            result = np.column_stack((indices, similarities))
-            
-            return result
-            
+            query_embedding = self._embed_queries(texts)
+
+            # 查询向量与数据集embedding不属于同一集合时直接报错，不在请求线程内重建整个数据集
+            if self.embedding.size > 0 and self.embedding.shape[1] != query_embedding.shape[1]:
+                raise EmbeddingMismatchError(
+                    f"查询embedding维度 {query_embedding.shape[1]} 与数据集embedding {self.embedding.shape[1]} 不一致（{self.emb_path}），"
+                    f"请为当前provider构建对应的embedding集合"
+                )
+
+            query_embedding = normalize_rows(query_embedding)
+            n_scored = self.embedding.shape[0] if rows is None else rows.size
+            # 子集足够小时直接暴力检索；否则ANN/量化索引只在允许的行中取候选
+            use_index = top_k is not None and 0 < top_k < n_scored and (rows is None or n_scored > SUBSET_BRUTE_FORCE_ROWS)
+            allowed = None
+            mean_vector = None
+            if use_index and rows is not None:
+                allowed = np.zeros(self.embedding.shape[0], dtype=bool)
+                allowed[rows] = True
+                # 负向平移与暴力检索一致取子集均值
+                if any(neg not in [None, ""] for _, neg in descs):
+                    mean_vector = self._subset_mean(rows)
+            if use_index and self.ann_index is not None:
+                return self._fuse_shortlists(descs, self._query_ann(descs, query_embedding, slot, top_k, allowed, mean_vector), rows)
+            if use_index and self.quantized is not None:
+                return self._fuse_shortlists(descs, self._query_quantized(descs, query_embedding, slot, top_k, allowed, mean_vector), rows)
+            # (n_rows, n_texts)：每列为一条文本对全库（或子集）的相似度
+            corpus = self.embedding if rows is None else self.embedding[rows]
+            similarities = np.dot(corpus, query_embedding.T)
+        except EmbeddingMismatchError:
+            raise
         except Exception as e:
+            if self.lexical is not None:
+                print(f"SearchEngine.query embedding不可用，回退词法检索: {e}")
+                return self._query_lexical(descs, top_k, rows)
             print(f"SearchEngine.query出错: {e}")
-            return np.array([]).reshape(0, 2)  # 返回空的二维数组
+            return [empty for _ in descs]
+
+        hybrid = self.mode == "hybrid" and self.lexical is not None
+        results = []
+        for pos_desc, neg_desc in descs:
+            if pos_desc in [None, ""]:
+                results.append(empty)
+                continue
+            scores = similarities[:, slot[f"{pos_desc}"]]
+            if neg_desc not in [None, ""]:
+                neg_similarities = similarities[:, slot[f"{neg_desc}"]]
+                # 减去负向相似度后平移回原均值：pos - neg + mean(neg)
+                scores = scores - neg_similarities + neg_similarities.mean()
+            if hybrid:
+                scores = scores + self.lexical_weight * self._lexical_scores(pos_desc, neg_desc, rows)
+
+            # 仅对前top_k做部分排序
+            indices = top_k_indices(scores, top_k)
+            ids = indices if rows is None else rows[indices]
+            results.append(np.column_stack((ids, scores[indices])))
+        return results
+
+    def _embed_queries(self, texts: list) -> np.ndarray:
+        """调用embed_texts；设置SEARCH_EMBED_TIMEOUT时超时抛出TimeoutError"""
+        global _EMBED_EXECUTOR
+        if self.embed_timeout is None:
+            return self.embed_texts(texts)
+        with _EMBED_EXECUTOR_LOCK:
+            if _EMBED_EXECUTOR is None:
+                _EMBED_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix="query-embed")
+            executor = _EMBED_EXECUTOR
+        future = executor.submit(self.embed_texts, texts)
+        try:
+            return future.result(timeout=self.embed_timeout)
+        except concurrent.futures.TimeoutError:
+            raise TimeoutError(f"embedding超过{self.embed_timeout}s未返回")
+
+    def _lexical_scores(self, pos_desc: str, neg_desc: str = None, rows: np.ndarray = None) -> np.ndarray:
+        """[0, 1] 归一化BM25分数（给定rows时只取这些行），负向需求与向量分数同样按 pos - neg + mean(neg) 组合"""
+        scores = self.lexical.score_normalized(f"{pos_desc}")
+        if rows is not None:
+            scores = scores[rows]
+        if neg_desc not in [None, ""]:
+            neg_scores = self.lexical.score_normalized(f"{neg_desc}")
+            if rows is not None:
+                neg_scores = neg_scores[rows]
+            scores = scores - neg_scores + neg_scores.mean()
+        return scores
 
+    def _query_lexical(self, descs: list, top_k: int = None, rows: np.ndarray = None) -> list:
+        """纯词法检索，不调用embedding接口"""
+        results = []
+        for pos_desc, neg_desc in descs:
+            if pos_desc in [None, ""]:
+                results.append(np.array([]).reshape(0, 2))
+                continue
+            scores = self._lexical_scores(pos_desc, neg_desc, rows)
+            indices = top_k_indices(scores, top_k)
+            ids = indices if rows is None else rows[indices]
+            results.append(np.column_stack((ids, scores[indices])))
+        return results
+
+    def _subset_mean(self, rows: np.ndarray) -> np.ndarray:
+        """给定行（升序）的embedding均值，分块累加以免一次读出整个子集"""
+        total = np.zeros(self.embedding.shape[1], dtype=np.float64)
+        for start in range(0, rows.size, SUBSET_MEAN_BLOCK_ROWS):
+            block = np.asarray(self.embedding[rows[start:start + SUBSET_MEAN_BLOCK_ROWS]], dtype=np.float32)
+            total += block.sum(axis=0, dtype=np.float64)
+        return (total / max(rows.size, 1)).astype(np.float32)
+
+    def _fuse_shortlists(self, descs: list, results: list, rows: np.ndarray = None) -> list:
+        """hybrid模式下对ANN/量化检索返回的候选叠加词法分数并重新排序（给定rows时词法负向均值同样取子集）"""
+        if self.mode != "hybrid" or self.lexical is None:
+            return results
+        fused = []
+        for (pos_desc, neg_desc), res in zip(descs, results):
+            if res.size == 0:
+                fused.append(res)
+                continue
+            indices = res[:, 0].astype(np.int64)
+            lexical = self._lexical_scores(pos_desc, neg_desc, rows)
+            # 子集分数按子集位置排列，rows升序，候选行号二分得到位置
+            positions = indices if rows is None else np.searchsorted(rows, indices)
+            scores = res[:, 1] + self.lexical_weight * lexical[positions]
+            order = np.argsort(scores)[::-1]
+            fused.append(np.column_stack((indices[order], scores[order])))
+        return fused
+
+    def _query_ann(self, descs: list, query_embedding: np.ndarray, slot: dict, top_k: int, allowed: np.ndarray = None, mean_vector: np.ndarray = None) -> list:
+        """经IVF索引取候选行后精确重排，返回形状与暴力检索一致"""
+        results = []
+        for pos_desc, neg_desc in descs:
+            if pos_desc in [None, ""]:
+                results.append(np.array([]).reshape(0, 2))
+                continue
+            pos = query_embedding[slot[f"{pos_desc}"]]
+            neg = query_embedding[slot[f"{neg_desc}"]] if neg_desc not in [None, ""] else None
+            indices, scores = self.ann_index.search(self.embedding, pos, neg, top_k=top_k, nprobe=self.ann_nprobe,
+                                                     allowed=allowed, mean_vector=mean_vector)
+            results.append(np.column_stack((indices, scores)))
+        return results
+
+    def _query_quantized(self, descs: list, query_embedding: np.ndarray, slot: dict, top_k: int, allowed: np.ndarray = None, mean_vector: np.ndarray = None) -> list:
+        """在int8 codes上一次算出全部文本的近似分数，按需求取候选后从float存储精确重排"""
+        approx = self.quantized.approx_scores(query_embedding)
+        results = []
+        for pos_desc, neg_desc in descs:
+            if pos_desc in [None, ""]:
+                results.append(np.array([]).reshape(0, 2))
+                continue
+            pos = query_embedding[slot[f"{pos_desc}"]]
+            scores = approx[:, slot[f"{pos_desc}"]]
+            neg = None
+            if neg_desc not in [None, ""]:
+                neg = query_embedding[slot[f"{neg_desc}"]]
+                neg_approx = approx[:, slot[f"{neg_desc}"]]
+                scores = scores - neg_approx + (neg_approx.mean() if allowed is None else neg_approx[allowed].mean())
+            indices, exact = self.quantized.search(self.embedding, scores, pos, neg, top_k=top_k, allowed=allowed, mean_vector=mean_vector)
+            results.append(np.column_stack((indices, exact)))
+        return results
@@ -8,17 +8,73 @@ import re
 import copy
 import json
 import numpy as np
-import concurrent.futures
 import sys
 import pandas as pd
 import httpx
+import hashlib
+import threading
 
 from model.utils.funcs import (
     RecurringList, compute_consecutive_distances, find_indices, 
     sample_items, reorder_list, remove_duplicates
 )
-from model.search import SearchEngine
-from model.spatial import SpatialHandler
+from model.registry import DATASET_REGISTRY
+from model.rules import ColumnCache, Predicate
+from model.stats import DatasetStats
+from model.embedding_manifest import EmbeddingMismatchError
+from model.utils.kv_cache import shared_cache
+from model.utils.metrics import timed_stage, time_model_call, observe_candidates, CACHE_REQUESTS, StageTimer
+
+# 约束->规则映射缓存的版本号：提示词或规则格式变化时递增，使旧条目失效
+STRUCT_RULES_CACHE_VERSION = 1
+DEFAULT_STRUCT_RULES_CACHE_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cache', 'deepseek_rules.sqlite'
+)
+
+_HTTP_CLIENT = None
+_HTTP_CLIENT_LOCK = threading.Lock()
+
+
+def shared_http_client() -> httpx.Client:
+    """进程内共享的httpx连接池（各请求的DeepSeekClient复用同一组keep-alive连接）"""
+    global _HTTP_CLIENT
+    with _HTTP_CLIENT_LOCK:
+        if _HTTP_CLIENT is None or _HTTP_CLIENT.is_closed:
+            _HTTP_CLIENT = httpx.Client(
+                timeout=30.0,
+                limits=httpx.Limits(max_connections=20, max_keepalive_connections=10)
+            )
+        return _HTTP_CLIENT
+
+
+def struct_rules_cache_from_env():
+    """约束->规则映射的持久化缓存：路径 DEEPSEEK_RULES_CACHE_PATH（默认 cache/deepseek_rules.sqlite，设为off关闭）"""
+    path = os.getenv("DEEPSEEK_RULES_CACHE_PATH") or DEFAULT_STRUCT_RULES_CACHE_PATH
+    if path.strip().lower() in ("off", "none", "0"):
+        return None
+    try:
+        return shared_cache(
+            path,
+            ttl=float(os.getenv("DEEPSEEK_RULES_CACHE_TTL") or 7 * 24 * 3600),
+            max_entries=int(os.getenv("DEEPSEEK_RULES_CACHE_MAX_ENTRIES") or 5000)
+        )
+    except Exception as e:
+        print(f"约束规则缓存不可用：{e}")
+        return None
+
+
+def struct_rules_cache_key(constraints: list, columns: list, dtypes: list, samples: dict, model: str) -> str:
+    """缓存键 = 规范化后的硬性约束（去空白、去重、排序）+ 数据集schema指纹（列名、类型与提示词中的示例值）"""
+    normalized = sorted({
+        (str(c.get('text') or '').strip(), str(c.get('type') or '').strip(), bool(c.get('is_negative', False)))
+        for c in constraints if str(c.get('text') or '').strip()
+    })
+    schema = [[str(col), str(dt), [str(v) for v in (samples or {}).get(col, [])]] for col, dt in zip(columns, dtypes)]
+    raw = json.dumps({
+        "v": STRUCT_RULES_CACHE_VERSION, "model": model,
+        "constraints": normalized, "schema": schema
+    }, ensure_ascii=False, sort_keys=True)
+    return "struct_rules:" + hashlib.sha1(raw.encode("utf-8")).hexdigest()
 
 
 class DeepSeekClient:
@@ -26,7 +82,7 @@ class DeepSeekClient:
     def __init__(self, api_key: str, base_url: str = "https://api.deepseek.com"):
         self.api_key = api_key
         self.base_url = base_url.rstrip('/')
-        self.session = httpx.Client(timeout=30.0)
+        self.session = shared_http_client()
 
     def chat_json(self, messages: list, model: str = "deepseek-chat") -> str:
         url = f"{self.base_url}/chat/completions"
@@ -41,8 +97,9 @@ class DeepSeekClient:
             "stream": False,
             "response_format": {"type": "json_object"}
         }
-        resp = self.session.post(url, headers=headers, json=payload)
-        resp.raise_for_status()
+        with time_model_call("deepseek_chat"):
+            resp = self.session.post(url, headers=headers, json=payload)
+            resp.raise_for_status()
         data = resp.json()
         try:
             return data["choices"][0]["message"]["content"]
@@ -63,7 +120,7 @@ class SiteSelector:
                  deepseek_base_url=None, deepseek_api_key=None,
                  enable_spatial_optimization=False, enable_route_order=False,
                  min_distance_meters=0, dataset_path=None,
-                 enable_struct_filters=False):
+                 enable_struct_filters=False, search_mode=None):
         
         # 核心参数
         self.MODEL = "gpt-4o"
@@ -93,14 +150,9 @@ class SiteSelector:
         
         # 初始化检索和空间处理模块
         self.maxSiteNum = 10  # 最多推荐10个地块
-        self.search_engine = SearchEngine(
-            embedding=self.embedding,
-            emb_path=getattr(self, 'emb_path', ''),
-            file_path=getattr(self, 'data_path', ''),
-            proxy=self.proxy
-        )
-        self.spatial_handler = SpatialHandler(
-            data=self.site_data,
+        # search_mode: vector / hybrid / lexical，缺省读取SEARCH_MODE
+        self.search_engine = self.dataset.search_engine(proxy=self.proxy, mode=search_mode)
+        self.spatial_handler = self.dataset.spatial_handler(
             min_clusters=2,  # 至少2个空间聚类
             min_pois=self.maxSiteNum,
             citywalk=False,  # 选址不需要citywalk模式
@@ -145,25 +197,35 @@ class SiteSelector:
         self.text_score_min = 0.0
         self.text_score_max = 1.0
 
+    @timed_stage("parse_user_request")
     def parse_user_request(self, user_reqs):
         """解析用户自然语言需求"""
         prompt = self.get_parse_prompt(user_reqs)
         response = self.proxy.chat(
             messages=[{"role": "user", "content": prompt}],
-            model=self.MODEL
-        ).replace("'", '"')
-        
+            model=self.MODEL,
+            # 只缓存可解析的响应，避免错误结果被重复返回
+            validate=lambda r: self.parse_requirements_response(r) is not None
+        )
+        parsed = self.parse_requirements_response(response)
+        if parsed is None:
+            print("解析JSON失败")
+            return []
+        return parsed
+
+    def parse_requirements_response(self, response):
+        """解析需求拆解的LLM响应（JSON数组），失败返回None"""
+        response = (response or "").replace("'", '"')
         try:
             return json.loads(response)
         except:
             match = re.search(r'\[(.*?)\]', response, re.DOTALL)
             if match:
-                json_str = match.group(0)
                 try:
-                    return json.loads(json_str)
+                    return json.loads(match.group(0))
                 except json.JSONDecodeError:
-                    print("解析JSON失败")
-            return []
+                    pass
+            return None
 
     # === 综合评分与权重推导 ===
     def _district_from_text(self, text: str | None) -> str | None:
@@ -210,9 +272,10 @@ class SiteSelector:
     def _ensure_price_range(self):
         if getattr(self, '_price_min', None) is None or getattr(self, '_price_max', None) is None:
             try:
-                s = pd.to_numeric(self.site_data["价格_万元/㎡"], errors='coerce')
-                vmin = float(np.nanmin(s)) if np.isfinite(np.nanmin(s)) else 0.0
-                vmax = float(np.nanmax(s)) if np.isfinite(np.nanmax(s)) else 1.0
+                # 取自数据集统计清单（按数据集版本预先计算）
+                lo, hi = self._dataset_stats().value_range("价格_万元/㎡")
+                vmin = float(lo) if lo is not None and np.isfinite(lo) else 0.0
+                vmax = float(hi) if hi is not None and np.isfinite(hi) else 1.0
                 if abs(vmax - vmin) < 1e-8:
                     vmax = vmin + 1.0
                 self._price_min, self._price_max = vmin, vmax
@@ -318,6 +381,7 @@ class SiteSelector:
         keywords = ["工厂", "工业", "制造", "生产", "食品", "厂房", "产业园", "工业用地"]
         return any(k in all_text for k in keywords)
 
+    @timed_stage("apply_request_overrides")
     def apply_request_overrides(self, sorted_results: np.ndarray) -> np.ndarray:
         """根据用户显式需求进行用途过滤与交通优先排序。
         - 若需求包含工业/工厂关键词：优先保留土地用途包含“工业”的候选；若过滤为空则回退。
@@ -334,9 +398,8 @@ class SiteSelector:
             if self._intent_industrial() and ('土地用途' in columns):
                 try:
                     idxs = filtered[:, 0].astype(int)
-                    series = self.site_data.loc[idxs, '土地用途'].astype(str)
-                    mask = series.str.contains('工业', na=False)
-                    keep = np.array(mask.values, dtype=bool)
+                    # 经土地用途的倒排索引判定（结果按取值缓存），候选行只做查表
+                    keep = Predicate('土地用途', 'contains', '工业').evaluate(self._column_cache(), idxs)
                     after = filtered[keep]
                     if after.size > 0:
                         print(f"用途过滤(工业)：保留 {int(after.shape[0])}/{int(filtered.shape[0])}")
@@ -390,14 +453,8 @@ class SiteSelector:
             return c in columns
 
         def get_q(col: str, q: float, default: float) -> float:
-            try:
-                s = pd.to_numeric(self.site_data[col], errors='coerce')
-                v = float(s.quantile(q))
-                if np.isnan(v):
-                    return default
-                return v
-            except Exception:
-                return default
+            # 分位数取自数据集统计清单
+            return self._dataset_stats().quantile(col, q, default)
 
         price_low = get_q("价格_万元/㎡", 0.25, 0.0)
         price_high = get_q("价格_万元/㎡", 0.75, 999999.0)
@@ -568,88 +625,34 @@ class SiteSelector:
             self.user_pos_reqs = [self.user_reqs]
             self.user_neg_reqs = [None]
 
+    @timed_stage("load_site_data")
     def load_site_data(self, city_name, dataset_path=None):
         """加载地块数据；支持自定义真实数据路径并标准化列。
         - 若提供 dataset_path（绝对或相对），优先使用；并把同名 .npy 作为embedding路径。
-        - 否则回退到原来的 {city}_{type}.csv/.npy 命名。
+        - 否则按城市解析：CITY_DATASETS 映射，或 {city}_{type}.csv/.npy 命名。
         - 缺失的 name/address/desc 列会从可用列自动拼接生成。
+        数据经进程级注册表加载，同一数据集在文件未变化时跨请求复用，多城市按LRU与内存预算保留。
         """
-        import pandas as pd
         # 解析数据路径
         if dataset_path:
             data_path = dataset_path if os.path.isabs(dataset_path) else os.path.abspath(dataset_path)
             base, ext = os.path.splitext(data_path)
             emb_path = base + ".npy"
+            self.dataset = DATASET_REGISTRY.get(data_path, emb_path=emb_path, proxy=self.proxy)
         else:
-            data_path = os.path.join("model", "data", f'{city_name}_{self.type}.csv')
-            emb_path = os.path.join("model", "data", f'{city_name}_{self.type}.npy')
-        # 缓存路径，便于后续embedding维度不匹配时重算
-        self.data_path = data_path
-        self.emb_path = emb_path
-
-        # 读取CSV数据
-        self.site_data = pd.read_csv(data_path)
-        # 标准化经纬度列
-        if 'lon' not in self.site_data.columns and '经度' in self.site_data.columns:
-            self.site_data = self.site_data.rename(columns={'经度': 'lon'})
-        if 'lat' not in self.site_data.columns and '纬度' in self.site_data.columns:
-            self.site_data = self.site_data.rename(columns={'纬度': 'lat'})
-        # 标准化名称/地址/用途/面积/价格
-        if 'name' not in self.site_data.columns:
-            if '宗地坐落' in self.site_data.columns:
-                self.site_data['name'] = self.site_data['宗地坐落'].astype(str)
-            else:
-                self.site_data['name'] = self.site_data.index.astype(str)
-        if 'address' not in self.site_data.columns:
-            if '宗地坐落' in self.site_data.columns:
-                self.site_data['address'] = self.site_data['宗地坐落'].astype(str)
-            else:
-                self.site_data['address'] = self.site_data['name'].astype(str)
-        # 生成desc/context（当源数据没有时）
-        if 'desc' not in self.site_data.columns:
-            usage = (self.site_data['土地用途'].astype(str) if '土地用途' in self.site_data.columns else pd.Series([''] * len(self.site_data)))
-            area = (self.site_data['宗地面积(平方米)'].astype(str) if '宗地面积(平方米)' in self.site_data.columns else pd.Series([''] * len(self.site_data)))
-            price = (self.site_data['挂牌起始价(万元)'].astype(str) if '挂牌起始价(万元)' in self.site_data.columns else pd.Series([''] * len(self.site_data)))
-            self.site_data['desc'] = (
-                ("用途:" + usage + "，面积:" + area + "㎡，起始价:" + price + "万元").str.strip()
-            )
-        if 'context' not in self.site_data.columns:
-            self.site_data['context'] = (
-                self.site_data['name'].astype(str) + "，地址是" + self.site_data['address'].astype(str) + "，" + self.site_data['desc'].astype(str)
-            )
-        # 填充ID
-        if 'id' not in self.site_data.columns:
-            self.site_data['id'] = self.site_data.index.astype(int)
-
-        # 可选：生成平面坐标x/y（仅当后续启用空间优化时使用）
-        if 'x' not in self.site_data.columns or 'y' not in self.site_data.columns:
-            try:
-                # 简化的近似换算（米）：
-                # x ~ lon * 111320 * cos(lat)
-                # y ~ lat * 110540
-                rad = np.deg2rad(self.site_data['lat'].astype(float))
-                self.site_data['x'] = self.site_data['lon'].astype(float) * 111320.0 * np.cos(rad)
-                self.site_data['y'] = self.site_data['lat'].astype(float) * 110540.0
-            except Exception:
-                pass
-
-        # 读取/生成embedding
-        if os.path.exists(emb_path):
-            self.embedding = np.load(emb_path)
-        else:
-            # 通过SearchEngine计算并保存embedding（支持缺省列的context拼接）
-            se_tmp = SearchEngine(embedding=None, emb_path=emb_path, file_path=data_path, proxy=self.proxy)
-            self.embedding = se_tmp.embedding
+            self.dataset = DATASET_REGISTRY.get_city(city_name, self.type, proxy=self.proxy)
+        # 实际使用的embedding集合由数据集清单按当前provider选择
+        self.data_path = self.dataset.data_path
+        self.emb_path = self.dataset.emb_path
+        self.site_data = self.dataset.site_data
+        self.embedding = self.dataset.embedding
         
         # 初始化 must_see_sites 为索引列表（由约束过滤在候选检索阶段生成）
         self.must_see_sites = []
         
-        # 创建索引映射
-        self.site_data = self.site_data.reset_index(drop=True)
-        row_idx = self.site_data.index.to_numpy()
-        site_id = self.site_data["id"].to_numpy()
-        self.r2i = {key: value for key, value in zip(row_idx, site_id)}
-        self.i2r = {value: key for key, value in zip(row_idx, site_id)}
+        # 索引映射（由注册表预先构建）
+        self.r2i = self.dataset.r2i
+        self.i2r = self.dataset.i2r
 
     def init_safe_inference(self):
         """加载SAFE配置与预测结果，并为站点计算geohash以便匹配。"""
@@ -690,7 +693,8 @@ class SiteSelector:
         else:
             self.safe_enabled = False
             print(f"[SAFE] 未找到预测文件，禁用融合：{predictions_path}")
-        # 计算站点geohash
+        # 计算站点geohash（site_data为注册表共享快照，写入新列前先复制）
+        self.site_data = self.site_data.copy()
         precision = int(self.safe_config.get('geohash_precision', 12)) if self.safe_config else 12
         try:
             self.site_data['geohash'] = [self.encode_geohash(row['lat'], row['lon'], precision) for _, row in self.site_data[['lat','lon']].iterrows()]
@@ -757,6 +761,7 @@ class SiteSelector:
         blended_sorted = blended[blended[:, 1].argsort()[::-1]]
         return blended_sorted
 
+    @timed_stage("get_candidate_sites")
     def get_candidate_sites(self):
         """检索候选地块"""
         # 调试打印：用户需求拆解
@@ -770,52 +775,49 @@ class SiteSelector:
         except Exception:
             pass
         
-        def process_request(pos_req, neg_req):
-            top_k = min(self.site_data.shape[0], self.min_site_candidate_num)
-            req_sites = self.search_engine.query(
-                desc=(pos_req, neg_req if neg_req else ""),
-                top_k=top_k
-            )
+        top_k = min(self.site_data.shape[0], self.min_site_candidate_num)
+        descs = []
+        for i, pos_req in enumerate(self.user_pos_reqs):
+            neg_req = self.user_neg_reqs[i] if i < len(self.user_neg_reqs) else None
+            descs.append((pos_req, neg_req if neg_req else ""))
+
+        # 结构化规则先于检索计算，向量检索只在满足规则的行上打分
+        search_mask = None
+        if self.enable_struct_filters:
+            try:
+                struct_mask = self.compute_struct_mask()
+                if struct_mask is not None and not struct_mask.all():
+                    if struct_mask.any():
+                        search_mask = struct_mask
+                        print(f"结构化约束预过滤：检索范围 {int(struct_mask.sum())}/{struct_mask.shape[0]}")
+                    else:
+                        print("结构化约束预过滤后为空，回退全库检索")
+            except Exception as e:
+                print(f"结构化约束预过滤失败，回退全库检索：{e}")
+
+        # 全部子需求一次embedding请求、一次矩阵乘
+        try:
+            batch_results = self.search_engine.query_batch(descs, top_k=top_k, mask=search_mask)
+        except EmbeddingMismatchError:
+            raise
+        except Exception as e:
+            print(f"处理需求时出错: {e}")
+            batch_results = []
+
+        all_reqs_topk = []
+        pseudo_must_see_sites = []
+        for (pos_req, _), req_sites in zip(descs, batch_results):
+            if req_sites is None or len(req_sites) == 0:
+                continue
             # 打印每条子需求的检索结果（Top-K）
             try:
-                ids = req_sites[:top_k, 0].astype(int).tolist() if req_sites is not None and len(req_sites) > 0 else []
+                ids = req_sites[:top_k, 0].astype(int).tolist()
                 names = self.site_data.loc[ids, 'name'].astype(str).tolist() if ids else []
                 print(f"子需求[{pos_req}] Top-{top_k} 地块: {names}")
             except Exception:
                 pass
-            pseudo_must_see_local = [int(site) for site in req_sites[:2, 0]]
-            return req_sites, pseudo_must_see_local
-        
-        all_reqs_topk = []
-        pseudo_must_see_sites = []
-        
-        # 并发处理多个需求
-        if len(self.user_pos_reqs) > 1:
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                futures = []
-                for i, pos_req in enumerate(self.user_pos_reqs):
-                    neg_req = self.user_neg_reqs[i] if i < len(self.user_neg_reqs) else None
-                    future = executor.submit(process_request, pos_req, neg_req)
-                    futures.append(future)
-                
-                for future in concurrent.futures.as_completed(futures):
-                    try:
-                        req_sites, pseudo_must_see = future.result()
-                        if req_sites is not None and len(req_sites) > 0:
-                            pseudo_must_see_sites.extend(pseudo_must_see)
-                            all_reqs_topk.append(req_sites)
-                    except Exception as e:
-                        print(f"处理需求时出错: {e}")
-                        continue
-        else:
-            neg_req = self.user_neg_reqs[0] if self.user_neg_reqs else None
-            try:
-                req_sites, pseudo_must_see = process_request(self.user_pos_reqs[0], neg_req)
-                if req_sites is not None and len(req_sites) > 0:
-                    pseudo_must_see_sites.extend(pseudo_must_see)
-                    all_reqs_topk.append(req_sites)
-            except Exception as e:
-                print(f"处理需求时出错: {e}")
+            pseudo_must_see_sites.extend(int(site) for site in req_sites[:2, 0])
+            all_reqs_topk.append(req_sites)
         
         # 检查是否有有效结果
         if not all_reqs_topk:
@@ -848,13 +850,15 @@ class SiteSelector:
             self.text_score_max = 1.0
 
         sorted_results = result[result[:, 1].argsort()[::-1]]
+        observe_candidates("retrieval", len(sorted_results))
         
-        # 先应用结构化约束过滤（若启用），减少候选规模并增强语义召回
+        # 应用结构化约束过滤（若启用）；检索已预过滤时仅重新归一文本分数
         if self.enable_struct_filters:
             try:
                 sorted_results = self.apply_struct_filters(sorted_results)
             except Exception as e:
                 print(f"结构化约束过滤失败，回退原结果：{e}")
+            observe_candidates("struct_filters", len(sorted_results))
         else:
             try:
                 print("结构化约束过滤已关闭")
@@ -869,6 +873,7 @@ class SiteSelector:
                 print(f"需求覆盖失败，回退原结果：{e}")
             except Exception:
                 pass
+        observe_candidates("request_overrides", len(sorted_results))
 
         # 与SAFE概率融合（暂时禁用）
         # try:
@@ -885,14 +890,19 @@ class SiteSelector:
         
         return sorted_results, pseudo_must_see_sites
 
-    def apply_struct_filters(self, sorted_results: np.ndarray) -> np.ndarray:
-        """LLM增强的结构化过滤：
+    @timed_stage("struct_mask")
+    def compute_struct_mask(self):
+        """将硬性约束转为全库结构化掩码（每个请求只计算一次）：
         - 使用DeepSeek将硬性约束映射为列级规则，并生成同义文本用于语义检索增强。
-        - 计算结构化掩码并过滤候选，保留满足度更高的地块；保存同义词以供硬性约束文本过滤使用。
-        - 计算结构化满足度(每站点满足的规则数/总规则数)，用于后续加权（可选）。
+        - 规则编译为谓词计划（model.rules），按选择度排序并短路求值。
+
+        Returns:
+            np.ndarray | None: (N,) bool掩码；无可用规则时为None。
         """
-        if not isinstance(sorted_results, np.ndarray) or sorted_results.size == 0:
-            return sorted_results
+        if getattr(self, '_struct_mask_ready', False):
+            return self.struct_mask
+        self._struct_mask_ready = True
+        self.struct_mask = None
 
         columns = self.site_data.columns.tolist()
         has_constraints = hasattr(self, 'hard_constraints') and len(self.hard_constraints) > 0
@@ -911,19 +921,42 @@ class SiteSelector:
             except Exception:
                 samples = {}
 
-            prompt = self.get_struct_constraint_prompt(constraints=self.hard_constraints, columns=columns, samples=samples)
-            messages = [
-                {"role": "system", "content": "你是专业的选址约束工程师，输出严格JSON"},
-                {"role": "user", "content": prompt}
-            ]
-            try:
-                resp = self.deepseek_client.chat_json(messages=messages, model="deepseek-chat")
-                parsed = json.loads(resp)
-                llm_rules = parsed.get("rules", []) or []
-                self.synonyms_map = parsed.get("synonyms", {}) or {}
-            except Exception as e:
-                print(f"LLM结构化解析失败：{e}")
-                llm_rules = []
+            # 相同约束在同一数据集schema下的映射结果直接复用，跳过LLM调用
+            cache = struct_rules_cache_from_env()
+            key = struct_rules_cache_key(
+                self.hard_constraints, columns, [str(t) for t in self.site_data.dtypes], samples, "deepseek-chat"
+            )
+            cached = None
+            if cache is not None:
+                try:
+                    cached = cache.get_json(key)
+                except Exception:
+                    cached = None
+                CACHE_REQUESTS.inc(cache="struct_rules", result="hit" if cached is not None else "miss")
+
+            if cached is not None:
+                llm_rules = cached.get("rules", []) or []
+                self.synonyms_map = cached.get("synonyms", {}) or {}
+            else:
+                prompt = self.get_struct_constraint_prompt(constraints=self.hard_constraints, columns=columns, samples=samples)
+                messages = [
+                    {"role": "system", "content": "你是专业的选址约束工程师，输出严格JSON"},
+                    {"role": "user", "content": prompt}
+                ]
+                try:
+                    resp = self.deepseek_client.chat_json(messages=messages, model="deepseek-chat")
+                    parsed = json.loads(resp)
+                    llm_rules = parsed.get("rules", []) or []
+                    self.synonyms_map = parsed.get("synonyms", {}) or {}
+                except Exception as e:
+                    print(f"LLM结构化解析失败：{e}")
+                    llm_rules = []
+                # 只缓存成功解析且非空的结果，失败或空响应下次重试
+                if cache is not None and (llm_rules or self.synonyms_map):
+                    try:
+                        cache.set_json(key, {"rules": llm_rules, "synonyms": self.synonyms_map})
+                    except Exception as e:
+                        print(f"约束规则缓存写入失败：{e}")
 
             rules = pre_rules + llm_rules
             try:
@@ -935,7 +968,7 @@ class SiteSelector:
             if len(pre_rules) > 0:
                 print(f"结构化约束：使用预设规则 {len(pre_rules)} 条（未启用LLM或无硬性约束）")
             else:
-                return sorted_results
+                return None
 
         # 打印结构化约束解析摘要
         try:
@@ -944,96 +977,54 @@ class SiteSelector:
             pass
         if len(rules) == 0:
             # 无规则则不做结构化过滤
-            return sorted_results
-
-        N = self.site_data.shape[0]
-        # 初始化结构化满足度计数
-        satisfied = np.zeros(N, dtype=float)
-        total_rules = 0
-        # 累积掩码，默认全保留
-        struct_mask = np.ones(N, dtype=bool)
-
-        def to_numeric_series(series: pd.Series) -> pd.Series:
-            try:
-                return pd.to_numeric(series, errors='coerce')
-            except Exception:
-                return pd.Series([np.nan] * len(series))
-
-        for r in rules:
-            col = r.get("column")
-            op = (r.get("op") or "").lower()
-            val = r.get("value")
-            neg = bool(r.get("negative", False))
-            conf = float(r.get("confidence", 0.0))
-            if col not in columns or conf < 0.3:
-                continue
-            series = self.site_data[col]
-            mask = np.ones(N, dtype=bool)
-            try:
-                if op in ["<=", ">=", "<", ">"]:
-                    s_num = to_numeric_series(series)
-                    v_num = None
-                    try:
-                        v_num = float(val)
-                    except Exception:
-                        v_num = np.nan
-                    if np.isnan(v_num):
-                        continue
-                    if op == "<=":
-                        mask = (s_num <= v_num)
-                    elif op == ">=":
-                        mask = (s_num >= v_num)
-                    elif op == "<":
-                        mask = (s_num < v_num)
-                    elif op == ">":
-                        mask = (s_num > v_num)
-                elif op == "==":
-                    mask = series.astype(str).str.lower() == str(val).lower()
-                elif op == "contains":
-                    mask = series.astype(str).str.contains(str(val), case=False, na=False)
-                elif op == "regex":
-                    try:
-                        mask = series.astype(str).str.contains(str(val), flags=re.I, na=False)
-                    except Exception:
-                        mask = series.astype(str).str.contains(str(val), case=False, na=False)
-                elif op == "in":
-                    values = val if isinstance(val, list) else [val]
-                    values = [str(v) for v in values if v is not None]
-                    if len(values) == 0:
-                        continue
-                    comb = np.zeros(N, dtype=bool)
-                    base = series.astype(str).str.lower()
-                    for v in values:
-                        comb = comb | base.str.contains(v.lower(), na=False)
-                    mask = comb
-                else:
-                    # 未知操作符，跳过
-                    continue
-            except Exception:
-                continue
-
-            total_rules += 1
-            if neg:
-                struct_mask = struct_mask & (~mask)
-                satisfied += (~mask).astype(float)
-            else:
-                struct_mask = struct_mask & mask
-                satisfied += mask.astype(float)
+            return None
 
-        if total_rules > 0:
-            struct_score = satisfied / float(total_rules)
-        else:
-            struct_score = np.ones(N, dtype=float)
+        # 规则编译为列级谓词计划（按规则集哈希随数据集缓存），满足度留到候选阶段只对候选行计算
+        self.struct_plan = self._column_cache().plan(rules, columns)
+        self.struct_mask = self.struct_plan.mask(self._column_cache())
+        return self.struct_mask
+
+    def _dataset_stats(self) -> DatasetStats:
+        """数据集统计清单；未经注册表加载时按当前数据计算一次"""
+        stats = getattr(getattr(self, 'dataset', None), 'stats', None)
+        if stats is None:
+            stats = getattr(self, '_local_stats', None)
+            if stats is None:
+                stats = self._local_stats = DatasetStats.from_frame(self.site_data)
+        return stats
+
+    def _column_cache(self) -> ColumnCache:
+        """数据集共享的类型化列缓存；未经注册表加载时按当前数据构建"""
+        cache = getattr(getattr(self, 'dataset', None), 'column_cache', None)
+        if cache is None or cache.frame is not self.site_data:
+            cache = getattr(self, '_local_column_cache', None)
+            if cache is None or cache.frame is not self.site_data:
+                cache = self._local_column_cache = ColumnCache(self.site_data, stats=self._dataset_stats())
+        return cache
+
+    @timed_stage("apply_struct_filters")
+    def apply_struct_filters(self, sorted_results: np.ndarray) -> np.ndarray:
+        """LLM增强的结构化过滤：
+        - 用 compute_struct_mask 的全库掩码过滤候选，保留满足规则的地块。
+        - 只对候选行计算结构化满足度(每站点满足的规则数/总规则数)，用于后续加权（可选）。
+        - 检索已按掩码预过滤时此处不再删减候选，仅按文本分数重新归一排序。
+        """
+        if not isinstance(sorted_results, np.ndarray) or sorted_results.size == 0:
+            return sorted_results
+        struct_mask = self.compute_struct_mask()
+        if struct_mask is None:
+            return sorted_results
 
-        # 缓存结构化满足度，便于后续推荐解释
+        # 缓存候选行的结构化满足度，便于后续推荐解释
+        cand_rows = sorted_results[:, 0].astype(int)
         try:
-            self.struct_score_by_index = {int(i): float(struct_score[int(i)]) for i in range(N)}
+            cand_scores = self.struct_plan.scores(self._column_cache(), cand_rows)
+            self.struct_score_by_index = {int(i): float(v) for i, v in zip(cand_rows, cand_scores)}
         except Exception:
             self.struct_score_by_index = {}
 
         # 在候选排序上应用掩码
-        keep_set = {int(i) for i in np.where(struct_mask)[0].tolist()}
-        mask_res = np.array([int(i) in keep_set for i in sorted_results[:, 0]])
+        mask_res = struct_mask[cand_rows]
         filtered = sorted_results[mask_res]
         try:
             print(f"结构化约束过滤后数量：{int(filtered.shape[0])}/{int(sorted_results.shape[0])}")
@@ -1086,8 +1077,9 @@ class SiteSelector:
                     syns = self.synonyms_map.get(text, []) or []
                 queries = [text] + [s for s in syns if isinstance(s, str) and s.strip() != '']
                 union_top = set()
-                for qtxt in queries:
-                    q = self.search_engine.query(desc=(qtxt, ""), top_k=None)
+                # 原文与同义词一次批量检索
+                batch = self.search_engine.query_batch([(qtxt, "") for qtxt in queries], top_k=None)
+                for q in batch:
                     if q.size == 0:
                         continue
                     k = max(1, int(len(q) * top_frac))
@@ -1102,7 +1094,7 @@ class SiteSelector:
                     keep_set = keep_set.intersection(set(top_indices))
                     # 选择一个锚点：对queries中第一个检索的top-1作为锚点（若存在）
                     try:
-                        q0 = self.search_engine.query(desc=(queries[0], ""), top_k=None)
+                        q0 = batch[0]
                         if q0.size > 0:
                             anchor_sites.append(int(q0[0, 0]))
                     except Exception:
@@ -1136,6 +1128,7 @@ class SiteSelector:
 
         return filtered
 
+    @timed_stage("optimize_site_selection")
     def optimize_site_selection(self, req_topk_sites, pseudo_must_see):
         """空间优化选址"""
         # 若关闭空间优化，采用简化策略：按分数排序取Top-K，并可选地做最小间距NMS，始终包含must_see
@@ -1219,6 +1212,7 @@ class SiteSelector:
 
         return sites, scores, clusters
 
+    @timed_stage("generate_site_order")
     def generate_site_order(self, sites, clusters):
         """生成地块访问顺序"""
         # 关闭访问顺序生成时，保持当前排序并返回单一聚类
@@ -1252,9 +1246,8 @@ class SiteSelector:
         
         return sites, new_clusters_order, clusters
 
-    def generate_recommendation(self, ordered_sites, clusters):
-        """生成推荐报告"""
-        
+    def get_recommendation_messages(self, ordered_sites):
+        """构造推荐报告的LLM消息"""
         # 准备候选地块信息
         context_string = ""
         for i, site_id in enumerate(ordered_sites[:self.maxSiteNum]):
@@ -1277,91 +1270,122 @@ class SiteSelector:
             numCandidates=len(ordered_sites)
         )
         
-        # 调用LLM
-        messages = [
+        return [
             {"role": "system", "content": "你是专业的选址顾问"},
             {"role": "user", "content": prompt}
         ]
-        
-        response = self.proxy.chat(messages=messages, model=self.MODEL)
-        
+
+    def parse_recommendation_response(self, response):
+        """解析LLM返回的推荐JSON，失败返回None"""
         try:
-            result = json.loads(response)
+            return json.loads(response)
         except:
             try:
-                result = json.loads(response[8:-4])
+                return json.loads(response[8:-4])
             except:
-                print("无法解析JSON响应")
-                return {"error": response}
-        
-        # 归一化文本分数到[1,10]（用于展示与缺省回填）
-        def norm_score(sid: int):
-            s = self.text_score_map.get(int(sid))
-            if s is None:
-                return 5.0
-            denom = (self.text_score_max - self.text_score_min)
-            if denom <= 1e-8:
-                return 5.0
-            return 1.0 + 9.0 * ((s - self.text_score_min) / denom)
-
-        # 添加坐标与GeoJSON，便于前端地图可视化，并按分数高低排序展示
+                return None
+
+    def _text_norm_score(self, sid: int):
+        """归一化文本分数到[1,10]（用于展示与缺省回填）"""
+        s = self.text_score_map.get(int(sid))
+        if s is None:
+            return 5.0
+        denom = (self.text_score_max - self.text_score_min)
+        if denom <= 1e-8:
+            return 5.0
+        return 1.0 + 9.0 * ((s - self.text_score_min) / denom)
+
+    def rank_display_sites(self, ordered_sites):
+        """计算展示地块的最终分并排序（不依赖LLM输出）。
+        final = w_vector*text_norm + w_poi*poi_score（poi含综合分与规则分）
+        返回 (display_ids, score_by_id, breakdown_by_id)，breakdown中附带权重。
+        """
+        display_ids = list(ordered_sites[:self.maxSiteNum])
+        weights_poi = self.derive_scoring_weights()
+        # 若明确强调交通便利，则在POI综合分中强化交通权重
         try:
-            enriched_sites = {}
-            features = []
-            # 计算最终展示分：final = w_vector*text_norm + w_poi*poi_score（poi含综合分与规则分）
-            display_ids = list(ordered_sites[:self.maxSiteNum])
-            weights_poi = self.derive_scoring_weights()
-            # 若明确强调交通便利，则在POI综合分中强化交通权重
+            if self._intent_prioritize_traffic():
+                weights_poi = {'traffic': 0.80, 'price': 0.15, 'region': 0.05}
+        except Exception:
+            pass
+        final_w_vector = float(self.blend_w_text)
+        final_w_poi = float(1.0 - final_w_vector)
+        poi_struct_ratio = 0.2  # POI内规则分占比，结构化满足度归一到[1,10]
+
+        # 预先计算每个地块的最终分，便于排序
+        score_by_id = {}
+        breakdown_by_id = {}
+        for sid in display_ids:
+            sid_int = int(sid)
+            t_norm = self._text_norm_score(sid_int)
+            comp_s = self.composite_score(sid_int, weights_poi)
+            struct_raw = None
+            if hasattr(self, 'struct_score_by_index') and isinstance(self.struct_score_by_index, dict):
+                struct_raw = self.struct_score_by_index.get(sid_int)
+            struct_norm = (1.0 + 9.0 * float(struct_raw)) if (struct_raw is not None) else None
+            if struct_norm is not None:
+                poi_s = float((1.0 - poi_struct_ratio) * comp_s + poi_struct_ratio * struct_norm)
+            else:
+                poi_s = float(comp_s)
+            final_s = final_w_vector * (t_norm if t_norm is not None else 5.0) + final_w_poi * poi_s
+            final_s = float(np.clip(final_s, 1.0, 10.0))
+            score_by_id[sid_int] = final_s
+            breakdown_by_id[sid_int] = {
+                'text_norm': t_norm,
+                'poi_composite': comp_s,
+                'struct_norm': struct_norm,
+                'poi_score': poi_s,
+                'final_score': final_s,
+                'w_vector': float(final_w_vector),
+                'w_poi': float(final_w_poi),
+                'poi_struct_ratio': float(poi_struct_ratio)
+            }
+        # 按最终分排序（高到低）；若显式强调交通便利，则按交通分重排
+        try:
+            if self._intent_prioritize_traffic() and ('交通_便利评分(0-10)' in self.site_data.columns):
+                def traffic_s(sid):
+                    try:
+                        v = float(self.site_data.loc[int(sid), '交通_便利评分(0-10)'])
+                        return float(np.clip(v, 0.0, 10.0))
+                    except Exception:
+                        return -float('inf')
+                display_ids.sort(key=lambda sid: traffic_s(sid), reverse=True)
+            else:
+                display_ids.sort(key=lambda sid: score_by_id.get(int(sid), -float('inf')), reverse=True)
+        except Exception:
+            pass
+        return display_ids, score_by_id, breakdown_by_id
+
+    def site_summaries(self, site_ids, score_by_id=None):
+        """地块的id/名称/坐标/分数摘要，用于流式阶段事件"""
+        out = []
+        for sid in site_ids:
             try:
-                if self._intent_prioritize_traffic():
-                    weights_poi = {'traffic': 0.80, 'price': 0.15, 'region': 0.05}
-            except Exception:
-                pass
-            final_w_vector = float(self.blend_w_text)
-            final_w_poi = float(1.0 - final_w_vector)
-            poi_struct_ratio = 0.2  # POI内规则分占比，结构化满足度归一到[1,10]
-
-            # 预先计算每个地块的最终分，便于排序
-            score_by_id = {}
-            poi_by_id = {}
-            breakdown_by_id = {}
-            for sid in display_ids:
-                sid_int = int(sid)
-                t_norm = norm_score(sid_int)
-                comp_s = self.composite_score(sid_int, weights_poi)
-                struct_raw = None
-                if hasattr(self, 'struct_score_by_index') and isinstance(self.struct_score_by_index, dict):
-                    struct_raw = self.struct_score_by_index.get(sid_int)
-                struct_norm = (1.0 + 9.0 * float(struct_raw)) if (struct_raw is not None) else None
-                if struct_norm is not None:
-                    poi_s = float((1.0 - poi_struct_ratio) * comp_s + poi_struct_ratio * struct_norm)
-                else:
-                    poi_s = float(comp_s)
-                final_s = final_w_vector * (t_norm if t_norm is not None else 5.0) + final_w_poi * poi_s
-                final_s = float(np.clip(final_s, 1.0, 10.0))
-                score_by_id[sid_int] = final_s
-                poi_by_id[sid_int] = poi_s
-                breakdown_by_id[sid_int] = {
-                    'text_norm': t_norm,
-                    'poi_composite': comp_s,
-                    'struct_norm': struct_norm,
-                    'poi_score': poi_s,
-                    'final_score': final_s
+                row = self.site_data.loc[int(sid)]
+                item = {
+                    'index': int(sid),
+                    'id': str(row['id']) if 'id' in row else str(sid),
+                    'name': str(row.get('name') or row.get('宗地坐落') or f"地块{sid}"),
+                    'lon': float(row['lon']),
+                    'lat': float(row['lat']),
                 }
-            # 按最终分排序（高到低）；若显式强调交通便利，则按交通分重排
-            try:
-                if self._intent_prioritize_traffic() and ('交通_便利评分(0-10)' in self.site_data.columns):
-                    def traffic_s(sid):
-                        try:
-                            v = float(self.site_data.loc[int(sid), '交通_便利评分(0-10)'])
-                            return float(np.clip(v, 0.0, 10.0))
-                        except Exception:
-                            return -float('inf')
-                    display_ids.sort(key=lambda sid: traffic_s(sid), reverse=True)
+                if score_by_id is not None:
+                    item['score'] = score_by_id.get(int(sid))
                 else:
-                    display_ids.sort(key=lambda sid: score_by_id.get(int(sid), -float('inf')), reverse=True)
+                    item['score'] = self._text_norm_score(int(sid))
+                out.append(item)
             except Exception:
-                pass
+                continue
+        return out
+
+    def enrich_recommendation(self, result, ordered_sites, ranked=None):
+        """为LLM推荐结果补充坐标、最终分与GeoJSON，便于前端地图可视化"""
+        try:
+            enriched_sites = {}
+            features = []
+            if ranked is None:
+                ranked = self.rank_display_sites(ordered_sites)
+            display_ids, score_by_id, breakdown_by_id = ranked
             # 解释项准备
             debug_scores = {}
 
@@ -1385,10 +1409,10 @@ class SiteSelector:
                     site_entry['name'] = site_entry.get('name') or f"地块{key}"
                 # 分数字段使用最终分（覆盖LLM分），确保展示逻辑一致
                 try:
-                    site_entry['score'] = float(score_by_id.get(int(site_id), norm_score(site_id)))
+                    site_entry['score'] = float(score_by_id.get(int(site_id), self._text_norm_score(site_id)))
                 except Exception:
                     try:
-                        ns = norm_score(site_id)
+                        ns = self._text_norm_score(site_id)
                         site_entry['score'] = float(ns) if ns is not None else float('nan')
                     except Exception:
                         pass
@@ -1402,17 +1426,9 @@ class SiteSelector:
 
                 # 解释项：最终分拆解（向量/POI/规则）
                 try:
-                    bd = breakdown_by_id.get(int(site_id), {})
-                    debug_scores[str(site_id)] = {
-                        'text_norm': bd.get('text_norm'),
-                        'poi_composite': bd.get('poi_composite'),
-                        'struct_norm': bd.get('struct_norm'),
-                        'poi_score': bd.get('poi_score'),
-                        'final_score': bd.get('final_score'),
-                        'w_vector': float(final_w_vector),
-                        'w_poi': float(final_w_poi),
-                        'poi_struct_ratio': float(poi_struct_ratio)
-                    }
+                    bd = breakdown_by_id.get(int(site_id))
+                    if bd is not None:
+                        debug_scores[str(site_id)] = dict(bd)
                 except Exception:
                     pass
 
@@ -1444,6 +1460,22 @@ class SiteSelector:
         
         return result
 
+    @timed_stage("generate_recommendation")
+    def generate_recommendation(self, ordered_sites, clusters):
+        """生成推荐报告"""
+        messages = self.get_recommendation_messages(ordered_sites)
+        
+        # 调用LLM
+        response = self.proxy.chat(messages=messages, model=self.MODEL,
+                                   validate=lambda r: self.parse_recommendation_response(r) is not None)
+        
+        result = self.parse_recommendation_response(response)
+        if result is None:
+            print("无法解析JSON响应")
+            return {"error": response}
+        
+        return self.enrich_recommendation(result, ordered_sites)
+
     def get_recommendation_prompt(self, context_string, must_see_string, 
                                  keyword_reqs, userReqList, 
                                  maxSiteNum, numMustSee, numCandidates):
@@ -1490,22 +1522,8 @@ class SiteSelector:
 请按JSON格式输出，每个地块评分1-10分。
 """
 
-    def solve(self):
-        """执行完整的选址推荐流程"""
-        
-        print("Step 1: 检索候选地块...")
-        req_topk_sites, pseudo_must_see = self.get_candidate_sites()
-        print(f"✓ 找到 {len(req_topk_sites)} 个候选地块")
-        
-        print("Step 2: 空间优化选址...")
-        if not self.enable_spatial_optimization:
-            print("✓ 按评分直接选取Top-K")
-        sites, scores, clusters = self.optimize_site_selection(
-            req_topk_sites, pseudo_must_see
-        )
-        print(f"✓ 保留 {len(sites)} 个地块")
-
-        # —— 打印POI与规则算分（综合分拆解 + 结构化满足度 + 核心POI指标）——
+    def print_score_breakdown(self, sites):
+        """打印POI与规则算分（综合分拆解 + 结构化满足度 + 核心POI指标）"""
         try:
             weights = self.derive_scoring_weights()
             print("\n[调试] 候选地块得分拆解（按保留顺序，最多展示前10个）：")
@@ -1576,7 +1594,26 @@ class SiteSelector:
                 print(f"[调试] 分解打印失败: {e}")
             except Exception:
                 pass
+
+    @timed_stage("solve")
+    def solve(self):
+        """执行完整的选址推荐流程"""
+        
+        print("Step 1: 检索候选地块...")
+        req_topk_sites, pseudo_must_see = self.get_candidate_sites()
+        print(f"✓ 找到 {len(req_topk_sites)} 个候选地块")
         
+        print("Step 2: 空间优化选址...")
+        if not self.enable_spatial_optimization:
+            print("✓ 按评分直接选取Top-K")
+        sites, scores, clusters = self.optimize_site_selection(
+            req_topk_sites, pseudo_must_see
+        )
+        print(f"✓ 保留 {len(sites)} 个地块")
+        observe_candidates("spatial", len(sites))
+
+        self.print_score_breakdown(sites)
+
         # 访问顺序生成（静默）
         ordered_sites, clusters_order, clusters = self.generate_site_order(
             sites, clusters
@@ -1591,4 +1628,63 @@ class SiteSelector:
         print("=" * 60)
         print(json.dumps(recommendation, ensure_ascii=False, indent=2))
         
-        return recommendation
\ No newline at end of file
+        return recommendation
+
+    def solve_stream(self):
+        """流式执行选址推荐流程，逐阶段产出 (事件名, 数据)：
+        - requirements: 需求解析结果（构造SiteSelector时已完成）
+        - candidates: 检索得到的候选地块id与坐标
+        - sites: 空间优化后的最终地块及最终分（不依赖LLM）
+        - token: 推荐报告的LLM增量文本
+        - result: 与 solve() 相同结构的完整结果
+        """
+        yield "requirements", {
+            "pos": self.user_pos_reqs,
+            "neg": self.user_neg_reqs,
+            "hard_constraints": self.hard_constraints,
+        }
+
+        req_topk_sites, pseudo_must_see = self.get_candidate_sites()
+        candidate_ids = req_topk_sites[:, 0].astype(int).tolist() if len(req_topk_sites) > 0 else []
+        yield "candidates", {"sites": self.site_summaries(candidate_ids)}
+
+        sites, scores, clusters = self.optimize_site_selection(
+            req_topk_sites, pseudo_must_see
+        )
+        observe_candidates("spatial", len(sites))
+        ordered_sites, clusters_order, clusters = self.generate_site_order(
+            sites, clusters
+        )
+        ranked = self.rank_display_sites(ordered_sites)
+        display_ids, score_by_id, _ = ranked
+        yield "sites", {"sites": self.site_summaries(display_ids, score_by_id)}
+
+        # 只统计报告生成本身（提示词、取增量、解析），不含客户端读取每个token的时间
+        timer = StageTimer("generate_recommendation")
+        chunks = []
+        try:
+            with timer.measure():
+                messages = self.get_recommendation_messages(ordered_sites)
+                tokens = iter(self.proxy.stream_chat(
+                    messages=messages, model=self.MODEL,
+                    validate=lambda r: self.parse_recommendation_response(r) is not None
+                ))
+            while True:
+                with timer.measure():
+                    token = next(tokens, None)
+                if token is None:
+                    break
+                chunks.append(token)
+                yield "token", {"text": token}
+
+            with timer.measure():
+                response = "".join(chunks)
+                result = self.parse_recommendation_response(response)
+                if result is None:
+                    print("无法解析JSON响应")
+                    result = {"error": response}
+                else:
+                    result = self.enrich_recommendation(result, ordered_sites, ranked=ranked)
+        finally:
+            timer.observe()
+        yield "result", result
@@ -0,0 +1,151 @@
+"""
+数据集统计清单 x.stats.json：每个数值列的行数、空值数、最小/最大值、常用分位数与直方图
+按数据集版本（CSV大小与修改时间）生成一次，评分归一、预设规则阈值与规则选择度估计直接读取
+"""
+
+import os
+import json
+import numpy as np
+import pandas as pd
+
+STATS_VERSION = 1
+QUANTILES = (0.05, 0.1, 0.25, 0.5, 0.75, 0.9, 0.95)
+HIST_BINS = 32
+
+
+def stats_path_for(data_path: str) -> str:
+    """数据集对应的统计清单：data/x.csv -> data/x.stats.json"""
+    return os.path.splitext(data_path)[0] + ".stats.json"
+
+
+def _source_signature(data_path: str) -> dict:
+    st = os.stat(data_path)
+    return {"file": os.path.basename(data_path), "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def column_stats(values: np.ndarray) -> dict:
+    """单个数值列的统计（inf单独计数，最小/最大值与直方图只取有限值，分位数与 pandas quantile 一致含inf）"""
+    values = np.asarray(values, dtype=np.float64)
+    present = values[~np.isnan(values)]
+    finite = present[np.isfinite(present)]
+    entry = {
+        "count": int(values.size),
+        "nulls": int(values.size - present.size),
+        "posinf": int((present == np.inf).sum()),
+        "neginf": int((present == -np.inf).sum()),
+        "min": float(finite.min()) if finite.size else None,
+        "max": float(finite.max()) if finite.size else None,
+        "mean": float(finite.mean()) if finite.size else None,
+        "quantiles": {},
+        "histogram": None,
+    }
+    if present.size:
+        ordered = np.sort(present)
+        with np.errstate(invalid='ignore'):
+            qs = np.quantile(ordered, QUANTILES)
+        entry["quantiles"] = {str(q): (float(v) if not np.isnan(v) else None) for q, v in zip(QUANTILES, qs)}
+    if finite.size:
+        counts, edges = np.histogram(finite, bins=HIST_BINS)
+        entry["histogram"] = {"edges": edges.tolist(), "counts": counts.tolist()}
+    return entry
+
+
+class DatasetStats:
+    """数值列统计的只读视图。
+
+    Args:
+        columns (dict): 列名 -> column_stats 结果。
+        source (dict, optional): 生成统计的CSV签名。
+    """
+
+    def __init__(self, columns: dict, source: dict = None):
+        self.columns = columns
+        self.source = source
+
+    @classmethod
+    def from_frame(cls, frame: pd.DataFrame, source: dict = None) -> "DatasetStats":
+        columns = {}
+        for name in frame.columns:
+            series = frame[name]
+            if pd.api.types.is_numeric_dtype(series.dtype) and not pd.api.types.is_bool_dtype(series.dtype) \
+                    and not isinstance(series.dtype, pd.CategoricalDtype):
+                columns[str(name)] = column_stats(series.to_numpy(dtype=np.float64))
+        return cls(columns, source)
+
+    @classmethod
+    def load(cls, path: str) -> "DatasetStats":
+        with open(path, 'r', encoding='utf-8') as f:
+            raw = json.load(f)
+        if raw.get("version") != STATS_VERSION:
+            raise ValueError(f"统计清单版本不匹配: {raw.get('version')}")
+        return cls(raw.get("columns") or {}, raw.get("source"))
+
+    def save(self, path: str):
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({"version": STATS_VERSION, "source": self.source, "columns": self.columns}, f, ensure_ascii=False, indent=2)
+            f.write("\n")
+        os.replace(tmp, path)
+
+    def column(self, name: str) -> dict:
+        return self.columns.get(name)
+
+    def value_range(self, name: str) -> tuple:
+        """(min, max)，与 nanmin/nanmax 一致：含inf时对应端为±inf；无数据时为 (None, None)"""
+        col = self.columns.get(name)
+        if not col or (col["min"] is None and not col["posinf"] and not col["neginf"]):
+            return None, None
+        vmin = -np.inf if col["neginf"] else (col["min"] if col["min"] is not None else np.inf)
+        vmax = np.inf if col["posinf"] else (col["max"] if col["max"] is not None else -np.inf)
+        return vmin, vmax
+
+    def quantile(self, name: str, q: float, default: float = None) -> float:
+        """预先计算的分位数；列或分位点不存在时返回default"""
+        col = self.columns.get(name)
+        v = (col or {}).get("quantiles", {}).get(str(q))
+        return default if v is None else float(v)
+
+    def estimate_count(self, name: str, op: str, value: float) -> int:
+        """按直方图估计满足 `列 op value` 的行数（桶内线性插值）；列无统计时返回None"""
+        col = self.columns.get(name)
+        if not col:
+            return None
+        present = col["count"] - col["nulls"]
+        below = float(col["neginf"])
+        hist = col.get("histogram")
+        if hist:
+            edges = np.asarray(hist["edges"], dtype=np.float64)
+            counts = np.asarray(hist["counts"], dtype=np.float64)
+            if value >= edges[-1]:
+                below += counts.sum()
+            elif value > edges[0]:
+                i = int(np.searchsorted(edges, value, side='right')) - 1
+                width = edges[i + 1] - edges[i]
+                below += counts[:i].sum() + (counts[i] * (value - edges[i]) / width if width > 0 else counts[i])
+        if value == np.inf:
+            below += col["posinf"] if op == "<=" else 0
+        if op in ("<=", "<"):
+            return int(round(below))
+        return int(round(present - below))
+
+
+def load_stats(data_path: str, frame: pd.DataFrame) -> DatasetStats:
+    """读取与当前CSV一致的统计清单，缺失或过期时由frame重新计算并写入"""
+    path = stats_path_for(data_path)
+    try:
+        source = _source_signature(data_path)
+    except OSError:
+        source = None
+    try:
+        stats = DatasetStats.load(path)
+        if source is not None and stats.source == source:
+            return stats
+    except (OSError, ValueError, KeyError):
+        pass
+    print(f"[Stats] 生成统计清单: {path}")
+    stats = DatasetStats.from_frame(frame, source)
+    try:
+        stats.save(path)
+    except OSError as e:
+        print(f"[Stats] 统计清单写入失败: {e}")
+    return stats
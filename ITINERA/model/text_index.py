@@ -0,0 +1,156 @@
+"""
+文本列的字符n-gram倒排索引：建在列的去重取值（字典）上，n-gram -> 取值编号的倒排表，取值编号 -> 行号
+子串/多值 in 谓词变为倒排表求交，正则只在n-gram筛出的候选取值上逐个匹配，代价随命中数增长而非随表大小
+"""
+
+import re
+import numpy as np
+
+try:
+    import re._parser as sre_parse
+    from re._constants import LITERAL, SUBPATTERN, BRANCH
+except ImportError:  # Python < 3.11
+    import sre_parse
+    from sre_constants import LITERAL, SUBPATTERN, BRANCH
+
+
+def _grams(text: str, n: int) -> set:
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def _required_literals(items) -> list:
+    """一段正则中每个匹配必然包含其一的字面量列表；无法确定时返回None"""
+    options = []
+    run = ""
+    for op, av in list(items) + [(None, None)]:
+        if op is LITERAL:
+            # 解析原始正则后只对提取出的字面量小写（先小写整个正则会破坏 \A、\N{...} 等转义）
+            run += chr(av).lower()
+            continue
+        if run:
+            options.append([run])
+            run = ""
+        if op is SUBPATTERN:
+            sub = _required_literals(av[-1])
+        elif op is BRANCH:
+            alts = [_required_literals(b) for b in av[1]]
+            sub = None if any(a is None for a in alts) else [lit for a in alts for lit in a]
+        else:
+            sub = None
+        if sub:
+            options.append(sub)
+    if not options:
+        return None
+    # 取最短备选最长的一组：字面量越长，倒排表求交后的候选越少
+    return max(options, key=lambda alts: min(len(a) for a in alts))
+
+
+def required_literals(pattern: str) -> list:
+    """正则的必需字面量备选（小写）；解析失败或无必需字面量时返回None"""
+    try:
+        return _required_literals(sre_parse.parse(pattern))
+    except (re.error, RecursionError, TypeError, ValueError):
+        return None
+
+
+def _sorted_unique(a: np.ndarray) -> np.ndarray:
+    # 排序后去相邻重复（大数组上比 np.unique 稳定地快）
+    a = np.sort(a)
+    return a[np.concatenate(([True], a[1:] != a[:-1]))] if a.size else a
+
+
+class NgramIndex:
+    """单列的n-gram倒排索引。
+
+    Args:
+        values (np.ndarray): 去重后的字符串取值（编号即下标）。
+        codes (np.ndarray): (n_rows,) 每行的取值编号，-1表示空值。
+    """
+
+    def __init__(self, values: np.ndarray, codes: np.ndarray):
+        self.values = values
+        self._build_postings([str(v).lower() for v in values])
+        # 按取值编号分组的行号（CSR）：某取值的行为 order[offsets[v]:offsets[v + 1]]
+        valid = codes >= 0
+        self.order = np.flatnonzero(valid)[np.argsort(codes[valid], kind='stable')].astype(np.int64)
+        self.offsets = np.concatenate(([0], np.cumsum(np.bincount(codes[valid], minlength=len(values))))).astype(np.int64)
+
+    def _build_postings(self, lowered: list):
+        """向量化构建倒排表：所有取值拼接为码点数组，逐位置生成一元/二元组键，
+        与取值编号打包为int64后一次排序完成分组与去重"""
+        lengths = np.fromiter((len(t) for t in lowered), dtype=np.int64, count=len(lowered))
+        cps = np.frombuffer("\x00".join(lowered).encode('utf-32-le'), dtype=np.uint32)
+        # 码点重编号为稠密秩：一元组键为秩r，二元组键为 R + r1 * R + r2，保证打包后不溢出
+        self.alphabet = _sorted_unique(cps)
+        ranks = np.searchsorted(self.alphabet, cps).astype(np.int64)
+        # 每个位置所属的取值编号，分隔符位置为-1
+        pos_vid = np.repeat(np.arange(len(lowered), dtype=np.int64), lengths + 1)[:cps.size]
+        pos_vid[np.cumsum(lengths + 1)[:-1] - 1] = -1
+        uni = pos_vid >= 0
+        bi = uni[:-1] & (pos_vid[:-1] == pos_vid[1:])
+        size = self.alphabet.size
+        keys = np.concatenate((ranks[uni], size + ranks[:-1][bi] * size + ranks[1:][bi]))
+        ids = np.concatenate((pos_vid[uni], pos_vid[:-1][bi]))
+        bits = max(1, int(len(lowered)).bit_length())
+        packed = _sorted_unique((keys << bits) | ids)
+        keys, self.gram_ids = packed >> bits, (packed & ((1 << bits) - 1)).astype(np.int32)
+        starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+        self.gram_keys = keys[starts]
+        self.gram_offsets = np.append(starts, keys.size).astype(np.int64)
+
+    def _gram_key(self, gram: str) -> int:
+        ranks = []
+        for ch in gram:
+            r = int(np.searchsorted(self.alphabet, ord(ch)))
+            if r >= self.alphabet.size or self.alphabet[r] != ord(ch):
+                return None
+            ranks.append(r)
+        size = self.alphabet.size
+        return ranks[0] if len(ranks) == 1 else size + ranks[0] * size + ranks[1]
+
+    def _posting(self, gram: str) -> np.ndarray:
+        key = self._gram_key(gram)
+        if key is None:
+            return None
+        i = int(np.searchsorted(self.gram_keys, key))
+        if i >= self.gram_keys.size or self.gram_keys[i] != key:
+            return None
+        return self.gram_ids[self.gram_offsets[i]:self.gram_offsets[i + 1]]
+
+    def _literal_candidates(self, literal: str) -> np.ndarray:
+        n = 2 if len(literal) >= 2 else 1
+        lists = []
+        for g in _grams(literal, n):
+            ids = self._posting(g)
+            if ids is None:
+                return np.zeros(0, dtype=np.int32)
+            lists.append(ids)
+        lists.sort(key=len)
+        out = lists[0]
+        for ids in lists[1:]:
+            if out.size == 0:
+                break
+            out = np.intersect1d(out, ids, assume_unique=True)
+        return out
+
+    def candidates(self, literals: list) -> np.ndarray:
+        """包含任一字面量（小写）的n-gram候选取值编号（可能有误报，需再校验）"""
+        parts = [self._literal_candidates(lit) for lit in literals]
+        if not parts:
+            return np.zeros(0, dtype=np.int32)
+        return _sorted_unique(np.concatenate(parts))
+
+    def match_values(self, predicate, literals: list = None) -> np.ndarray:
+        """满足谓词的取值编号：有必需字面量时只校验n-gram候选，否则逐个取值匹配"""
+        if literals:
+            cand = self.candidates(literals)
+        else:
+            cand = np.arange(len(self.values), dtype=np.int32)
+        return np.asarray([v for v in cand if predicate.match(self.values[v])], dtype=np.int64)
+
+    def rows(self, value_ids: np.ndarray) -> np.ndarray:
+        """给定取值编号对应的全部行号（升序）"""
+        if len(value_ids) == 0:
+            return np.zeros(0, dtype=np.int64)
+        chunks = [self.order[self.offsets[v]:self.offsets[v + 1]] for v in value_ids]
+        return np.sort(np.concatenate(chunks))
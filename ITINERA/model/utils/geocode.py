@@ -0,0 +1,169 @@
+import logging
+import concurrent.futures
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger('itinera.geocode')
+
+AMAP_GEOCODE_URL = 'https://restapi.amap.com/v3/geocode/geo'
+
+
+class GeocodeError(Exception):
+    """地理编码失败；error为返回给前端的错误码，status为HTTP状态码"""
+    def __init__(self, error: str, status: int, data=None):
+        super().__init__(error)
+        self.error = error
+        self.status = status
+        self.data = data
+
+
+def gcj_to_wgs(points: np.ndarray):
+    """批量GCJ-02转WGS84，输入/输出形状 (n, 2)；转换失败返回None"""
+    try:
+        from xyconvert import gcj2wgs
+        return gcj2wgs(np.asarray(points, dtype=float).reshape(-1, 2))
+    except Exception as e:
+        logger.warning('坐标转换失败，回退使用GCJ-02: %s', e)
+        return None
+
+
+def _normalize_item(q, city) -> tuple:
+    """(地址, 城市) 去除首尾空白；None 视为空串（返回 missing_q，而不是把 'None' 当作地址请求并缓存）"""
+    return ('' if q is None else str(q).strip(), '' if city is None else str(city).strip())
+
+
+class AmapGeocoder:
+    """高德地理编码：连接池 + (query, city) → WGS84 结果缓存（可选）。
+
+    缓存值为接口返回给前端的结果字典；not_found/no_location 同样缓存，避免批量任务反复查询无效地址。
+    """
+
+    def __init__(self, cache=None, pool_size: int = 8, timeout: float = 7):
+        self.cache = cache
+        self.pool_size = int(pool_size)
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=self.pool_size)
+        self.session.mount('https://', adapter)
+
+    @staticmethod
+    def _cache_key(q: str, city: str) -> str:
+        return f"{city or ''}\t{q}"
+
+    def _request_gcj(self, q: str, city: str, key: str):
+        """请求高德接口，返回 (lon_gcj, lat_gcj)；失败抛出 GeocodeError"""
+        params = {'address': q, 'key': key}
+        if city:
+            params['city'] = city
+        r = self.session.get(AMAP_GEOCODE_URL, params=params, timeout=self.timeout)
+        r.raise_for_status()
+        j = r.json()
+        if j.get('status') != '1':
+            logger.error('高德返回错误: %s', j)
+            raise GeocodeError('amap_error', 502, j)
+        geocodes = j.get('geocodes') or []
+        if not geocodes:
+            logger.info('地理编码未命中: %s | %s', q, city)
+            raise GeocodeError('not_found', 404)
+        loc = geocodes[0].get('location', '')
+        if not loc:
+            logger.info('地理编码无坐标: %s', geocodes[0])
+            raise GeocodeError('no_location', 404)
+        lon_gcj, lat_gcj = [float(x) for x in loc.split(',')]
+        return lon_gcj, lat_gcj
+
+    @staticmethod
+    def _result(lon, lat, converted: bool) -> dict:
+        if converted:
+            return {'lon': float(lon), 'lat': float(lat), 'provider': 'amap', 'coord_in': 'GCJ-02', 'coord_out': 'WGS84'}
+        return {'lon': float(lon), 'lat': float(lat), 'provider': 'amap', 'coord_out': 'GCJ-02'}
+
+    def _store(self, q: str, city: str, result: dict):
+        if self.cache is not None:
+            try:
+                self.cache.set_json(self._cache_key(q, city), result)
+            except Exception as e:
+                logger.warning('地理编码缓存写入失败: %s', e)
+
+    def geocode(self, q: str, city: str, key: str) -> dict:
+        """单条地理编码，返回结果字典；失败抛出 GeocodeError"""
+        cached = self.cache.get_json(self._cache_key(q, city)) if self.cache is not None else None
+        if cached is not None:
+            if cached.get('error'):
+                raise GeocodeError(cached['error'], 404)
+            return cached
+        try:
+            lon_gcj, lat_gcj = self._request_gcj(q, city, key)
+        except GeocodeError as e:
+            if e.status == 404:
+                self._store(q, city, {'error': e.error})
+            raise
+        wgs = gcj_to_wgs([[lon_gcj, lat_gcj]])
+        if wgs is None:
+            return self._result(lon_gcj, lat_gcj, converted=False)
+        result = self._result(wgs[0, 0], wgs[0, 1], converted=True)
+        logger.info('地理编码成功(GCJ->WGS): %s -> (%.6f, %.6f) -> (%.6f, %.6f)', q, lon_gcj, lat_gcj, result['lon'], result['lat'])
+        self._store(q, city, result)
+        return result
+
+    def geocode_batch(self, items: list, key: str, max_workers: int = None) -> list:
+        """批量地理编码。
+
+        Args:
+            items (list): [(query, city), ...]
+            key (str): 高德Key
+            max_workers (int, optional): 并发请求数，默认等于连接池大小
+
+        Returns:
+            list: 与输入顺序一致的结果字典；失败项为 {'error': 错误码}
+        """
+        unique = list(dict.fromkeys(_normalize_item(q, c) for q, c in items))
+        results = {}
+        pending = []
+        for q, c in unique:
+            if not q:
+                results[(q, c)] = {'error': 'missing_q'}
+                continue
+            cached = self.cache.get_json(self._cache_key(q, c)) if self.cache is not None else None
+            if cached is not None:
+                results[(q, c)] = cached
+            else:
+                pending.append((q, c))
+
+        gcj = {}
+        if pending:
+            workers = max(1, min(int(max_workers or self.pool_size), self.pool_size, len(pending)))
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = {executor.submit(self._request_gcj, q, c, key): (q, c) for q, c in pending}
+                for future in concurrent.futures.as_completed(futures):
+                    qc = futures[future]
+                    try:
+                        gcj[qc] = future.result()
+                    except GeocodeError as e:
+                        results[qc] = {'error': e.error}
+                        if e.status == 404:
+                            self._store(qc[0], qc[1], results[qc])
+                    except Exception as e:
+                        logger.warning('地理编码失败: %s | %s: %s', qc[0], qc[1], e)
+                        results[qc] = {'error': 'server_error'}
+
+        if gcj:
+            # 所有GCJ-02坐标一次性向量化转换
+            keys = list(gcj.keys())
+            pts = np.array([gcj[k] for k in keys], dtype=float)
+            wgs = gcj_to_wgs(pts)
+            for i, qc in enumerate(keys):
+                if wgs is None:
+                    results[qc] = self._result(pts[i, 0], pts[i, 1], converted=False)
+                else:
+                    results[qc] = self._result(wgs[i, 0], wgs[i, 1], converted=True)
+                    self._store(qc[0], qc[1], results[qc])
+            logger.info('批量地理编码: 请求 %d 条, 去重后 %d 条, 调用接口 %d 条', len(items), len(unique), len(pending))
+
+        out = []
+        for q, c in items:
+            qc = _normalize_item(q, c)
+            out.append(dict(results.get(qc, {'error': 'server_error'}), q=qc[0], city=qc[1]))
+        return out
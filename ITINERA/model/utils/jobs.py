@@ -0,0 +1,109 @@
+import time
+import uuid
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger('itinera.jobs')
+
+
+class QueueFullError(Exception):
+    """排队任务数已达上限"""
+
+
+class Job:
+    """后台任务状态：queued → running → done / failed"""
+
+    def __init__(self, name: str = ""):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.status = "queued"
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+
+    def to_dict(self, include_result: bool = True) -> dict:
+        data = {
+            "job_id": self.id,
+            "name": self.name,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+        if self.error is not None:
+            data["error"] = self.error
+        if include_result and self.status == "done":
+            data["result"] = self.result
+        return data
+
+
+class JobQueue:
+    """有界后台任务队列。
+
+    Args:
+        max_workers (int): 并发执行的任务数。
+        max_pending (int): 排队+执行中的任务上限，超出时 submit 抛出 QueueFullError。
+        retention (float): 已结束任务的结果保留秒数。
+        max_retained (int): 最多保留的已结束任务数。
+    """
+
+    def __init__(self, max_workers: int = 2, max_pending: int = 20, retention: float = 3600, max_retained: int = 500):
+        self.max_pending = int(max_pending)
+        self.retention = float(retention)
+        self.max_retained = int(max_retained)
+        self._executor = ThreadPoolExecutor(max_workers=int(max_workers), thread_name_prefix="job")
+        self._jobs = OrderedDict()
+        self._active = 0
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, name: str = "", **kwargs) -> Job:
+        job = Job(name=name)
+        with self._lock:
+            self._cleanup()
+            if self._active >= self.max_pending:
+                raise QueueFullError(f"任务队列已满（{self._active}/{self.max_pending}）")
+            self._active += 1
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def _run(self, job: Job, fn, args, kwargs):
+        job.status = "running"
+        job.started_at = time.time()
+        try:
+            job.result = fn(*args, **kwargs)
+            job.status = "done"
+        except Exception as e:
+            logger.exception('后台任务失败: %s', job.id)
+            job.error = str(e)
+            job.status = "failed"
+        finally:
+            job.finished_at = time.time()
+            with self._lock:
+                self._active -= 1
+
+    def get(self, job_id: str):
+        with self._lock:
+            self._cleanup()
+            return self._jobs.get(job_id)
+
+    def _cleanup(self):
+        # 调用方持有锁；按提交顺序淘汰过期或超量的已结束任务
+        now = time.time()
+        finished = [j for j in self._jobs.values() if j.finished_at is not None]
+        excess = len(finished) - self.max_retained
+        for j in finished:
+            if now - j.finished_at > self.retention or excess > 0:
+                self._jobs.pop(j.id, None)
+                excess -= 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            counts = {}
+            for j in self._jobs.values():
+                counts[j.status] = counts.get(j.status, 0) + 1
+            return {"active": self._active, "max_pending": self.max_pending, "jobs": counts}
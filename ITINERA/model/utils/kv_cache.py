@@ -0,0 +1,115 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+
+class SqliteCache:
+    """基于SQLite的持久化键值缓存，支持TTL、条目数上限（按最近访问LRU淘汰）与命中统计。
+
+    值以bytes存储；get_json/set_json 为JSON值的便捷封装。多线程共享一个连接，由锁串行化。
+    """
+
+    def __init__(self, path: str, ttl: float = None, max_entries: int = None, table: str = "kv"):
+        self.path = os.path.abspath(path)
+        self.ttl = float(ttl) if ttl else None
+        self.max_entries = int(max_entries) if max_entries else None
+        self.table = table
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} ("
+                "key TEXT PRIMARY KEY, value BLOB, created_at REAL, accessed_at REAL)"
+            )
+            self._conn.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_accessed ON {self.table}(accessed_at)")
+            self._conn.commit()
+
+    def get(self, key: str):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT value, created_at FROM {self.table} WHERE key=?", (key,)
+            ).fetchone()
+            if row is None or (self.ttl is not None and now - row[1] > self.ttl):
+                self.misses += 1
+                return None
+            self._conn.execute(f"UPDATE {self.table} SET accessed_at=? WHERE key=?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def get_many(self, keys: list) -> dict:
+        """批量读取，返回 {key: value}（仅包含命中的键）"""
+        out = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                out[key] = value
+        return out
+
+    def set(self, key: str, value: bytes):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, sqlite3.Binary(value), now, now)
+            )
+            self._writes += 1
+            if self._writes % 64 == 0:
+                self._prune(now)
+            self._conn.commit()
+
+    def get_json(self, key: str):
+        value = self.get(key)
+        if value is None:
+            return None
+        try:
+            return json.loads(bytes(value).decode("utf-8"))
+        except ValueError:
+            return None
+
+    def set_json(self, key: str, value):
+        self.set(key, json.dumps(value, ensure_ascii=False).encode("utf-8"))
+
+    def _prune(self, now: float):
+        # 调用方持有锁
+        if self.ttl is not None:
+            self._conn.execute(f"DELETE FROM {self.table} WHERE created_at < ?", (now - self.ttl,))
+        if self.max_entries is not None:
+            self._conn.execute(
+                f"DELETE FROM {self.table} WHERE key IN ("
+                f"SELECT key FROM {self.table} ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+
+    def prune(self):
+        with self._lock:
+            self._prune(time.time())
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            size = self._conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+        return {"entries": int(size), "hits": self.hits, "misses": self.misses}
+
+
+_SHARED = {}
+_SHARED_LOCK = threading.Lock()
+
+
+def shared_cache(path: str, ttl: float = None, max_entries: int = None) -> SqliteCache:
+    """按路径复用进程内的SqliteCache实例（首次创建时的参数生效）"""
+    key = os.path.abspath(path)
+    with _SHARED_LOCK:
+        cache = _SHARED.get(key)
+        if cache is None:
+            cache = SqliteCache(key, ttl=ttl, max_entries=max_entries)
+            _SHARED[key] = cache
+        return cache
@@ -0,0 +1,214 @@
+import time
+import threading
+import functools
+from contextlib import contextmanager
+
+# 阶段耗时（秒）直方图分桶
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# 候选数量直方图分桶
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000, 10000)
+
+
+def _fmt_labels(labelnames, values, extra=None) -> str:
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    body = ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in pairs)
+    return "{" + body + "}"
+
+
+def _fmt_value(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if not float(v).is_integer() else str(int(v))
+
+
+class Counter:
+    def __init__(self, name: str, doc: str, labelnames=()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value: float = 1.0, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, v in sorted(self._values.items()):
+                lines.append(f"{self.name}{_fmt_labels(self.labelnames, key)} {_fmt_value(v)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, doc: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._values = {}  # key -> [bucket_counts, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        value = float(value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = [[0] * len(self.buckets), 0.0, 0]
+                self._values[key] = entry
+            for i, b in enumerate(self.buckets):
+                if value <= b:
+                    entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, n) in sorted(self._values.items()):
+                for b, c in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{_fmt_labels(self.labelnames, key, ('le', _fmt_value(b)))} {c}")
+                lines.append(f"{self.name}_sum{_fmt_labels(self.labelnames, key)} {_fmt_value(total)}")
+                lines.append(f"{self.name}_count{_fmt_labels(self.labelnames, key)} {n}")
+        return lines
+
+
+class MetricsRegistry:
+    """进程内指标注册表，按Prometheus文本格式导出"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = cls(name, *args, **kwargs)
+                self._metrics[name] = metric
+            return metric
+
+    def counter(self, name: str, doc: str, labelnames=()) -> Counter:
+        return self._get_or_create(Counter, name, doc, labelnames)
+
+    def histogram(self, name: str, doc: str, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, doc, labelnames, buckets=buckets)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for m in metrics:
+            lines.extend(m.render())
+        return "\n".join(lines) + "\n"
+
+
+METRICS = MetricsRegistry()
+
+STAGE_SECONDS = METRICS.histogram("itinera_stage_seconds", "Latency of SiteSelector pipeline stages.", ("stage",))
+STAGE_ERRORS = METRICS.counter("itinera_stage_errors_total", "SiteSelector pipeline stages that raised.", ("stage",))
+CANDIDATES = METRICS.histogram("itinera_candidates", "Candidate sites remaining after each retrieval/filter step.", ("step",), buckets=COUNT_BUCKETS)
+MODEL_CALLS = METRICS.counter("itinera_model_calls_total", "LLM and embedding API calls.", ("kind", "status"))
+MODEL_SECONDS = METRICS.histogram("itinera_model_call_seconds", "Latency of LLM and embedding API calls.", ("kind",))
+CACHE_REQUESTS = METRICS.counter("itinera_cache_requests_total", "Cache lookups by cache and result (hit/miss).", ("cache", "result"))
+
+
+@contextmanager
+def time_stage(stage: str):
+    """统计代码块耗时到 itinera_stage_seconds"""
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage)
+
+
+class StageTimer:
+    """分段累计同一阶段的耗时并只记录一次，用于中间穿插 yield 的流式阶段（不计入调用方消费产出的时间）"""
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        self.elapsed = 0.0
+
+    @contextmanager
+    def measure(self):
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            STAGE_ERRORS.inc(stage=self.stage)
+            raise
+        finally:
+            self.elapsed += time.perf_counter() - start
+
+    def observe(self):
+        STAGE_SECONDS.observe(self.elapsed, stage=self.stage)
+
+
+def timed_stage(stage: str):
+    """方法装饰器版本的 time_stage"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with time_stage(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def time_model_call(kind: str):
+    """统计一次LLM/embedding调用的次数、结果与耗时"""
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except GeneratorExit:
+        # 调用方提前关闭（如SSE客户端断开）不计为调用失败
+        raise
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        MODEL_CALLS.inc(kind=kind, status=status)
+        MODEL_SECONDS.observe(time.perf_counter() - start, kind=kind)
+
+
+class ModelCallTimer:
+    """流式LLM调用的计时：只累计从上游取数据的时间（不含调用方消费每个增量的时间），结束时记录一次调用"""
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.elapsed = 0.0
+        self.status = "ok"
+
+    @contextmanager
+    def measure(self):
+        start = time.perf_counter()
+        try:
+            yield
+        except GeneratorExit:
+            raise
+        except BaseException:
+            self.status = "error"
+            raise
+        finally:
+            self.elapsed += time.perf_counter() - start
+
+    def observe(self):
+        MODEL_CALLS.inc(kind=self.kind, status=self.status)
+        MODEL_SECONDS.observe(self.elapsed, kind=self.kind)
+
+
+def observe_candidates(step: str, n: int):
+    CANDIDATES.observe(int(n), step=step)
@@ -1,12 +1,121 @@
 import requests
 import json
+import hashlib
 import logging
 import os
+import threading
+from collections import OrderedDict
 
+import numpy as np
 from openai import OpenAI
 
+from model.utils.kv_cache import shared_cache
+from model.utils.metrics import time_model_call, ModelCallTimer, CACHE_REQUESTS
+
+
+# Sentinel marking the end of an upstream chat stream
+_STREAM_END = object()
+
+
+def chat_cache_from_env():
+    """由环境变量 OPENAI_CHAT_CACHE_PATH 启用chat响应缓存（默认关闭）"""
+    path = os.getenv("OPENAI_CHAT_CACHE_PATH")
+    if not path:
+        return None
+    return shared_cache(
+        path,
+        ttl=float(os.getenv("OPENAI_CHAT_CACHE_TTL") or 7 * 24 * 3600),
+        max_entries=int(os.getenv("OPENAI_CHAT_CACHE_MAX_ENTRIES") or 10000)
+    )
+
+
+def parse_embedding_response(response) -> np.ndarray:
+    """Convert an embeddings response (dict-style or attribute-style) to a float32 (n, dim) array."""
+    try:
+        return np.array([record["embedding"] for record in response["data"]], dtype=np.float32)
+    except Exception:
+        return np.array([record.embedding for record in response.data], dtype=np.float32)
+
+
+class EmbeddingMemo:
+    """Two-tier memo for text embeddings keyed by (model, text).
+
+    Tier 1 is an in-process LRU; tier 2 is an optional persistent SqliteCache storing raw float32 bytes.
+    """
+
+    def __init__(self, max_items=4096, store=None):
+        self.max_items = int(max_items)
+        self.store = store
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(model, text):
+        return hashlib.sha256(f"{model}\n{text}".encode("utf-8")).hexdigest()
+
+    def get(self, model, text):
+        key = self._key(model, text)
+        with self._lock:
+            vec = self._lru.get(key)
+            if vec is not None:
+                self._lru.move_to_end(key)
+                CACHE_REQUESTS.inc(cache="embedding_lru", result="hit")
+                return vec
+        CACHE_REQUESTS.inc(cache="embedding_lru", result="miss")
+        if self.store is None:
+            return None
+        try:
+            raw = self.store.get(key)
+        except Exception as e:
+            logging.warning("embedding cache read failed: %s", e)
+            raw = None
+        CACHE_REQUESTS.inc(cache="embedding_store", result="hit" if raw is not None else "miss")
+        if raw is None:
+            return None
+        vec = np.frombuffer(bytes(raw), dtype=np.float32)
+        self._remember(key, vec)
+        return vec
+
+    def put(self, model, text, vec):
+        key = self._key(model, text)
+        vec = np.ascontiguousarray(vec, dtype=np.float32)
+        vec.setflags(write=False)
+        self._remember(key, vec)
+        if self.store is not None:
+            try:
+                self.store.set(key, vec.tobytes())
+            except Exception as e:
+                logging.warning("embedding cache write failed: %s", e)
+
+    def _remember(self, key, vec):
+        with self._lock:
+            self._lru[key] = vec
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.max_items:
+                self._lru.popitem(last=False)
+
+
+_EMBEDDING_MEMO = None
+_EMBEDDING_MEMO_LOCK = threading.Lock()
+
+
+def embedding_memo_from_env():
+    """Process-wide EmbeddingMemo; persistent tier enabled by OPENAI_EMBEDDING_CACHE_PATH."""
+    global _EMBEDDING_MEMO
+    with _EMBEDDING_MEMO_LOCK:
+        if _EMBEDDING_MEMO is None:
+            path = os.getenv("OPENAI_EMBEDDING_CACHE_PATH")
+            store = shared_cache(
+                path,
+                ttl=float(os.getenv("OPENAI_EMBEDDING_CACHE_TTL") or 30 * 24 * 3600),
+                max_entries=int(os.getenv("OPENAI_EMBEDDING_CACHE_MAX_ENTRIES") or 200000)
+            ) if path else None
+            _EMBEDDING_MEMO = EmbeddingMemo(max_items=int(os.getenv("OPENAI_EMBEDDING_LRU_SIZE") or 4096), store=store)
+        return _EMBEDDING_MEMO
+
+
 class OpenaiCall:
-    def __init__(self, api_key=None, base_url=None):
+    def __init__(self, api_key=None, base_url=None, chat_cache=None, embedding_memo=None):
         api_key = api_key or os.getenv("OPENAI_API_KEY")
         # Support multiple common env var names for base URL
         base_url = (
@@ -19,41 +128,125 @@ class OpenaiCall:
             self.client = OpenAI(api_key=api_key, base_url=base_url)
         else:
             self.client = OpenAI(api_key=api_key)
+        # Optional response cache (SqliteCache-like: get_json/set_json), keyed by model, messages and temperature
+        self.chat_cache = chat_cache if chat_cache is not None else chat_cache_from_env()
+        # Query embedding memo shared by all instances unless one is passed explicitly
+        self.embedding_memo = embedding_memo if embedding_memo is not None else embedding_memo_from_env()
+
+    def _chat_cache_key(self, model, messages, temperature):
+        raw = json.dumps({"model": model, "messages": messages, "temperature": temperature}, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
 
-    def chat(self, messages, model="gpt-3.5-turbo-1106", temperature=0):
+    def _chat_cache_get(self, key):
+        if key is None:
+            return None
+        try:
+            content = self.chat_cache.get_json(key)
+        except Exception as e:
+            logging.warning("chat cache read failed: %s", e)
+            return None
+        CACHE_REQUESTS.inc(cache="chat", result="hit" if content is not None else "miss")
+        return content
+
+    def _chat_cache_set(self, key, content, validate=None):
+        """Store a completion; empty content, and content the caller's validate() rejects, is never cached"""
+        if key is None or not content:
+            return
+        if validate is not None:
+            try:
+                if not validate(content):
+                    return
+            except Exception:
+                return
+        try:
+            self.chat_cache.set_json(key, content)
+        except Exception as e:
+            logging.warning("chat cache write failed: %s", e)
+
+    def chat(self, messages, model="gpt-3.5-turbo-1106", temperature=0, validate=None):
+        """Return the completion text.
+
+        validate (callable, optional): called with the content before it is cached; the response is cached
+        only if it returns True (e.g. the caller's parser succeeds), so a bad completion is not replayed.
+        """
         # Allow overriding chat model via environment variable
         model = os.getenv("OPENAI_CHAT_MODEL", model)
-        response = self.client.chat.completions.create(
-            model=model,
-            # response_format={"type": "json_object"},
-            messages=messages,
-            temperature=temperature
-        )
-        return response.choices[0].message.content
+        key = self._chat_cache_key(model, messages, temperature) if self.chat_cache is not None else None
+        cached = self._chat_cache_get(key)
+        if cached is not None:
+            return cached
+        with time_model_call("chat"):
+            response = self.client.chat.completions.create(
+                model=model,
+                # response_format={"type": "json_object"},
+                messages=messages,
+                temperature=temperature
+            )
+        content = response.choices[0].message.content
+        self._chat_cache_set(key, content, validate)
+        return content
 
-    def stream_chat(self, messages, model="gpt-3.5-turbo-1106", temperature=0):
+    def stream_chat(self, messages, model="gpt-3.5-turbo-1106", temperature=0, validate=None):
+        """Yield completion text deltas; the joined text is cached under the same rules as chat()"""
         model = os.getenv("OPENAI_CHAT_MODEL", model)
-        for chunk in self.client.chat.completions.create(
-            model=model,
-            # response_format={"type": "json_object"},
-            messages=messages,
-            temperature=temperature,
-            stream=True
-        ): 
-            # Some providers may yield None chunks intermittently
-            if getattr(chunk, "choices", None):
-                delta = chunk.choices[0].delta
-                content = getattr(delta, "content", None)
-                if content is not None:
-                    yield content
+        key = self._chat_cache_key(model, messages, temperature) if self.chat_cache is not None else None
+        cached = self._chat_cache_get(key)
+        if cached is not None:
+            yield cached
+            return
+        chunks = []
+        # Time only the pulls from the upstream stream, not the caller consuming each token
+        timer = ModelCallTimer("stream_chat")
+        try:
+            with timer.measure():
+                stream = iter(self.client.chat.completions.create(
+                    model=model,
+                    # response_format={"type": "json_object"},
+                    messages=messages,
+                    temperature=temperature,
+                    stream=True
+                ))
+            while True:
+                with timer.measure():
+                    chunk = next(stream, _STREAM_END)
+                if chunk is _STREAM_END:
+                    break
+                # Some providers may yield None chunks intermittently
+                if getattr(chunk, "choices", None):
+                    delta = chunk.choices[0].delta
+                    content = getattr(delta, "content", None)
+                    if content is not None:
+                        chunks.append(content)
+                        yield content
+        finally:
+            timer.observe()
+        self._chat_cache_set(key, "".join(chunks), validate)
     
     def embedding(self, input_data, model=None):
         # Align default with offline embeddings generated by emb_gen.py
         # Can be overridden via env var OPENAI_EMBEDDING_MODEL
         model = model or os.getenv("OPENAI_EMBEDDING_MODEL", "text-embedding-ada-002")
-        response = self.client.embeddings.create(
-            input=input_data,
-            model=model
-        )
+        with time_model_call("embedding"):
+            response = self.client.embeddings.create(
+                input=input_data,
+                model=model
+            )
+
+        return response
 
-        return response
\ No newline at end of file
+    def embed_texts(self, texts, model=None):
+        """Embed a list of texts as a float32 (n, dim) array, reusing memoized vectors and
+        sending only the misses in a single embeddings request."""
+        model = model or os.getenv("OPENAI_EMBEDDING_MODEL", "text-embedding-ada-002")
+        texts = [str(t) for t in texts]
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        vectors = [self.embedding_memo.get(model, t) for t in texts]
+        missing = list(dict.fromkeys(t for t, v in zip(texts, vectors) if v is None))
+        if missing:
+            fetched = parse_embedding_response(self.embedding(input_data=missing, model=model))
+            by_text = dict(zip(missing, fetched))
+            for t, v in by_text.items():
+                self.embedding_memo.put(model, t, v)
+            vectors = [v if v is not None else by_text[t] for t, v in zip(texts, vectors)]
+        return np.vstack(vectors).astype(np.float32, copy=False)
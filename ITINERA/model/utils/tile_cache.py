@@ -0,0 +1,220 @@
+import os
+import json
+import time
+import random
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger('itinera.tiles')
+
+
+class TileUpstreamError(Exception):
+    """上游瓦片服务返回非图片或非2xx响应"""
+    def __init__(self, status, content_type="", body=""):
+        super().__init__(f"status={status} ct={content_type} body={body}")
+        self.status = status
+        self.content_type = content_type
+        self.body = body
+
+
+class TileCache:
+    """磁盘瓦片缓存：按 {layer}/{z}/{x}/{y} 存储，超过容量上限时按LRU淘汰。
+
+    每个瓦片保存为数据文件 + 同名 .json 元数据（content_type/etag/fetched_at）。
+    LRU顺序在内存中维护，启动时按文件访问时间重建。
+    """
+
+    def __init__(self, root: str, max_bytes: int = 512 * 1024 * 1024):
+        self.root = os.path.abspath(root)
+        self.max_bytes = int(max_bytes)
+        self._lock = threading.Lock()
+        self._index = OrderedDict()  # key -> 数据文件字节数，尾部为最近使用
+        self._total = 0
+        os.makedirs(self.root, exist_ok=True)
+        self._scan()
+
+    def _key_path(self, key: tuple) -> str:
+        layer, z, x, y = key
+        return os.path.join(self.root, str(layer), str(int(z)), str(int(x)), str(int(y)))
+
+    def _scan(self):
+        entries = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for fn in filenames:
+                if fn.endswith('.json') or fn.endswith('.tmp'):
+                    continue
+                path = os.path.join(dirpath, fn)
+                rel = os.path.relpath(path, self.root).split(os.sep)
+                if len(rel) != 4:
+                    continue
+                try:
+                    st = os.stat(path)
+                    key = (rel[0], int(rel[1]), int(rel[2]), int(rel[3]))
+                except (OSError, ValueError):
+                    continue
+                entries.append((st.st_atime, key, st.st_size))
+        entries.sort()
+        for _, key, size in entries:
+            self._index[key] = size
+            self._total += size
+        if entries:
+            logger.info('瓦片缓存: %d 个, %.1f MB', len(entries), self._total / 1048576)
+
+    def get(self, key: tuple):
+        """返回 (content, meta)；未命中返回None。命中时刷新LRU位置。"""
+        path = self._key_path(key)
+        with self._lock:
+            if key not in self._index:
+                return None
+            self._index.move_to_end(key)
+        try:
+            with open(path, 'rb') as f:
+                content = f.read()
+            with open(path + '.json', 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            os.utime(path, None)
+            return content, meta
+        except (OSError, ValueError):
+            self._drop(key)
+            return None
+
+    def put(self, key: tuple, content: bytes, meta: dict):
+        path = self._key_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 先写临时文件再替换，避免并发读到半个瓦片
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(content)
+        os.replace(tmp, path)
+        tmp = f"{path}.json.{threading.get_ident()}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(tmp, path + '.json')
+        with self._lock:
+            self._total -= self._index.pop(key, 0)
+            self._index[key] = len(content)
+            self._total += len(content)
+        self._evict()
+
+    def touch(self, key: tuple, meta: dict):
+        """上游返回304时仅更新元数据"""
+        path = self._key_path(key)
+        try:
+            with open(path + '.json', 'w', encoding='utf-8') as f:
+                json.dump(meta, f)
+        except OSError:
+            pass
+
+    def _drop(self, key: tuple):
+        with self._lock:
+            self._total -= self._index.pop(key, 0)
+        path = self._key_path(key)
+        for p in (path, path + '.json'):
+            try:
+                os.remove(p)
+            except OSError:
+                pass
+
+    def _evict(self):
+        while True:
+            with self._lock:
+                if self._total <= self.max_bytes or not self._index:
+                    return
+                key = next(iter(self._index))
+            self._drop(key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'tiles': len(self._index), 'bytes': self._total, 'max_bytes': self.max_bytes}
+
+
+class TiandituTileProxy:
+    """天地图瓦片代理：磁盘缓存 + 连接池 + 同一瓦片并发未命中合并为一次上游请求。
+
+    缓存超过 max_age 秒后视为过期，用 If-None-Match 向上游重新验证；
+    上游失败时回退使用过期缓存。
+    """
+
+    def __init__(self, cache: TileCache, max_age: int = 7 * 24 * 3600, timeout: float = 10, pool_size: int = 16):
+        self.cache = cache
+        self.max_age = int(max_age)
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def get_tile(self, layer: str, z: int, x: int, y: int, tk: str):
+        """返回 (content, content_type, etag)；上游失败且无缓存时抛出 TileUpstreamError。"""
+        key = (layer, int(z), int(x), int(y))
+        cached = self.cache.get(key)
+        if cached is not None and time.time() - cached[1].get('fetched_at', 0) < self.max_age:
+            content, meta = cached
+            return content, meta.get('content_type') or 'image/png', meta.get('etag')
+
+        with self._lock:
+            fut = self._inflight.get(key)
+            leader = fut is None
+            if leader:
+                fut = Future()
+                self._inflight[key] = fut
+        if not leader:
+            return fut.result(timeout=self.timeout * 2)
+
+        try:
+            res = self._fetch(key, tk, cached)
+            fut.set_result(res)
+            return res
+        except BaseException as e:
+            fut.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def _fetch(self, key: tuple, tk: str, cached):
+        layer, z, x, y = key
+        s = random.randint(0, 7)
+        url = f"https://t{s}.tianditu.gov.cn/DataServer?T={layer}&x={x}&y={y}&l={z}&tk={tk}"
+        headers = {}
+        if cached is not None and cached[1].get('upstream_etag'):
+            headers['If-None-Match'] = cached[1]['upstream_etag']
+        try:
+            r = self.session.get(url, headers=headers, timeout=self.timeout)
+        except requests.RequestException:
+            if cached is not None:
+                logger.warning('天地图请求失败，使用过期缓存: %s', key)
+                return cached[0], cached[1].get('content_type') or 'image/png', cached[1].get('etag')
+            raise
+
+        if r.status_code == 304 and cached is not None:
+            content, meta = cached
+            meta['fetched_at'] = time.time()
+            self.cache.touch(key, meta)
+            return content, meta.get('content_type') or 'image/png', meta.get('etag')
+
+        ct = r.headers.get('Content-Type', '')
+        if not r.ok or not (ct.startswith('image/') or ct == 'application/octet-stream'):
+            if cached is not None:
+                logger.warning('天地图瓦片异常，使用过期缓存: status=%s %s', r.status_code, key)
+                return cached[0], cached[1].get('content_type') or 'image/png', cached[1].get('etag')
+            raise TileUpstreamError(r.status_code, ct, r.text[:200] if hasattr(r, 'text') else '')
+
+        content = r.content
+        etag = '"' + hashlib.sha1(content).hexdigest() + '"'
+        meta = {
+            'content_type': ct or 'image/png',
+            'etag': etag,
+            'upstream_etag': r.headers.get('ETag'),
+            'fetched_at': time.time(),
+        }
+        self.cache.put(key, content, meta)
+        return content, meta['content_type'], etag
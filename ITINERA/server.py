@@ -1,6 +1,7 @@
 import os
 import json
 import logging
+import threading
 from flask import Flask, request, jsonify, send_from_directory
 
 # Import SiteSelector and SimpleProxy
@@ -8,8 +9,16 @@ from flask import Flask, jsonify, request, send_from_directory
 import os
 
 from model.site_selector import SiteSelector
+from model.search import SEARCH_MODES
+from model.registry import DATASET_REGISTRY, resolve_city_dataset, UnknownCityError
+from model.embedding_manifest import EmbeddingsNotBuiltError
 # 替换 SimpleProxy 为支持 base_url 的 OpenaiCall
 from model.utils.proxy_call import OpenaiCall
+from model.utils.tile_cache import TileCache, TiandituTileProxy, TileUpstreamError
+from model.utils.kv_cache import SqliteCache
+from model.utils.geocode import AmapGeocoder, GeocodeError
+from model.utils.jobs import JobQueue, QueueFullError
+from model.utils.metrics import METRICS
 
 app = Flask(__name__, static_folder='web', static_url_path='/static')
 
@@ -31,12 +40,28 @@ def _apply_env_from_config():
     keys = [
         'OPENAI_BASE_URL', 'OPENAI_API_BASE', 'OPENAI_PROXY_BASE',
         'OPENAI_API_KEY', 'DEEPSEEK_API_KEY',
-        'OPENAI_CHAT_MODEL', 'OPENAI_EMBEDDING_MODEL'
+        'DEEPSEEK_RULES_CACHE_PATH', 'DEEPSEEK_RULES_CACHE_TTL', 'DEEPSEEK_RULES_CACHE_MAX_ENTRIES',
+        'OPENAI_CHAT_MODEL', 'OPENAI_EMBEDDING_MODEL',
+        'OPENAI_CHAT_CACHE_PATH', 'OPENAI_CHAT_CACHE_TTL', 'OPENAI_CHAT_CACHE_MAX_ENTRIES',
+        'OPENAI_EMBEDDING_CACHE_PATH', 'OPENAI_EMBEDDING_CACHE_TTL', 'OPENAI_EMBEDDING_CACHE_MAX_ENTRIES',
+        'OPENAI_EMBEDDING_LRU_SIZE', 'EMBEDDING_CHUNK_SIZE', 'EMBEDDING_MAX_WORKERS',
+        'ANN_NPROBE', 'EMBEDDING_STORAGE', 'QUANT_RERANK',
+        'SEARCH_MODE', 'SEARCH_LEXICAL_WEIGHT', 'SEARCH_EMBED_TIMEOUT',
+        'EMBEDDING_PROVIDER', 'LOCAL_EMBEDDING_DIM',
+        'CITY_DATASETS', 'DATASET_MEMORY_MB', 'PRELOAD_CITIES', 'PRELOAD_ON_STARTUP'
     ]
     for k in keys:
         v = CONFIG.get(k)
         if isinstance(v, str):
             v = v.strip()
+        elif isinstance(v, dict):
+            v = json.dumps(v, ensure_ascii=False)
+        elif isinstance(v, list):
+            v = ','.join(str(x) for x in v)
+        elif isinstance(v, bool):
+            v = 'true' if v else 'false'
+        elif isinstance(v, (int, float)):
+            v = str(v)
         if v:
             if k in os.environ:
                 continue
@@ -64,8 +89,7 @@ def get_config():
     logger.info('配置查询: %s', data)
     return jsonify(data)
 
-from flask import Response
-import random
+from flask import Response, stream_with_context
 
 # ------------------- OpenLayers examples build serving -------------------
 EXAMPLES_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'openlayers', 'build', 'examples'))
@@ -99,6 +123,23 @@ def index():
 def health():
     return jsonify({"status": "ok"})
 
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
+
+# 地理编码结果缓存 (query, city) → WGS84，默认保留30天
+GEOCODER = AmapGeocoder(
+    cache=SqliteCache(
+        CONFIG.get('GEOCODE_CACHE_PATH') or os.environ.get('GEOCODE_CACHE_PATH') or os.path.join(CACHE_DIR, 'geocode.sqlite'),
+        ttl=float(CONFIG.get('GEOCODE_CACHE_TTL') or os.environ.get('GEOCODE_CACHE_TTL') or 30 * 24 * 3600)
+    ),
+    pool_size=int(CONFIG.get('GEOCODE_POOL_SIZE') or os.environ.get('GEOCODE_POOL_SIZE') or 8)
+)
+GEOCODE_BATCH_MAX = 5000
+
+@app.route('/api/metrics', methods=['GET'])
+def metrics():
+    """Prometheus文本格式的阶段耗时、候选数量与模型调用指标"""
+    return Response(METRICS.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
 @app.route('/api/geocode', methods=['GET'])
 def geocode():
     q = request.args.get('q', '').strip()
@@ -110,59 +151,71 @@ def geocode():
     if not key:
         logger.error('AMAP_KEY 未配置')
         return jsonify({'error': 'missing_key'}), 500
-    url = 'https://restapi.amap.com/v3/geocode/geo'
-    params = {'address': q, 'key': key}
-    if city:
-        params['city'] = city
     try:
-        import requests
-        r = requests.get(url, params=params, timeout=7)
-        r.raise_for_status()
-        j = r.json()
-        if j.get('status') != '1':
-            logger.error('高德返回错误: %s', j)
-            return jsonify({'error': 'amap_error', 'data': j}), 502
-        geocodes = j.get('geocodes') or []
-        if not geocodes:
-            logger.info('地理编码未命中: %s | %s', q, city)
-            return jsonify({'error': 'not_found'}), 404
-        loc = geocodes[0].get('location', '')
-        if not loc:
-            logger.info('地理编码无坐标: %s', geocodes[0])
-            return jsonify({'error': 'no_location'}), 404
-        lon_gcj, lat_gcj = [float(x) for x in loc.split(',')]
-        try:
-            import numpy as np
-            from xyconvert import gcj2wgs
-            wgs = gcj2wgs(np.array([[lon_gcj, lat_gcj]]))
-            lon_wgs, lat_wgs = float(wgs[0, 0]), float(wgs[0, 1])
-            logger.info('地理编码成功(GCJ->WGS): %s -> (%.6f, %.6f) -> (%.6f, %.6f)', q, lon_gcj, lat_gcj, lon_wgs, lat_wgs)
-            return jsonify({'lon': lon_wgs, 'lat': lat_wgs, 'provider': 'amap', 'coord_in': 'GCJ-02', 'coord_out': 'WGS84'})
-        except Exception as conv_e:
-            logger.warning('坐标转换失败，回退使用GCJ-02: %s', conv_e)
-            return jsonify({'lon': lon_gcj, 'lat': lat_gcj, 'provider': 'amap', 'coord_out': 'GCJ-02'})
+        return jsonify(GEOCODER.geocode(q, city, key))
+    except GeocodeError as e:
+        payload = {'error': e.error}
+        if e.data is not None:
+            payload['data'] = e.data
+        return jsonify(payload), e.status
     except Exception as e:
         logger.exception('地理编码异常')
         return jsonify({'error': 'server_error', 'detail': str(e)}), 500
 
+@app.route('/api/geocode/batch', methods=['POST'])
+def geocode_batch():
+    """批量地理编码：{"addresses": [str | {"q", "city"}], "city": 默认城市}"""
+    data = request.get_json(force=True, silent=True) or {}
+    addresses = data.get('addresses') or []
+    default_city = str(data.get('city') or '').strip()
+    key = CONFIG.get('AMAP_KEY') or os.environ.get('AMAP_KEY') or ''
+    if not isinstance(addresses, list) or not addresses:
+        return jsonify({'error': 'missing_addresses'}), 400
+    if len(addresses) > GEOCODE_BATCH_MAX:
+        return jsonify({'error': 'too_many_addresses', 'max': GEOCODE_BATCH_MAX}), 400
+    if not key:
+        logger.error('AMAP_KEY 未配置')
+        return jsonify({'error': 'missing_key'}), 500
+    items = []
+    for a in addresses:
+        if isinstance(a, dict):
+            items.append((a.get('q') or a.get('address') or '', a.get('city') or default_city))
+        else:
+            items.append((a, default_city))
+    try:
+        results = GEOCODER.geocode_batch(items, key)
+        found = sum(1 for r in results if 'error' not in r)
+        logger.info('批量地理编码完成: %d/%d', found, len(results))
+        return jsonify({'results': results, 'found': found, 'total': len(results)})
+    except Exception as e:
+        logger.exception('批量地理编码异常')
+        return jsonify({'error': 'server_error', 'detail': str(e)}), 500
+
+# 瓦片磁盘缓存（容量上限与过期时间可在配置中覆盖）
+TILE_CACHE_DIR = CONFIG.get('TILE_CACHE_DIR') or os.environ.get('TILE_CACHE_DIR') or os.path.join(CACHE_DIR, 'tiles')
+TILE_PROXY = TiandituTileProxy(
+    TileCache(TILE_CACHE_DIR, max_bytes=int(float(CONFIG.get('TILE_CACHE_MAX_MB') or os.environ.get('TILE_CACHE_MAX_MB') or 512) * 1024 * 1024)),
+    max_age=int(CONFIG.get('TILE_CACHE_MAX_AGE') or os.environ.get('TILE_CACHE_MAX_AGE') or 7 * 24 * 3600)
+)
+
 def _proxy_tianditu(T, z, x, y):
     tk = CONFIG.get('TIANDITU_TK') or os.environ.get('TIANDITU_TK') or ''
     if not tk:
         logger.error('TIANDITU_TK 未配置')
         return jsonify({'error': 'missing_tk'}), 500
-    s = random.randint(0, 7)
-    url = f"https://t{s}.tianditu.gov.cn/DataServer?T={T}&x={x}&y={y}&l={z}&tk={tk}"
     try:
-        import requests
-        r = requests.get(url, timeout=10)
-        ct = r.headers.get('Content-Type', '')
-        if not r.ok or not (ct.startswith('image/') or ct == 'application/octet-stream'):
-            body = r.text[:200] if hasattr(r, 'text') else ''
-            logger.error('天地图瓦片异常: status=%s ct=%s body=%s url=%s', r.status_code, ct, body, url)
-            return jsonify({'error': 'tianditu_error', 'status': r.status_code}), 502
-        resp = Response(r.content, mimetype=ct or 'image/png')
+        content, ct, etag = TILE_PROXY.get_tile(T, z, x, y, tk)
+        if etag and etag in request.headers.get('If-None-Match', ''):
+            resp = Response(status=304)
+        else:
+            resp = Response(content, mimetype=ct or 'image/png')
         resp.headers['Cache-Control'] = 'public, max-age=604800'
+        if etag:
+            resp.headers['ETag'] = etag
         return resp
+    except TileUpstreamError as e:
+        logger.error('天地图瓦片异常: status=%s ct=%s body=%s tile=%s/%s/%s/%s', e.status, e.content_type, e.body, T, z, x, y)
+        return jsonify({'error': 'tianditu_error', 'status': e.status}), 502
     except Exception as e:
         logger.exception('瓦片代理异常')
         return jsonify({'error': 'server_error', 'detail': str(e)}), 500
@@ -175,58 +228,181 @@ def tiles_vec(z, x, y):
 def tiles_cva(z, x, y):
     return _proxy_tianditu('cva_w', z, x, y)
 
-@app.route('/api/recommendations', methods=['POST'])
-def recommendations():
+# 城市数据集按需加载：guangzhou 为带交通与价格指标的真实数据CSV，其他城市见 CITY_DATASETS 或 {city}_{type}.csv
+DEFAULT_CITY = 'guangzhou'
+
+def _parse_recommendation_request(data):
+    """校验推荐请求参数，返回 (参数dict, None) 或 (None, 错误响应)"""
+    data = data or {}
+    requirements = data.get('requirements', '').strip()
+    if not requirements:
+        logger.warning('推荐请求缺少需求描述')
+        return None, (jsonify({"error": "需求描述不能为空"}), 400)
+
+    # Load API key from environment
+    api_key = os.environ.get('OPENAI_API_KEY')
+    if not api_key:
+        logger.error('OPENAI_API_KEY 未设置')
+        return None, (jsonify({"error": "OPENAI_API_KEY 未设置，请在环境变量中配置"}), 400)
+
+    search_mode = data.get('search_mode') or None
+    if search_mode is not None and search_mode not in SEARCH_MODES:
+        return None, (jsonify({"error": f"search_mode 仅支持 {', '.join(SEARCH_MODES)}"}), 400)
+
+    city = str(data.get('city') or DEFAULT_CITY).strip().lower()
+    dataset_type = data.get('type', 'zh')
     try:
-        data = request.get_json(force=True)
-        requirements = data.get('requirements', '').strip()
+        resolve_city_dataset(city, dataset_type)
+    except UnknownCityError as e:
+        return None, (jsonify({"error": str(e)}), 400)
+
+    return {
+        'requirements': requirements,
+        'search_mode': search_mode,
+        'top_k': int(data.get('top_k', 10)),
+        'city': city,
+        'type': dataset_type,
+        'api_key': api_key,
+    }, None
+
+def _create_selector(params):
+    """按请求参数构造SiteSelector（包含需求解析的LLM调用）"""
+    # 支持通过环境变量设置自定义 Base URL（如国内代理服务）
+    # OpenaiCall 内部也会自动读取 OPENAI_BASE_URL / OPENAI_API_BASE / OPENAI_PROXY_BASE
+    proxy = OpenaiCall(api_key=params['api_key'])
+
+    return SiteSelector(
+        user_reqs=params['requirements'],
+        city=params['city'],
+        min_site_candidate_num=params['top_k'],
+        proxy_call=proxy,
+        type=params['type'],
         # 文本权重固定为 1.0
-        w_text = 1.0
+        blend_w_text=1.0,
         # 禁用 SAFE：强制不使用 SAFE 权重
-        w_safe = 0.0
-        min_site_candidate_num = int(data.get('top_k', 10))
-        city = data.get('city', 'guangzhou')
-        type_ = data.get('type', 'zh')
-
-        if not requirements:
-            logger.warning('推荐请求缺少需求描述')
-            return jsonify({"error": "需求描述不能为空"}), 400
-
-        # Load API key from environment
-        api_key = os.environ.get('OPENAI_API_KEY')
-        if not api_key:
-            logger.error('OPENAI_API_KEY 未设置')
-            return jsonify({"error": "OPENAI_API_KEY 未设置，请在环境变量中配置"}), 400
-
-        # 支持通过环境变量设置自定义 Base URL（如国内代理服务）
-        # OpenaiCall 内部也会自动读取 OPENAI_BASE_URL / OPENAI_API_BASE / OPENAI_PROXY_BASE
-        proxy = OpenaiCall(api_key=api_key)
-
-        # 使用带交通与价格指标的真实数据CSV（自动生成同名npy）
-        dataset_csv_path = os.path.abspath(os.path.join(os.path.dirname(__file__), 'model', 'data', 'land_transactions_with_coordinates_metrics.csv'))
-
-        selector = SiteSelector(
-            user_reqs=requirements,
-            city=city,
-            min_site_candidate_num=min_site_candidate_num,
-            proxy_call=proxy,
-            type=type_,
-            blend_w_text=w_text,
-            blend_w_safe=w_safe,
-            enable_safe=False,
-            dataset_path=dataset_csv_path
-        )
-
-        logger.info('开始生成推荐: city=%s top_k=%s', city, min_site_candidate_num)
+        blend_w_safe=0.0,
+        enable_safe=False,
+        search_mode=params.get('search_mode')
+    )
+
+@app.route('/api/recommendations', methods=['POST'])
+def recommendations():
+    try:
+        params, error = _parse_recommendation_request(request.get_json(force=True))
+        if error:
+            return error
+
+        selector = _create_selector(params)
+
+        logger.info('开始生成推荐: city=%s top_k=%s', params['city'], params['top_k'])
         result = selector.solve()
         logger.info('推荐生成完成')
         # result is expected to contain: features (GeoJSON-like), center {lon, lat}, sites list, etc.
         return jsonify(result)
 
+    except EmbeddingsNotBuiltError as e:
+        logger.error('数据集embedding未构建: %s', e)
+        return jsonify({"error": str(e)}), 503
     except Exception as e:
         logger.exception('推荐服务异常')
         return jsonify({"error": f"服务端异常: {str(e)}"}), 500
 
+# 推荐后台任务队列：提交即返回job_id，由有界线程池执行，前端轮询结果
+RECOMMENDATION_JOBS = JobQueue(
+    max_workers=int(CONFIG.get('JOB_WORKERS') or os.environ.get('JOB_WORKERS') or 2),
+    max_pending=int(CONFIG.get('JOB_MAX_PENDING') or os.environ.get('JOB_MAX_PENDING') or 20),
+    retention=float(CONFIG.get('JOB_RETENTION') or os.environ.get('JOB_RETENTION') or 3600)
+)
+
+def _run_recommendation_job(params):
+    selector = _create_selector(params)
+    logger.info('后台任务开始生成推荐: city=%s top_k=%s', params['city'], params['top_k'])
+    return selector.solve()
+
+@app.route('/api/recommendations/jobs', methods=['POST'])
+def submit_recommendation_job():
+    try:
+        params, error = _parse_recommendation_request(request.get_json(force=True))
+        if error:
+            return error
+        job = RECOMMENDATION_JOBS.submit(_run_recommendation_job, params, name='recommendation')
+        logger.info('推荐任务已提交: %s', job.id)
+        resp = jsonify(dict(job.to_dict(include_result=False), status_url=f'/api/recommendations/jobs/{job.id}'))
+        return resp, 202
+    except QueueFullError as e:
+        logger.warning('推荐任务队列已满: %s', e)
+        return jsonify({"error": "任务队列已满，请稍后重试"}), 429
+    except Exception as e:
+        logger.exception('推荐任务提交异常')
+        return jsonify({"error": f"服务端异常: {str(e)}"}), 500
+
+@app.route('/api/recommendations/jobs/<job_id>', methods=['GET'])
+def get_recommendation_job(job_id):
+    job = RECOMMENDATION_JOBS.get(job_id)
+    if job is None:
+        return jsonify({"error": "任务不存在或已过期"}), 404
+    return jsonify(job.to_dict())
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.route('/api/recommendations/stream', methods=['POST'])
+def recommendations_stream():
+    """以Server-Sent Events逐阶段推送推荐结果：requirements → candidates → sites → token* → result"""
+    try:
+        params, error = _parse_recommendation_request(request.get_json(force=True))
+    except Exception as e:
+        logger.exception('流式推荐请求解析异常')
+        return jsonify({"error": f"服务端异常: {str(e)}"}), 500
+    if error:
+        return error
+
+    def generate():
+        try:
+            selector = _create_selector(params)
+            logger.info('开始流式生成推荐: city=%s top_k=%s', params['city'], params['top_k'])
+            for event, data in selector.solve_stream():
+                yield _sse(event, data)
+            logger.info('流式推荐生成完成')
+        except Exception as e:
+            logger.exception('流式推荐服务异常')
+            yield _sse('error', {"error": f"服务端异常: {str(e)}"})
+
+    resp = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.headers['X-Accel-Buffering'] = 'no'
+    return resp
+
+
+def _preload_dataset():
+    """启动时预加载 PRELOAD_CITIES（逗号分隔，缺省为默认城市），其余城市在首个请求时加载；
+    预加载是请求路径之外唯一允许就地生成缺失embedding集合的地方"""
+    api_key = os.environ.get('OPENAI_API_KEY')
+    proxy = OpenaiCall(api_key=api_key) if api_key else None
+    cities = [c.strip() for c in (os.environ.get('PRELOAD_CITIES') or DEFAULT_CITY).split(',') if c.strip()]
+    for city in cities:
+        try:
+            bundle = DATASET_REGISTRY.get_city(city, proxy=proxy, build=True)
+            logger.info('数据集已加载: %s -> %s (%d 行, embedding=%s)', city, bundle.data_path, len(bundle.site_data), bundle.emb_path)
+        except Exception:
+            logger.exception('数据集预加载失败: %s', city)
+
+
+def _start_preload():
+    """应用启动时在后台线程预加载（WSGI服务器导入本模块与直接运行均生效，PRELOAD_ON_STARTUP=false 关闭）。
+    预加载期间到达的同城请求在注册表的路径锁上等待其完成，而不是各自生成embedding。
+    多worker部署时各进程会分别预加载，建议先离线运行 python -m model.embedding_builder <csv>
+    （EMBEDDING_STORAGE=int8 时再运行 python -m model.quantize <npy>），预加载只需读取已有集合。"""
+    if (os.environ.get('PRELOAD_ON_STARTUP') or 'true').strip().lower() in ('0', 'false', 'off', 'no'):
+        logger.info('已关闭启动预加载，缺失的embedding集合需离线构建')
+        return
+    threading.Thread(target=_preload_dataset, name='dataset-preload', daemon=True).start()
+
+
+# debug reloader 的父进程只负责监视文件变化，由子进程（WERKZEUG_RUN_MAIN=true）预加载
+if __name__ != '__main__' or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+    _start_preload()
+
 
 if __name__ == '__main__':
     # Allow port override via env
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 测试从任意目录运行时都能导入 model 包
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
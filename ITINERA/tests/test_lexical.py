@@ -0,0 +1,19 @@
+import numpy as np
+import pandas as pd
+
+from model.lexical import LexicalIndex
+
+
+def test_from_frame_tolerates_null_text():
+    frame = pd.DataFrame({
+        "context": ["天河区工业用地", "花都区商业用地", None],
+        "宗地坐落": ["天河区", np.nan, "番禺区"],
+        "土地用途": pd.Categorical(["工业", None, "住宅"]),
+    })
+    index = LexicalIndex.from_frame(frame)
+    assert index.n_docs == 3
+    scores = index.score("工业")
+    assert scores.argmax() == 0 and scores[2] == 0
+    # 空值不作为 "nan"/"None" 文本入索引
+    assert index.score("nan").max() == 0
+    assert index.score("None").max() == 0
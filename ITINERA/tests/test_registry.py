@@ -0,0 +1,37 @@
+import pytest
+
+from model import registry
+from model.registry import UnknownCityError, resolve_city_dataset
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    data = tmp_path / "data"
+    data.mkdir()
+    (data / "shenzhen_zh.csv").write_text("id\n1\n", encoding="utf-8")
+    # 数据目录之外的同名文件不能经由城市名访问
+    (tmp_path / "outside_zh.csv").write_text("id\n1\n", encoding="utf-8")
+    monkeypatch.setattr(registry, "DATA_DIR", str(data))
+    monkeypatch.setattr(registry, "DEFAULT_CITY_DATASETS", {})
+    monkeypatch.delenv("CITY_DATASETS", raising=False)
+    return data
+
+
+def test_resolves_city_in_data_dir(data_dir):
+    data_path, emb_path = resolve_city_dataset(" ShenZhen ", "zh")
+    assert data_path == str(data_dir / "shenzhen_zh.csv")
+    assert emb_path == str(data_dir / "shenzhen_zh.npy")
+
+
+@pytest.mark.parametrize("city, type", [
+    ("../outside", "zh"),
+    ("../../../../../../../tmp/rvt/x", "zh"),
+    ("/etc/passwd", "zh"),
+    ("shenzhen", "../zh"),
+    ("shenzhen", "zh.csv/"),
+    ("beijing", "zh"),
+    ("", "zh"),
+])
+def test_rejects_unknown_or_traversing_names(data_dir, city, type):
+    with pytest.raises(UnknownCityError):
+        resolve_city_dataset(city, type)
@@ -0,0 +1,84 @@
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from model import rules
+from model.rules import ColumnCache, Predicate, RulePlan
+
+
+USAGE = ["工业用地", np.nan, "商业用地", None, "工业", "住宅用地"]
+
+
+def _frame(categorical: bool) -> pd.DataFrame:
+    usage = pd.Categorical(USAGE) if categorical else pd.Series(USAGE, dtype=object)
+    return pd.DataFrame({"土地用途": usage, "面积": [1.0, 2.0, np.nan, 4.0, 5.0, 6.0]})
+
+
+def _contains(pattern: str) -> np.ndarray:
+    return pd.Series(USAGE, dtype=object).str.contains(pattern, case=False, na=False).to_numpy(dtype=bool)
+
+
+@pytest.mark.parametrize("categorical", [False, True])
+@pytest.mark.parametrize("op, value, expected", [
+    ("contains", "工业", _contains("工业")),
+    ("regex", "^商业", _contains("^商业")),
+    ("in", ["住宅", "商业"], _contains("住宅") | _contains("商业")),
+    ("==", "工业", np.array([v == "工业" for v in USAGE])),
+])
+def test_text_predicates_treat_null_as_no_match(categorical, op, value, expected):
+    cache = ColumnCache(_frame(categorical))
+    pred = Predicate("土地用途", op, value)
+    assert pred.evaluate(cache).tolist() == expected.tolist()
+    assert pred.evaluate(cache, np.array([1, 3, 0])).tolist() == expected[[1, 3, 0]].tolist()
+    assert pred.matching_rows(cache).tolist() == np.flatnonzero(expected).tolist()
+    assert pred.pass_count(cache) == int(expected.sum())
+
+
+@pytest.mark.parametrize("categorical", [False, True])
+def test_plan_with_null_text(categorical):
+    frame = _frame(categorical)
+    cache = ColumnCache(frame)
+    rules = [
+        {"column": "土地用途", "op": "contains", "value": "住宅", "negative": True, "confidence": 0.9},
+        {"column": "面积", "op": ">=", "value": 2, "confidence": 0.9},
+    ]
+    plan = RulePlan.compile(rules, frame.columns.tolist())
+    expected = ~_contains("住宅") & (frame["面积"].to_numpy() >= 2)
+    assert plan.mask(cache).tolist() == expected.tolist()
+    assert plan.scores(cache, np.arange(len(frame))).tolist() == [0.5, 1.0, 0.5, 1.0, 1.0, 0.5]
+
+
+def test_match_cache_is_bounded(monkeypatch):
+    monkeypatch.setattr(rules, "MATCH_CACHE_SIZE", 3)
+    cache = ColumnCache(_frame(False))
+    for value in ["工业", "商业", "住宅", "用地", "工"]:
+        Predicate("土地用途", "contains", value).pass_count(cache)
+    assert len(cache._hits) == 3
+    # 最近使用的保留，最早的被淘汰
+    assert [key[2] for key in cache._hits] == ['"住宅"', '"用地"', '"工"']
+
+
+def test_concurrent_first_use_builds_index_once(monkeypatch):
+    built = []
+    real = rules.NgramIndex
+
+    def counting(values, codes):
+        built.append(1)
+        return real(values, codes)
+
+    monkeypatch.setattr(rules, "NgramIndex", counting)
+    cache = ColumnCache(_frame(False))
+    barrier = threading.Barrier(8)
+
+    def worker():
+        barrier.wait()
+        cache.text_index("土地用途")
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(built) == 1
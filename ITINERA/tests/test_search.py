@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from model import search
+from model.ann import IVFIndex
+from model.quantize import Int8Store
+from model.search import SearchEngine
+
+N_ROWS, DIM = 3000, 32
+
+
+class FixedProvider:
+    """按文本确定性生成查询向量，不调用外部接口"""
+    name = "fixed"
+
+    def embed_queries(self, texts):
+        return np.stack([np.random.default_rng(sum(map(ord, t))).normal(size=DIM) for t in texts]).astype(np.float32)
+
+
+@pytest.fixture(scope="module")
+def engines(tmp_path_factory):
+    rng = np.random.default_rng(0)
+    embedding = rng.normal(size=(N_ROWS, DIM)).astype(np.float32)
+    embedding /= np.linalg.norm(embedding, axis=1, keepdims=True)
+    emb_path = str(tmp_path_factory.mktemp("emb") / "x.npy")
+    np.save(emb_path, embedding)
+    common = dict(embedding=embedding, normalized=True, provider=FixedProvider(), mode="vector")
+    brute = SearchEngine(**common)
+    # nprobe覆盖全部簇、重排覆盖全部行时，索引路径应与暴力检索结果完全一致
+    ivf = SearchEngine(ann_index=IVFIndex.build(embedding, n_lists=16), ann_nprobe=16, **common)
+    quantized = Int8Store.build(embedding, emb_path)
+    quantized.rerank = N_ROWS
+    int8 = SearchEngine(quantized=quantized, **common)
+    return brute, ivf, int8
+
+
+@pytest.mark.parametrize("desc", [("工业用地", None), ("工业用地", "住宅小区")])
+@pytest.mark.parametrize("as_rows", [False, True])
+def test_masked_query_matches_across_search_paths(engines, monkeypatch, desc, as_rows):
+    mask = np.random.default_rng(1).random(N_ROWS) < 0.4
+    selector = np.flatnonzero(mask) if as_rows else mask
+    brute, ivf, int8 = engines
+    expected = brute.query(desc, top_k=20, mask=selector)
+
+    # 子集超过该行数才走索引，调小以覆盖IVF/int8路径
+    monkeypatch.setattr(search, "SUBSET_BRUTE_FORCE_ROWS", 100)
+
+    assert expected.shape == (20, 2)
+    assert mask[expected[:, 0].astype(int)].all()
+    for engine in (ivf, int8):
+        result = engine.query(desc, top_k=20, mask=selector)
+        np.testing.assert_array_equal(result[:, 0], expected[:, 0])
+        np.testing.assert_allclose(result[:, 1], expected[:, 1], rtol=1e-5, atol=1e-5)
@@ -0,0 +1,36 @@
+import re
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from model.rules import ColumnCache, Predicate
+from model.text_index import required_literals
+
+
+VALUES = ["abc工业", "ABCD", "xabc", "Bell\x07abc", "工业用地", "商业", "a.b", "aXbc"]
+
+
+def _expected(pattern: str) -> np.ndarray:
+    series = pd.Series(VALUES).astype(str)
+    return series.str.contains(pattern, flags=re.I, na=False).to_numpy()
+
+
+@pytest.mark.parametrize("pattern, literals", [
+    (r"\Aabc", ["abc"]),
+    (r"ABC\d*", ["abc"]),
+    (r"\N{LATIN SMALL LETTER A}bc", ["abc"]),
+    (r"x\U00000061bc", ["xabc"]),
+    ("工业|商业", ["工业", "商业"]),
+])
+def test_required_literals_keep_escapes(pattern, literals):
+    assert required_literals(pattern) == literals
+
+
+@pytest.mark.parametrize("pattern", [r"\Aabc", r"ABC\Z", r"\N{LATIN SMALL LETTER A}bc", r"a\.b", r"\bxabc", "工业$"])
+def test_indexed_regex_matches_pandas(pattern):
+    cache = ColumnCache(pd.DataFrame({"a": VALUES}))
+    pred = Predicate("a", "regex", pattern)
+    expected = _expected(pattern)
+    assert pred.evaluate(cache).tolist() == expected.tolist()
+    assert pred.matching_rows(cache).tolist() == np.flatnonzero(expected).tolist()